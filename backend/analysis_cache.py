@@ -0,0 +1,194 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+
+def hash_text(text: str) -> str:
+    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+
+
+def make_cache_key(
+    doc_text: str,
+    screenshot_texts: List[str],
+    prompt_templates: Dict[str, str],
+    model_name: str,
+    options: Optional[Dict] = None,
+) -> str:
+    """Builds a content-addressed key for one full analysis run.
+
+    `options` holds any other settings that change the output (e.g. chunking).
+    """
+    parts = {
+        "doc": hash_text(doc_text),
+        "screenshots": [hash_text(t) for t in screenshot_texts],
+        "prompts": {name: hash_text(template) for name, template in sorted(prompt_templates.items())},
+        "model": model_name,
+        "options": options or {},
+    }
+    return hash_text(json.dumps(parts, sort_keys=True))
+
+
+class AnalysisCache:
+    """Persistent SQLite cache of analysis results with TTL expiry and LRU eviction.
+
+    Entries older than `ttl_seconds` are treated as misses. When the cache grows
+    beyond `max_entries` or `max_bytes`, the least recently used entries are evicted.
+    """
+
+    def __init__(self, db_path: str, ttl_seconds: int, max_entries: int, max_bytes: int):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS analysis_cache (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_analysis_cache_last_access ON analysis_cache(last_access)")
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[Dict]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM analysis_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            value, created_at = row
+            if self.ttl_seconds and now - created_at > self.ttl_seconds:
+                self._conn.execute("DELETE FROM analysis_cache WHERE key = ?", (key,))
+                self._conn.commit()
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE analysis_cache SET last_access = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+        return json.loads(value)
+
+    def set(self, key: str, value: Dict):
+        payload = json.dumps(value)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO analysis_cache (key, value, size, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, payload, len(payload), now, now),
+            )
+            self._evict(now)
+            self._conn.commit()
+
+    def delete(self, key: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM analysis_cache WHERE key = ?", (key,))
+            self._conn.commit()
+
+    def _evict(self, now: float):
+        if self.ttl_seconds:
+            self._conn.execute("DELETE FROM analysis_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+        count, total_size = self._conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM analysis_cache"
+        ).fetchone()
+        if count <= self.max_entries and total_size <= self.max_bytes:
+            return
+        # Walk entries from least to most recently used until both caps are satisfied
+        to_delete = []
+        for key, size in self._conn.execute("SELECT key, size FROM analysis_cache ORDER BY last_access ASC"):
+            if count <= self.max_entries and total_size <= self.max_bytes:
+                break
+            to_delete.append((key,))
+            count -= 1
+            total_size -= size
+        self._conn.executemany("DELETE FROM analysis_cache WHERE key = ?", to_delete)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            count, total_size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM analysis_cache"
+            ).fetchone()
+        return {
+            "entries": count,
+            "bytes": total_size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class DocumentVersionStore:
+    """Links successive analyses of the same document (per user and document key).
+
+    Each analyzed version records the hashes of its chunks, so the next version
+    can tell which parts changed.
+    """
+
+    def __init__(self, db_path: str):
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS document_versions (
+                user_id TEXT NOT NULL,
+                doc_key TEXT NOT NULL,
+                version INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                report_id TEXT NOT NULL,
+                chunk_hashes TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (user_id, doc_key, version)
+            )"""
+        )
+        self._conn.commit()
+
+    def latest(self, user_id: str, doc_key: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM document_versions WHERE user_id = ? AND doc_key = ? ORDER BY version DESC LIMIT 1",
+                (user_id, doc_key),
+            ).fetchone()
+        if row is None:
+            return None
+        version = dict(row)
+        version["chunk_hashes"] = json.loads(version["chunk_hashes"])
+        return version
+
+    def record(self, user_id: str, doc_key: str, sha256: str, report_id: str, chunk_hashes: List[str]) -> int:
+        with self._lock:
+            (latest,) = self._conn.execute(
+                "SELECT COALESCE(MAX(version), 0) FROM document_versions WHERE user_id = ? AND doc_key = ?",
+                (user_id, doc_key),
+            ).fetchone()
+            self._conn.execute(
+                "INSERT INTO document_versions (user_id, doc_key, version, sha256, report_id, chunk_hashes, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (user_id, doc_key, latest + 1, sha256, report_id, json.dumps(chunk_hashes), time.time()),
+            )
+            self._conn.commit()
+        return latest + 1
+
+
+def diff_chunks(previous_hashes: List[str], current_hashes: List[str]) -> Dict:
+    """Counts which of the current chunks already existed in the previous version."""
+    previous = set(previous_hashes)
+    unchanged = sum(1 for h in current_hashes if h in previous)
+    return {
+        "total": len(current_hashes),
+        "unchanged": unchanged,
+        "changed": len(current_hashes) - unchanged,
+        "removed": len(previous - set(current_hashes)),
+    }
@@ -0,0 +1,50 @@
+import gzip
+import json
+import os
+import uuid
+from typing import Dict, Optional
+
+
+class ArtifactStore:
+    """Compressed JSON artifacts keyed by source content hash and extractor version.
+
+    Artifacts are stored as `<root>/<hash[:2]>/<hash>.<kind>.<version>.json.gz`.
+    Bumping the version (or any setting folded into it) makes old artifacts
+    unreachable, which invalidates them without a migration.
+    """
+
+    def __init__(self, root_dir: str):
+        self.root_dir = root_dir
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(root_dir, exist_ok=True)
+
+    def _path(self, content_hash: str, kind: str, version: str) -> str:
+        return os.path.join(self.root_dir, content_hash[:2], f"{content_hash}.{kind}.{version}.json.gz")
+
+    def load(self, content_hash: str, kind: str, version: str) -> Optional[Dict]:
+        path = self._path(content_hash, kind, version)
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                artifact = json.load(f)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except (OSError, ValueError) as e:
+            # A corrupt artifact is treated as missing and rebuilt
+            print(f"Discarding unreadable artifact {path}: {e}")
+            self.misses += 1
+            return None
+        self.hits += 1
+        return artifact
+
+    def save(self, content_hash: str, kind: str, version: str, artifact: Dict):
+        path = self._path(content_hash, kind, version)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8", compresslevel=6) as f:
+            json.dump(artifact, f)
+        os.replace(tmp_path, path)
+
+    def stats(self) -> Dict:
+        return {"hits": self.hits, "misses": self.misses}
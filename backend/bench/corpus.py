@@ -0,0 +1,98 @@
+"""Synthetic benchmark documents: DOCX and PDF files of several sizes, and screenshots.
+
+The text is generated from a fixed seed, so a corpus is identical between
+runs and commits. It mixes headings, prose, numbers with units, acronyms and
+a few repeated sentences, so the local pre-passes have something to find.
+"""
+import os
+import random
+from typing import Dict, List
+
+import docx
+from PIL import Image, ImageDraw
+
+from reports import render_pdf_report
+
+# Paragraphs per document
+SIZES = {"small": 12, "medium": 80, "large": 400}
+PARAGRAPHS_PER_SECTION = 6
+
+_NOUNS = "module setting screen report user account upload timeout workflow dashboard export field value limit".split()
+_VERBS = "configures validates stores displays updates exports checks sends records removes".split()
+_ADJECTIVES = "default maximum current shared optional required secure internal".split()
+_REPEATED = [
+    "Always save your work before changing any of these settings.",
+    "Contact your administrator if the option is not available.",
+]
+
+
+def _sentence(rng: random.Random) -> str:
+    noun, other = rng.choice(_NOUNS), rng.choice(_NOUNS)
+    kind = rng.random()
+    if kind < 0.2:
+        return f"The {rng.choice(_ADJECTIVES)} {noun} {other} is {rng.choice([10, 15, 30, 60])} {rng.choice(['seconds', 'minutes', 'MB'])}."
+    if kind < 0.25:
+        return "The Application Programming Interface (API) " + f"{rng.choice(_VERBS)} each {noun}."
+    if kind < 0.3:
+        return rng.choice(_REPEATED)
+    return f"The {rng.choice(_ADJECTIVES)} {noun} {rng.choice(_VERBS)} the {other} for every {rng.choice(_NOUNS)}."
+
+
+def document_sections(paragraphs: int, seed: int) -> List[Dict]:
+    rng = random.Random(seed)
+    sections = []
+    for start in range(0, paragraphs, PARAGRAPHS_PER_SECTION):
+        count = min(PARAGRAPHS_PER_SECTION, paragraphs - start)
+        sections.append({
+            "heading": f"{len(sections) + 1}. {rng.choice(_NOUNS).capitalize()} {rng.choice(_NOUNS)}",
+            "paragraphs": [" ".join(_sentence(rng) for _ in range(rng.randint(3, 6))) for _ in range(count)],
+        })
+    return sections
+
+
+def write_docx(path: str, sections: List[Dict]):
+    document = docx.Document()
+    for section in sections:
+        document.add_heading(section["heading"], level=1)
+        for paragraph in section["paragraphs"]:
+            document.add_paragraph(paragraph)
+    document.save(path)
+
+
+def write_pdf(path: str, sections: List[Dict]):
+    # The report renderer lays out headings and paragraphs as real PDF text, which is all extraction needs
+    body = "\n\n".join(
+        f"### {section['heading']}\n" + "\n\n".join(section["paragraphs"]) for section in sections
+    )
+    with open(path, "wb") as f:
+        f.write(render_pdf_report({"original_filename": os.path.basename(path), "summary": body}))
+
+
+def write_screenshot(path: str, lines: List[str], width: int = 1280, height: int = 720):
+    image = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(image)
+    for i, line in enumerate(lines[:30]):
+        draw.text((40, 40 + i * 22), line, fill="black")
+    image.save(path)
+
+
+def build_corpus(root: str, sizes=("small", "medium", "large"), kinds=("docx", "pdf"), screenshots: int = 2, seed: int = 1) -> List[Dict]:
+    """Writes one document per size and kind, plus screenshots showing parts of it.
+
+    Returns [{"size", "kind", "document", "screenshots"}] with file paths.
+    """
+    os.makedirs(root, exist_ok=True)
+    corpus = []
+    for size in sizes:
+        sections = document_sections(SIZES[size], seed + SIZES[size])
+        shots = []
+        for n in range(screenshots):
+            section = sections[n % len(sections)]
+            path = os.path.join(root, f"{size}_screen{n + 1}.png")
+            write_screenshot(path, [section["heading"], *section["paragraphs"][0].split(". ")])
+            shots.append(path)
+        for kind in kinds:
+            path = os.path.join(root, f"{size}.{kind}")
+            (write_docx if kind == "docx" else write_pdf)(path, sections)
+            corpus.append({"size": size, "kind": kind, "document": path, "screenshots": shots})
+    return corpus
@@ -0,0 +1,154 @@
+"""A local stand-in for the Gemini and OpenAI-compatible APIs, for benchmarks.
+
+Serves `POST /v1beta/models/{model}:generateContent` and
+`:streamGenerateContent?alt=sse` (Gemini) and `POST /v1/chat/completions`
+(OpenAI-compatible, with `stream: true`), answering with generated text after
+a configurable delay:
+
+    FAKE_LLM_LATENCY         base seconds per response (default 0.5)
+    FAKE_LLM_TOKEN_LATENCY   extra seconds per output token (default 0)
+    FAKE_LLM_JITTER          +/- fraction applied to the delay (default 0.2)
+    FAKE_LLM_OUTPUT_TOKENS   approximate tokens per text response (default 200)
+    FAKE_LLM_ERROR_RATE      fraction of requests answered with 503 (default 0)
+    FAKE_LLM_SEED            random seed (default 1)
+
+JSON-mode requests get JSON the backend can parse: every quoted field named
+in a combined-analysis prompt, or an empty corrections list for grammar
+batches. Run with `uvicorn bench.fake_llm:app --port 8100` from `backend/`.
+"""
+import asyncio
+import json
+import os
+import random
+import re
+import time
+from collections import Counter
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+LATENCY = float(os.getenv("FAKE_LLM_LATENCY", "0.5"))
+TOKEN_LATENCY = float(os.getenv("FAKE_LLM_TOKEN_LATENCY", "0"))
+JITTER = float(os.getenv("FAKE_LLM_JITTER", "0.2"))
+OUTPUT_TOKENS = int(os.getenv("FAKE_LLM_OUTPUT_TOKENS", "200"))
+ERROR_RATE = float(os.getenv("FAKE_LLM_ERROR_RATE", "0"))
+
+WORDS = (
+    "the document section describes configuration values steps users report page table figure "
+    "should could consistent clearly review update timeout setting screen button field label"
+).split()
+_FIELD = re.compile(r'^"(\w+)":', re.MULTILINE)
+
+app = FastAPI()
+_random = random.Random(int(os.getenv("FAKE_LLM_SEED", "1")))
+stats = Counter()
+
+
+def _delay(output_tokens: int) -> float:
+    delay = LATENCY + TOKEN_LATENCY * output_tokens
+    return max(0.0, delay * (1 + _random.uniform(-JITTER, JITTER)))
+
+
+def _text(tokens: int) -> str:
+    lines = []
+    while tokens > 0:
+        words = [_random.choice(WORDS) for _ in range(min(tokens, 12))]
+        lines.append("- " + " ".join(words).capitalize() + ".")
+        tokens -= len(words)
+    return "\n".join(lines)
+
+
+def _answer(prompt: str, json_mode: bool) -> str:
+    if not json_mode:
+        return _text(OUTPUT_TOKENS)
+    if '"corrections"' in prompt:
+        return json.dumps({"corrections": []})
+    return json.dumps({field: _text(OUTPUT_TOKENS // 4) for field in _FIELD.findall(prompt)})
+
+
+def _tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+
+def _failure(provider: str):
+    stats[f"{provider}_errors"] += 1
+    return JSONResponse({"error": {"code": 503, "message": "Simulated overload"}}, status_code=503)
+
+
+async def _stream(pieces, delay: float, frame):
+    per_piece = delay / max(1, len(pieces))
+    for index, piece in enumerate(pieces):
+        await asyncio.sleep(per_piece)
+        yield f"data: {json.dumps(frame(piece, index == len(pieces) - 1))}\r\n\r\n"
+
+
+@app.post("/v1beta/models/{model_action}")
+async def gemini(model_action: str, request: Request):
+    body = await request.json()
+    action = model_action.split(":")[-1]
+    prompt = "".join(part.get("text", "") for content in body.get("contents", []) for part in content.get("parts", []))
+    json_mode = body.get("generationConfig", {}).get("responseMimeType") == "application/json"
+    stats["gemini_requests"] += 1
+    if _random.random() < ERROR_RATE:
+        return _failure("gemini")
+
+    answer = _answer(prompt, json_mode)
+    usage = {"promptTokenCount": _tokens(prompt), "candidatesTokenCount": _tokens(answer)}
+    delay = _delay(_tokens(answer))
+    if action == "streamGenerateContent":
+        pieces = re.findall(r"\S+\s*", answer)
+
+        def frame(piece, last):
+            event = {"candidates": [{"content": {"role": "model", "parts": [{"text": piece}]}}]}
+            if last:
+                event["usageMetadata"] = usage
+            return event
+
+        return StreamingResponse(_stream(pieces, delay, frame), media_type="text/event-stream")
+
+    await asyncio.sleep(delay)
+    return {
+        "candidates": [{"content": {"role": "model", "parts": [{"text": answer}]}, "finishReason": "STOP"}],
+        "usageMetadata": usage,
+    }
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    prompt = "\n".join(message.get("content", "") for message in body.get("messages", []))
+    json_mode = body.get("response_format", {}).get("type") == "json_object"
+    stats["openai_requests"] += 1
+    if _random.random() < ERROR_RATE:
+        return _failure("openai")
+
+    answer = _answer(prompt, json_mode)
+    usage = {"prompt_tokens": _tokens(prompt), "completion_tokens": _tokens(answer)}
+    delay = _delay(_tokens(answer))
+    created = int(time.time())
+    if body.get("stream"):
+        pieces = re.findall(r"\S+\s*", answer)
+
+        def frame(piece, last):
+            return {"object": "chat.completion.chunk", "created": created, "choices": [{"index": 0, "delta": {"content": piece}}]}
+
+        async def events():
+            async for event in _stream(pieces, delay, frame):
+                yield event
+            yield "data: [DONE]\r\n\r\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    await asyncio.sleep(delay)
+    return {
+        "object": "chat.completion",
+        "created": created,
+        "model": body.get("model"),
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+        "usage": usage,
+    }
+
+
+@app.get("/stats")
+async def get_stats():
+    return dict(stats)
@@ -0,0 +1,454 @@
+"""Load test and benchmark driver.
+
+Starts the fake LLM server and the backend (each with uvicorn, in a scratch
+directory), generates a synthetic corpus, and runs concurrent virtual users
+that sign up, upload, analyze, wait for the job and download both report
+formats. Reports p50/p95/p99 latency and throughput per endpoint, per job
+stage and per LLM task (the latter two from the backend's /metrics), and can
+save the results as a baseline and compare later runs against one.
+
+Run from `backend/`:
+
+    python -m bench.load --users 8 --iterations 2 --save bench/baseline.json
+    python -m bench.load --users 8 --iterations 2 --baseline bench/baseline.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import httpx
+
+from bench.corpus import build_corpus
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PERCENTILES = (50, 95, 99)
+# Latency changes smaller than this are noise, whatever the percentage
+NOISE_FLOOR_SECONDS = 0.005
+# Arguments that do not change the workload, ignored when checking a baseline matches
+OUTPUT_ARGS = ("save", "baseline", "max_regression", "keep_workdir")
+
+_SAMPLE = re.compile(r"^([a-zA-Z_:][\w:]*)(?:\{(.*)\})?\s+(\S+)$")
+_LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * p / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def summarize(latencies: List[float], errors: int, elapsed: float) -> Dict:
+    summary = {"count": len(latencies), "errors": errors, "throughput_per_second": round(len(latencies) / elapsed, 3)}
+    for p in PERCENTILES:
+        value = percentile(latencies, p)
+        summary[f"p{p}"] = round(value, 4) if value is not None else None
+    summary["mean"] = round(sum(latencies) / len(latencies), 4) if latencies else None
+    return summary
+
+
+def parse_metrics(text: str) -> List[tuple]:
+    samples = []
+    for line in text.splitlines():
+        match = _SAMPLE.match(line)
+        if line.startswith("#") or not match:
+            continue
+        labels = dict(_LABEL.findall(match.group(2) or ""))
+        samples.append((match.group(1), labels, float(match.group(3))))
+    return samples
+
+
+def histogram_summaries(samples: List[tuple], metric: str, label: str) -> Dict[str, Dict]:
+    """Estimates percentiles per `label` value from a Prometheus histogram's buckets."""
+    buckets = defaultdict(list)
+    sums, counts = defaultdict(float), defaultdict(float)
+    for name, labels, value in samples:
+        key = labels.get(label)
+        if key is None:
+            continue
+        if name == f"{metric}_bucket":
+            bound = float("inf") if labels["le"] == "+Inf" else float(labels["le"])
+            buckets[key].append((bound, value))
+        elif name == f"{metric}_sum":
+            sums[key] += value
+        elif name == f"{metric}_count":
+            counts[key] += value
+
+    summaries = {}
+    for key, entries in buckets.items():
+        # Other labels (e.g. status) split the series; merge them per bound
+        merged = defaultdict(float)
+        for bound, value in entries:
+            merged[bound] += value
+        ordered = sorted(merged.items())
+        total = ordered[-1][1] if ordered else 0
+        summary = {"count": int(total), "mean": round(sums[key] / counts[key], 4) if counts[key] else None}
+        for p in PERCENTILES:
+            summary[f"p{p}"] = round(_bucket_quantile(ordered, total * p / 100), 4) if total else None
+        summaries[key] = summary
+    return summaries
+
+
+def _bucket_quantile(ordered: List[tuple], rank: float) -> float:
+    previous_bound, previous_count = 0.0, 0.0
+    for bound, count in ordered:
+        if count >= rank:
+            if bound == float("inf"):
+                return previous_bound
+            if count == previous_count:
+                return bound
+            return previous_bound + (bound - previous_bound) * (rank - previous_count) / (count - previous_count)
+        previous_bound, previous_count = bound, count
+    return previous_bound
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.failures: List[str] = []
+
+    async def call(self, name: str, request):
+        started = time.monotonic()
+        try:
+            response = await request
+        except httpx.HTTPError as e:
+            self.errors[name] += 1
+            self.failures.append(f"{name}: {type(e).__name__}: {e}")
+            return None
+        self.latencies[name].append(time.monotonic() - started)
+        if response.status_code >= 400:
+            self.errors[name] += 1
+            self.failures.append(f"{name}: HTTP {response.status_code} {response.text[:200]}")
+            return None
+        return response
+
+    def record(self, name: str, seconds: float, ok: bool = True):
+        if ok:
+            self.latencies[name].append(seconds)
+        else:
+            self.errors[name] += 1
+
+
+async def wait_for_job(client: httpx.AsyncClient, recorder: Recorder, job_id: str, headers: Dict, poll_interval: float) -> Optional[Dict]:
+    while True:
+        response = await recorder.call("job_status", client.get(f"/jobs/{job_id}", headers=headers))
+        if response is None:
+            return None
+        job = response.json()
+        if job["status"] in ("done", "failed"):
+            return job
+        await asyncio.sleep(poll_interval)
+
+
+async def stream_job(client: httpx.AsyncClient, recorder: Recorder, data: Dict, headers: Dict) -> Optional[Dict]:
+    """Runs /analyze/stream and records the time to the first finished section."""
+    started = time.monotonic()
+    event, result, first_section = None, None, None
+    async with client.stream("POST", "/analyze/stream", data=data, headers=headers) as response:
+        if response.status_code != 200:
+            recorder.record("analyze_stream", 0, ok=False)
+            return None
+        async for line in response.aiter_lines():
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: "):
+                if event == "section" and first_section is None:
+                    first_section = time.monotonic() - started
+                if event in ("done", "failed"):
+                    result = {"status": event, **json.loads(line[len("data: "):])}
+    if first_section is not None:
+        recorder.record("first_section", first_section)
+    return result
+
+
+async def virtual_user(number: int, client: httpx.AsyncClient, uploads: List[Dict], args, recorder: Recorder):
+    email = f"bench-{uuid.uuid4().hex[:8]}-{number}@example.com"
+    response = await recorder.call(
+        "signup", client.post("/auth/signup", data={"email": email, "password": "bench-password", "name": f"Bench {number}"})
+    )
+    if response is None:
+        return
+    headers = {"Authorization": f"Bearer {response.json()['token']}"}
+
+    for item in uploads:
+        files = [("document", (os.path.basename(item["document"]), open(item["document"], "rb")))]
+        files += [("screenshots", (os.path.basename(path), open(path, "rb"))) for path in item["screenshots"]]
+        try:
+            response = await recorder.call("upload", client.post("/upload", files=files, headers=headers))
+        finally:
+            for _, (_, handle) in files:
+                handle.close()
+        if response is None:
+            continue
+        data = {"token": response.json()["upload_id"], "mode": args.mode}
+
+        started = time.monotonic()
+        if args.stream:
+            job = await stream_job(client, recorder, data, headers)
+            report_id = job.get("report_id") if job else None
+        else:
+            response = await recorder.call("analyze", client.post("/analyze", data=data, headers=headers))
+            job = await wait_for_job(client, recorder, response.json()["job_id"], headers, args.poll_interval) if response else None
+            report_id = job.get("report_id") if job else None
+        ok = bool(job) and job["status"] == "done"
+        recorder.record(f"analysis_{item['size']}_{item['kind']}", time.monotonic() - started, ok)
+        if not ok:
+            recorder.failures.append(f"job for {item['document']}: {job.get('error') if job else 'no result'}")
+            continue
+
+        for report_format in ("docx", "pdf"):
+            await recorder.call(
+                f"report_{report_format}",
+                client.get(f"/report/{report_id}", params={"format": report_format}, headers=headers),
+            )
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(app: str, port: int, cwd: str, env: Dict, log_path: str) -> subprocess.Popen:
+    log = open(log_path, "w")
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", app, "--app-dir", BACKEND_DIR, "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=cwd, env=env, stdout=log, stderr=subprocess.STDOUT,
+    )
+
+
+def wait_until_ready(url: str, process: subprocess.Popen, log_path: str, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited during startup; see {log_path}")
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Server at {url} did not start within {timeout}s; see {log_path}")
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def build_uploads(workdir: str, args) -> List[List[Dict]]:
+    """The documents each virtual user uploads, one per iteration.
+
+    With a cold cache every upload is a distinct document (its own seed), so
+    nothing is served from the analysis caches; with a warm cache all users
+    share one corpus.
+    """
+    sizes, kinds = args.sizes.split(","), args.kinds.split(",")
+    mixes = [(size, kind) for size in sizes for kind in kinds]
+    shared = None
+    if args.cache == "warm":
+        shared = build_corpus(os.path.join(workdir, "corpus"), sizes, kinds, args.screenshots, args.seed)
+    plan = []
+    for user in range(args.users):
+        uploads = []
+        for iteration in range(args.iterations):
+            size, kind = mixes[(user + iteration) % len(mixes)]
+            if shared is not None:
+                uploads.append(next(item for item in shared if item["size"] == size and item["kind"] == kind))
+                continue
+            seed = args.seed + 1000 * user + iteration
+            root = os.path.join(workdir, "corpus", f"u{user}_i{iteration}")
+            uploads.extend(build_corpus(root, (size,), (kind,), args.screenshots, seed))
+        plan.append(uploads)
+    return plan
+
+
+async def run_load(base_url: str, plan: List[List[Dict]], args) -> Dict:
+    recorder = Recorder()
+    limits = httpx.Limits(max_connections=args.users * 2 + 4)
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as client:
+        started = time.monotonic()
+        await asyncio.gather(*(virtual_user(n, client, uploads, args, recorder) for n, uploads in enumerate(plan)))
+        elapsed = time.monotonic() - started
+        metrics_text = (await client.get("/metrics")).text
+    jobs = sum(len(v) for name, v in recorder.latencies.items() if name.startswith("analysis_"))
+    samples = parse_metrics(metrics_text)
+    return {
+        "elapsed_seconds": round(elapsed, 3),
+        "jobs_completed": jobs,
+        "jobs_per_minute": round(jobs * 60 / elapsed, 2) if elapsed else 0,
+        "endpoints": {
+            name: summarize(recorder.latencies[name], recorder.errors[name], elapsed)
+            for name in sorted(set(recorder.latencies) | set(recorder.errors))
+        },
+        "stages": histogram_summaries(samples, "docanalyzer_job_stage_seconds", "stage"),
+        "llm_tasks": histogram_summaries(samples, "docanalyzer_llm_request_seconds", "task"),
+        "failures": recorder.failures[:20],
+    }
+
+
+def print_results(results: Dict):
+    print(f"\n{results['jobs_completed']} job(s) in {results['elapsed_seconds']}s ({results['jobs_per_minute']} jobs/min)")
+    for section in ("endpoints", "stages", "llm_tasks"):
+        print(f"\n{section:<26}{'count':>7}{'errors':>8}{'p50':>10}{'p95':>10}{'p99':>10}")
+        for name, summary in results[section].items():
+            cells = "".join(f"{summary[f'p{p}']:>10.3f}" if summary[f"p{p}"] is not None else f"{'-':>10}" for p in PERCENTILES)
+            print(f"{name:<26}{summary['count']:>7}{summary.get('errors', 0):>8}{cells}")
+    for failure in results["failures"]:
+        print(f"  failure: {failure}")
+
+
+def compare(results: Dict, baseline: Dict, max_regression: float) -> List[str]:
+    """Prints per-percentile changes against a baseline; returns the p95 regressions beyond `max_regression`."""
+    print(f"\nCompared with baseline {baseline['meta'].get('commit') or ''} ({baseline['meta'].get('timestamp')})")
+    workload = {key: value for key, value in results["meta"]["args"].items() if key not in OUTPUT_ARGS}
+    previous_workload = {key: value for key, value in baseline["meta"].get("args", {}).items() if key not in OUTPUT_ARGS}
+    if workload != previous_workload:
+        differing = sorted(key for key in set(workload) | set(previous_workload) if workload.get(key) != previous_workload.get(key))
+        print(f"Warning: the baseline was run with different settings ({', '.join(differing)}); results are not comparable")
+    base_rate, rate = baseline.get("jobs_per_minute") or 0, results["jobs_per_minute"]
+    regressions = []
+    if base_rate:
+        change = (rate - base_rate) / base_rate
+        print(f"throughput: {base_rate} -> {rate} jobs/min ({change:+.1%})")
+        if change < -max_regression:
+            regressions.append(f"throughput {base_rate} -> {rate} jobs/min ({change:+.0%})")
+    for section in ("endpoints", "stages", "llm_tasks"):
+        for name, summary in results[section].items():
+            previous = baseline.get(section, {}).get(name)
+            if not previous:
+                continue
+            if summary.get("errors", 0) > previous.get("errors", 0):
+                regressions.append(f"{section}/{name} errors {previous.get('errors', 0)} -> {summary['errors']}")
+            changes = []
+            for p in PERCENTILES:
+                old, new = previous.get(f"p{p}"), summary.get(f"p{p}")
+                if old is None or new is None:
+                    continue
+                change = (new - old) / old if old else 0.0
+                changes.append(f"p{p} {old:.3f}->{new:.3f} ({change:+.0%})")
+                if p == 95 and change > max_regression and new - old > NOISE_FLOOR_SECONDS:
+                    regressions.append(f"{section}/{name} p95 {old:.3f}s -> {new:.3f}s ({change:+.0%})")
+            print(f"{section}/{name}: " + ", ".join(changes))
+    for regression in regressions:
+        print(f"REGRESSION: {regression}")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=4, help="concurrent virtual users")
+    parser.add_argument("--iterations", type=int, default=2, help="documents each user uploads and analyzes")
+    parser.add_argument("--sizes", default="small,medium", help="comma-separated: small, medium, large")
+    parser.add_argument("--kinds", default="docx,pdf", help="comma-separated: docx, pdf")
+    parser.add_argument("--screenshots", type=int, default=2, help="screenshots per upload (OCR needs Tesseract)")
+    parser.add_argument("--mode", default="fanout", choices=["fanout", "combined"])
+    parser.add_argument("--stream", action="store_true", help="use /analyze/stream instead of polling /jobs")
+    parser.add_argument("--cache", default="cold", choices=["cold", "warm"], help="distinct documents per upload, or one shared corpus")
+    parser.add_argument("--provider", default="gemini", choices=["gemini", "openai"])
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="fake LLM base latency in seconds")
+    parser.add_argument("--llm-token-latency", type=float, default=0.0, help="fake LLM seconds per output token")
+    parser.add_argument("--llm-jitter", type=float, default=0.2)
+    parser.add_argument("--llm-output-tokens", type=int, default=200)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="fraction of LLM requests answered with 503")
+    parser.add_argument("--app-env", action="append", default=[], metavar="KEY=VALUE", help="extra backend setting, repeatable")
+    parser.add_argument("--poll-interval", type=float, default=0.2)
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", help="write the results (usable as a baseline) to this JSON file")
+    parser.add_argument("--baseline", help="compare against results saved with --save")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="allowed p95 increase before failing, as a fraction")
+    parser.add_argument("--keep-workdir", action="store_true", help="keep the scratch directory with logs and data")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix="docanalyzer-bench-")
+    app_dir = os.path.join(workdir, "app")
+    os.makedirs(app_dir)
+    print(f"Working directory: {workdir}")
+
+    plan = build_uploads(workdir, args)
+    llm_port, app_port = free_port(), free_port()
+    llm_env = {
+        **os.environ,
+        "FAKE_LLM_LATENCY": str(args.llm_latency),
+        "FAKE_LLM_TOKEN_LATENCY": str(args.llm_token_latency),
+        "FAKE_LLM_JITTER": str(args.llm_jitter),
+        "FAKE_LLM_OUTPUT_TOKENS": str(args.llm_output_tokens),
+        "FAKE_LLM_ERROR_RATE": str(args.llm_error_rate),
+        "FAKE_LLM_SEED": str(args.seed),
+    }
+    app_env = {
+        **os.environ,
+        "LLM_PROVIDER": args.provider,
+        "GEMINI_API_KEY": "bench",
+        "OPENAI_API_KEY": "bench",
+        "LLM_BASE_URL": f"http://127.0.0.1:{llm_port}/{'v1beta' if args.provider == 'gemini' else 'v1'}",
+        **dict(setting.split("=", 1) for setting in args.app_env),
+    }
+
+    processes = []
+    try:
+        llm_log, app_log = os.path.join(workdir, "fake_llm.log"), os.path.join(workdir, "app.log")
+        processes.append(start_server("bench.fake_llm:app", llm_port, BACKEND_DIR, llm_env, llm_log))
+        wait_until_ready(f"http://127.0.0.1:{llm_port}/stats", processes[-1], llm_log)
+        processes.append(start_server("main:app", app_port, app_dir, app_env, app_log))
+        wait_until_ready(f"http://127.0.0.1:{app_port}/metrics", processes[-1], app_log)
+
+        results = asyncio.run(run_load(f"http://127.0.0.1:{app_port}", plan, args))
+        results["llm_server"] = httpx.get(f"http://127.0.0.1:{llm_port}/stats").json()
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    results["meta"] = {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "args": vars(args),
+    }
+    print_results(results)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nSaved results to {args.save}")
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.max_regression)
+    if args.keep_workdir or results["failures"]:
+        print(f"Logs and data kept in {workdir}")
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
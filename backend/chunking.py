@@ -0,0 +1,185 @@
+import asyncio
+import os
+import re
+import zlib
+from typing import Awaitable, Callable, Dict, List, Optional
+
+CHUNK_TOKEN_BUDGET = int(os.getenv("CHUNK_TOKEN_BUDGET", "6000"))
+# Rough average for English prose; good enough for budgeting prompt sizes
+CHARS_PER_TOKEN = 4
+
+HEADING_PATTERN = re.compile(r"^(#{1,6}\s+\S|(\d+(\.\d+)*\.?|[IVXLC]+\.|Chapter\s+\d+|Section\s+\d+)\s+[A-Z])")
+PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+LINE_BREAK = re.compile(r"\n")
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+# Multi-chunk documents also end a chunk after any unit whose content hash is
+# divisible by this (once the chunk is a quarter full), so chunk boundaries
+# depend on local content and an edit only changes the chunks around it
+BOUNDARY_MODULUS = 4
+MIN_BOUNDARY_FILL = 0.25
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def _is_heading(line: str) -> bool:
+    stripped = line.strip()
+    return bool(stripped) and len(stripped) < 120 and bool(HEADING_PATTERN.match(stripped))
+
+
+def split_sections(text: str) -> List[str]:
+    """Splits plain text into sections starting at heading-like lines."""
+    sections, current = [], []
+    for line in text.split("\n"):
+        if _is_heading(line) and any(l.strip() for l in current):
+            sections.append("\n".join(current))
+            current = []
+        current.append(line)
+    if current:
+        sections.append("\n".join(current))
+    return [s for s in sections if s.strip()]
+
+
+def split_paragraph_sections(paragraphs: List[Dict]) -> List[str]:
+    """Splits DOCX paragraphs into sections starting at Heading/Title-styled paragraphs."""
+    sections, current = [], []
+    for paragraph in paragraphs:
+        style = paragraph.get("style") or ""
+        is_heading = style.startswith("Heading") or style == "Title" or _is_heading(paragraph["text"])
+        if is_heading and any(p.strip() for p in current):
+            sections.append("\n".join(current))
+            current = []
+        current.append(paragraph["text"])
+    if current:
+        sections.append("\n".join(current))
+    return [s for s in sections if s.strip()]
+
+
+def _split_oversized(text: str, token_budget: int) -> List[str]:
+    """Breaks a unit that exceeds the budget on paragraphs, then lines, then sentences, then characters."""
+    if estimate_tokens(text) <= token_budget:
+        return [text]
+    for pattern, joiner in ((PARAGRAPH_BREAK, "\n\n"), (LINE_BREAK, "\n"), (SENTENCE_END, " ")):
+        parts = [part for part in pattern.split(text) if part.strip()]
+        if len(parts) > 1:
+            return _pack(parts, token_budget, joiner)
+    max_chars = token_budget * CHARS_PER_TOKEN
+    return [text[i:i + max_chars] for i in range(0, len(text), max_chars)]
+
+
+def _pack(parts: List[str], token_budget: int, joiner: str) -> List[str]:
+    packed, current, current_tokens = [], [], 0
+    for part in parts:
+        for piece in _split_oversized(part, token_budget):
+            tokens = estimate_tokens(piece)
+            if current and current_tokens + tokens > token_budget:
+                packed.append(joiner.join(current))
+                current, current_tokens = [], 0
+            current.append(piece)
+            current_tokens += tokens
+    if current:
+        packed.append(joiner.join(current))
+    return packed
+
+
+def _is_content_boundary(text: str) -> bool:
+    return zlib.crc32(text.encode("utf-8")) % BOUNDARY_MODULUS == 0
+
+
+def chunk_document(
+    text: str,
+    pages: Optional[List[Dict]] = None,
+    token_budget: Optional[int] = None,
+    paragraphs: Optional[List[Dict]] = None,
+) -> List[Dict]:
+    """Splits a document into chunks of at most `token_budget` estimated tokens.
+
+    PDF chunks are built from whole pages where they fit, so every chunk maps
+    to a page range; other documents are split on heading-delimited sections,
+    using DOCX paragraph styles when `paragraphs` are given.
+    Each chunk is {"index", "text", "pages", "tokens"}, where `pages` is the
+    (first, last) page range or None. Documents that need more than one chunk
+    are cut at content-defined boundaries so unchanged parts of a revised
+    document produce identical chunks.
+    """
+    token_budget = token_budget or CHUNK_TOKEN_BUDGET
+    if pages:
+        units = [(piece, page["page"]) for page in pages for piece in _split_oversized(page["text"], token_budget)]
+    else:
+        sections = split_paragraph_sections(paragraphs) if paragraphs else split_sections(text)
+        units = [(piece, None) for section in sections for piece in _split_oversized(section, token_budget)]
+
+    multi_chunk = sum(estimate_tokens(piece) for piece, _ in units) > token_budget
+    chunks, current, current_tokens = [], [], 0
+
+    def flush():
+        page_numbers = [n for _, n in current if n is not None]
+        chunk_text = "\n".join(piece for piece, _ in current)
+        chunks.append({
+            "index": len(chunks),
+            "text": chunk_text,
+            "pages": (page_numbers[0], page_numbers[-1]) if page_numbers else None,
+            "tokens": estimate_tokens(chunk_text),
+        })
+
+    for piece, page_number in units:
+        tokens = estimate_tokens(piece)
+        if current and current_tokens + tokens > token_budget:
+            flush()
+            current, current_tokens = [], 0
+        current.append((piece, page_number))
+        current_tokens += tokens
+        if multi_chunk and current_tokens >= token_budget * MIN_BOUNDARY_FILL and _is_content_boundary(piece):
+            flush()
+            current, current_tokens = [], 0
+    if current:
+        flush()
+    return chunks or [{"index": 0, "text": text, "pages": None, "tokens": estimate_tokens(text)}]
+
+
+def chunk_label(chunk: Dict, total: int) -> str:
+    if chunk["pages"]:
+        first, last = chunk["pages"]
+        return f"Page {first}" if first == last else f"Pages {first}-{last}"
+    # Named after the chunk's opening line rather than its position, which shifts when content is inserted
+    opening = next((line.strip() for line in chunk["text"].split("\n") if line.strip()), "")
+    if len(opening) > 60:
+        opening = opening[:57] + "..."
+    return f'Section "{opening}"' if opening else f"Part {chunk['index'] + 1} of {total}"
+
+
+async def map_reduce(
+    chunks: List[Dict],
+    map_fn: Callable[[Dict], Awaitable[str]],
+    reduce_fn: Optional[Callable[[List[str]], Awaitable[str]]] = None,
+    token_budget: Optional[int] = None,
+) -> str:
+    """Runs `map_fn` over all chunks concurrently and merges the partial results.
+
+    Without `reduce_fn` the partials are concatenated in chunk order. Otherwise
+    they are reduced in rounds, grouping as many partials as fit in the token
+    budget, until one result remains. Exceptions raised by `map_fn` or
+    `reduce_fn` propagate to the caller. Concurrency is bounded by whatever limiter `map_fn`/`reduce_fn` use.
+    """
+    token_budget = token_budget or CHUNK_TOKEN_BUDGET
+    partials = await asyncio.gather(*(map_fn(chunk) for chunk in chunks))
+    if reduce_fn is None or len(partials) == 1:
+        return "\n\n".join(partials)
+
+    while len(partials) > 1:
+        groups, current, current_tokens = [], [], 0
+        for partial in partials:
+            tokens = estimate_tokens(partial)
+            # Always merge at least two partials per group so each round shrinks the list
+            if len(current) >= 2 and current_tokens + tokens > token_budget:
+                groups.append(current)
+                current, current_tokens = [], 0
+            current.append(partial)
+            current_tokens += tokens
+        if len(current) == 1 and groups:
+            groups[-1].append(current[0])
+        elif current:
+            groups.append(current)
+        partials = await asyncio.gather(*(reduce_fn(group) for group in groups))
+    return partials[0]
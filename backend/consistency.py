@@ -0,0 +1,262 @@
+import os
+import re
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from repetition import format_position, preview, split_units
+
+# "llm" sends the document to the model as before; "hybrid" indexes numbers, definitions,
+# acronyms and spellings locally and sends only conflicting excerpts; "local" never calls the model
+CONSISTENCY_MODE = os.getenv("CONSISTENCY_MODE", "hybrid").lower()
+CONSISTENCY_MODES = ("llm", "hybrid", "local")
+
+MAX_CONFLICTS = int(os.getenv("CONSISTENCY_MAX_CONFLICTS", "50"))
+# Excerpts listed per conflict; quantities mentioned very often are usually generic words
+MAX_EXCERPTS_PER_CONFLICT = 6
+SUBJECT_WORDS = 3
+LINK_WINDOW_WORDS = 4
+
+# unit -> (dimension, factor to the dimension's base unit)
+UNITS = {}
+for names, dimension, factor in (
+    (("ms", "msec", "millisecond", "milliseconds"), "time", 0.001),
+    (("s", "sec", "secs", "second", "seconds"), "time", 1),
+    (("min", "mins", "minute", "minutes"), "time", 60),
+    (("h", "hr", "hrs", "hour", "hours"), "time", 3600),
+    (("day", "days"), "time", 86400),
+    (("week", "weeks"), "time", 604800),
+    (("b", "byte", "bytes"), "size", 1),
+    (("kb", "kilobyte", "kilobytes"), "size", 1e3),
+    (("mb", "megabyte", "megabytes"), "size", 1e6),
+    (("gb", "gigabyte", "gigabytes"), "size", 1e9),
+    (("tb", "terabyte", "terabytes"), "size", 1e12),
+    (("mm", "millimeter", "millimeters"), "length", 0.001),
+    (("cm", "centimeter", "centimeters"), "length", 0.01),
+    (("m", "meter", "meters", "metre", "metres"), "length", 1),
+    (("km", "kilometer", "kilometers"), "length", 1000),
+    (("g", "gram", "grams"), "mass", 1),
+    (("kg", "kilogram", "kilograms"), "mass", 1000),
+    (("%", "percent", "per cent"), "percent", 1),
+    (("px", "pixel", "pixels"), "pixels", 1),
+    (("v", "volt", "volts"), "voltage", 1),
+    (("°c", "degrees"), "temperature", 1),
+):
+    for name in names:
+        UNITS[name] = (dimension, factor)
+CURRENCIES = {"$": "usd", "€": "eur", "£": "gbp"}
+
+_UNIT_PATTERN = "|".join(sorted((re.escape(name) for name in UNITS), key=len, reverse=True))
+_QUANTITY = re.compile(
+    r"(?P<currency>[$€£])?(?P<number>\d+(?:,\d{3})*(?:\.\d+)?)\s*(?P<unit>" + _UNIT_PATTERN + r")?(?![\w.]*\d)(?!\w)",
+    re.IGNORECASE,
+)
+_WORD = re.compile(r"[A-Za-z][A-Za-z\-']*")
+_CLAUSE_BREAK = re.compile(r"[,;:()]")
+_DEFINITION = re.compile(
+    r"^(?:[Tt]he term\s+)?[\"“']?(?P<term>[A-Z][\w\- ]{0,40}?)[\"”']?\s+(?:means|shall mean|refers to|is defined as|is short for)\s+(?P<definition>.+?)\.?$"
+)
+_ACRONYM_AFTER = re.compile(r"\((?P<acronym>[A-Z][A-Za-z0-9&]{1,9}?)s?\)")
+_ACRONYM_BEFORE = re.compile(r"\b(?P<acronym>[A-Z][A-Z0-9&]{1,9})s?\s+\((?P<expansion>[^()]{3,80})\)")
+_HYPHENATED = re.compile(r"\b[a-z]+(?:-[a-z]+)+\b")
+
+# Words that do not identify what a number measures
+_STOPWORDS = set("""
+a an the is are was were be been being of to for at in on by with from up than set equals equal
+about approximately around roughly only least most per should must will shall can may might not no
+it its this that these those their our your his her all each every and or but as into over under
+has have had do does did which who what when where while then also just exactly nearly almost
+there here we you they i he she
+""".split())
+# "<subject> is/to <number>": the words before the first of these name what the number measures
+_LINKS = {"is", "are", "was", "were", "be", "been", "equals", "to", "at"}
+_DETERMINERS = {"the", "a", "an", "this", "these", "those", "our", "your", "its", "their", "each", "every"}
+_PREPOSITIONS = {"of", "for", "in", "on", "per", "from", "with"}
+# Imperatives that open instructions ("Set the retry limit to 5")
+_LEADING_VERBS = set("set change configure increase decrease raise lower reduce limit keep use make allow specify enter".split())
+# Minor words skipped when matching an expansion's initials to its acronym
+_MINOR_WORDS = {"of", "and", "the", "for", "to", "in", "on", "a", "an", "&"}
+
+
+def _subject(sentence: str, start: int) -> Tuple[Tuple[str, ...], bool]:
+    """What a number measures, and whether it was stated as "<subject> is/to <number>".
+
+    For a linked statement the subject is the noun phrase before the link,
+    without leading filler ("Later we say the upload timeout is" -> upload
+    timeout); otherwise it is the last few content words of the number's clause.
+    """
+    clause = _CLAUSE_BREAK.split(sentence[:start])[-1]
+    words = [w.lower().strip("-'") for w in _WORD.findall(clause)]
+    # The link must sit just before the number ("is", "is limited to"), not anywhere in the clause
+    window = max(0, len(words) - LINK_WINDOW_WORDS)
+    link = next((i for i in range(window, len(words)) if words[i] in _LINKS), 0)
+    phrase = words[:link] if link else words
+    if link:
+        # The phrase starts at its last determiner that does not follow a preposition ("the size of an upload")
+        starts = [i for i, w in enumerate(phrase) if w in _DETERMINERS and (i == 0 or phrase[i - 1] not in _PREPOSITIONS)]
+        if starts:
+            phrase = phrase[starts[-1] + 1:]
+        while phrase and phrase[0] in _LEADING_VERBS:
+            phrase = phrase[1:]
+    content = [w for w in phrase if w and w not in _STOPWORDS and w not in UNITS]
+    return tuple(content[-SUBJECT_WORDS:]), bool(link)
+
+
+def _initials_match(words: List[str], acronym: str) -> bool:
+    initials = "".join(w[0] for w in words if w.lower() not in _MINOR_WORDS)
+    return initials.lower() == re.sub(r"[^A-Za-z0-9]", "", acronym).lower()
+
+
+def _expansion_before(text: str, acronym: str) -> Optional[str]:
+    """Finds the words right before "(ACR)" whose initials spell the acronym, if any."""
+    words = re.findall(r"[\w&][\w&'\-]*", text)
+    letters = len(re.sub(r"[^A-Za-z0-9]", "", acronym))
+    for count in range(letters, min(len(words), letters * 2 + 2) + 1):
+        candidate = words[-count:]
+        if _initials_match(candidate, acronym) and candidate[0].lower() not in _MINOR_WORDS:
+            return " ".join(candidate)
+    return None
+
+
+def _normalize(text: str) -> str:
+    return " ".join(re.sub(r"[-_/]", " ", text.lower()).split()).strip(" .\"'“”")
+
+
+def build_index(text: str, pages: Optional[List[Dict]] = None, paragraphs: Optional[List[Dict]] = None) -> Dict:
+    """Indexes quantities, defined terms, acronym expansions and hyphenated spellings.
+
+    Every occurrence keeps its sentence and position, so conflicts can be shown
+    as short excerpts instead of the whole document.
+    """
+    sentences = split_units(text, pages, paragraphs)["sentence"]
+    index = {
+        "quantities": defaultdict(list),   # (subject, dimension) -> occurrences
+        "definitions": defaultdict(list),  # term -> occurrences
+        "acronyms": defaultdict(list),     # acronym -> occurrences
+        "spellings": defaultdict(list),    # spelling without spaces/hyphens -> occurrences
+    }
+    words = Counter()
+    for sentence in sentences:
+        body = sentence["text"]
+        words.update(w.lower() for w in _WORD.findall(body))
+
+        for match in _QUANTITY.finditer(body):
+            unit = (match.group("unit") or "").lower()
+            currency = match.group("currency")
+            subject, linked = _subject(body, match.start())
+            if currency:
+                dimension, factor = f"currency:{CURRENCIES[currency]}", 1
+            elif unit in UNITS:
+                dimension, factor = UNITS[unit]
+            elif linked and match.group("number").isdigit():
+                # A whole number stated as a subject's value ("the retry limit is 3") is a count;
+                # other bare numbers (steps, versions) are too ambiguous to compare
+                dimension, factor = "count", 1
+            else:
+                continue
+            if not subject:
+                continue
+            value = float(match.group("number").replace(",", "")) * factor
+            index["quantities"][(subject, dimension)].append(
+                {**sentence, "value": value, "mention": match.group(0).strip()}
+            )
+
+        definition = _DEFINITION.match(body)
+        if definition:
+            term = re.sub(r"^the ", "", _normalize(definition.group("term")))
+            meaning = _normalize(definition.group("definition"))
+            # "This means that ..." explains the previous sentence rather than defining a term
+            if term and len(term.split()) <= 5 and term.split()[0] not in _STOPWORDS and not meaning.startswith("that "):
+                index["definitions"][term].append({**sentence, "value": meaning, "mention": definition.group("term")})
+
+        for match in _ACRONYM_AFTER.finditer(body):
+            acronym = match.group("acronym")
+            expansion = _expansion_before(body[:match.start()], acronym)
+            if expansion:
+                index["acronyms"][acronym].append({**sentence, "value": _normalize(expansion), "mention": expansion})
+        for match in _ACRONYM_BEFORE.finditer(body):
+            acronym, expansion = match.group("acronym"), match.group("expansion").strip()
+            if _initials_match(re.findall(r"[\w&][\w&'\-]*", expansion), acronym):
+                index["acronyms"][acronym].append({**sentence, "value": _normalize(expansion), "mention": expansion})
+
+        for hyphenated in _HYPHENATED.findall(body.lower()):
+            index["spellings"][hyphenated.replace("-", "")].append({**sentence, "value": hyphenated, "mention": hyphenated})
+
+    # A hyphenated word conflicts with the same word written closed ("e-mail"/"email", "set-up"/"setup")
+    for joined, occurrences in index["spellings"].items():
+        if not words[joined]:
+            continue
+        pattern = re.compile(r"\b" + re.escape(joined) + r"\b", re.IGNORECASE)
+        closed = [s for s in sentences if pattern.search(s["text"])]
+        occurrences.extend({**s, "value": joined, "mention": joined} for s in closed)
+    return index
+
+
+def _conflict(kind: str, subject: str, occurrences: List[Dict]) -> Optional[Dict]:
+    values = []
+    for occurrence in occurrences:
+        if occurrence["value"] not in values:
+            values.append(occurrence["value"])
+    if len(values) < 2:
+        return None
+    # Show the first excerpt for every distinct value, then further ones up to the limit
+    shown = [next(o for o in occurrences if o["value"] == value) for value in values]
+    first_ids = {id(o) for o in shown}
+    shown += [o for o in occurrences if id(o) not in first_ids]
+    return {
+        "kind": kind,
+        "subject": subject,
+        "values": len(values),
+        "occurrences": len(occurrences),
+        "excerpts": shown[:MAX_EXCERPTS_PER_CONFLICT],
+    }
+
+
+def find_conflicts(index: Dict) -> List[Dict]:
+    """Candidate inconsistencies: the same quantity, term, acronym or word with more than one value."""
+    conflicts = []
+    for (subject, dimension), occurrences in index["quantities"].items():
+        conflict = _conflict("quantity", " ".join(subject), occurrences)
+        if conflict:
+            conflict["dimension"] = dimension
+            conflicts.append(conflict)
+    for kind, key in (("definition", "definitions"), ("acronym", "acronyms"), ("spelling", "spellings")):
+        for subject, occurrences in index[key].items():
+            conflict = _conflict(kind, subject, occurrences)
+            if conflict:
+                conflicts.append(conflict)
+    # A handful of differing values is the most likely real conflict; a "quantity" with
+    # many values is usually a generic word such as "page" and sorts last
+    kinds = ("definition", "acronym", "quantity", "spelling")
+    conflicts.sort(key=lambda c: (c["values"] > 3, kinds.index(c["kind"]), c["excerpts"][0]["paragraph"]))
+    return conflicts[:MAX_CONFLICTS]
+
+
+def detect_conflicts(text: str, pages: Optional[List[Dict]] = None, paragraphs: Optional[List[Dict]] = None) -> List[Dict]:
+    return find_conflicts(build_index(text, pages, paragraphs))
+
+
+def _mention(conflict: Dict, excerpt: Dict) -> str:
+    if conflict["kind"] == "quantity":
+        return excerpt["mention"]
+    return f"\"{preview(excerpt['mention'] if conflict['kind'] != 'definition' else excerpt['value'])}\""
+
+
+def format_conflicts(conflicts: List[Dict]) -> str:
+    """Renders conflicts as the report's Markdown-style list of excerpts."""
+    if not conflicts:
+        return "No conflicting numbers, definitions, acronyms or spellings were found."
+    headings = {
+        "quantity": "Quantity \"{subject}\" has {values} different values",
+        "definition": "Term \"{subject}\" is defined {values} different ways",
+        "acronym": "Acronym {subject} has {values} different expansions",
+        "spelling": "\"{subject}\" is spelled {values} different ways",
+    }
+    lines = [f"Found {len(conflicts)} candidate inconsistenc{'y' if len(conflicts) == 1 else 'ies'}."]
+    for conflict in conflicts:
+        lines.append("")
+        lines.append("### " + headings[conflict["kind"]].format(**conflict))
+        for excerpt in conflict["excerpts"]:
+            lines.append(f"- {format_position(excerpt)}: {_mention(conflict, excerpt)} in \"{preview(excerpt['text'])}\"")
+        if conflict["occurrences"] > len(conflict["excerpts"]):
+            lines.append(f"- ...and {conflict['occurrences'] - len(conflict['excerpts'])} more mention(s)")
+    return "\n".join(lines)
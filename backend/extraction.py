@@ -0,0 +1,329 @@
+import asyncio
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import AsyncIterator, Dict, List, Optional
+
+import docx
+import pdfplumber
+import pytesseract
+from cachetools import LRUCache
+from PIL import Image
+
+PDF_MAX_PAGES = int(os.getenv("PDF_MAX_PAGES", "1000"))
+PDF_PAGE_TIMEOUT_SECONDS = float(os.getenv("PDF_PAGE_TIMEOUT_SECONDS", "10"))
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "8"))
+EXTRACTION_WORKERS = int(os.getenv("EXTRACTION_WORKERS", str(os.cpu_count() or 2)))
+
+MAX_SCREENSHOTS = int(os.getenv("MAX_SCREENSHOTS", "5"))
+# Longest image side passed to Tesseract; larger screenshots are downscaled (0 disables)
+OCR_MAX_DIMENSION = int(os.getenv("OCR_MAX_DIMENSION", "2000"))
+OCR_GRAYSCALE = os.getenv("OCR_GRAYSCALE", "true").lower() == "true"
+# Pixel threshold (1-255) for black/white binarization after grayscale (0 disables)
+OCR_BINARIZE_THRESHOLD = int(os.getenv("OCR_BINARIZE_THRESHOLD", "0"))
+OCR_CACHE_SIZE = int(os.getenv("OCR_CACHE_SIZE", "512"))
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+# Stands in for the OCR text of a screenshot that could not be read
+UNREADABLE_SCREENSHOT = "[This screenshot could not be read.]"
+# Bump whenever extraction output changes so stored text artifacts are rebuilt
+EXTRACTOR_VERSION = "1"
+
+_process_pool: Optional[ProcessPoolExecutor] = None
+# Free workers in the pool; work is only submitted once one is free, so its timeout starts when it runs
+_pool_slots: Optional[asyncio.Semaphore] = None
+# Bumped whenever the pool is replaced, to tell calls broken by a reset from a crashed worker
+_pool_generation = 0
+_ocr_cache = LRUCache(maxsize=OCR_CACHE_SIZE)
+ocr_cache_stats = {"hits": 0, "misses": 0}
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(max_workers=EXTRACTION_WORKERS)
+    return _process_pool
+
+
+def shutdown_process_pool():
+    global _process_pool, _pool_slots
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
+    _pool_slots = None
+
+
+def reset_process_pool():
+    """Kills the pool's worker processes, e.g. one stuck on a malformed PDF; a fresh pool starts on next use."""
+    global _process_pool, _pool_slots, _pool_generation
+    pool = _process_pool
+    _process_pool, _pool_slots = None, None
+    _pool_generation += 1
+    if pool is not None:
+        # ProcessPoolExecutor has no public way to stop a running call
+        for process in list(pool._processes.values()):
+            process.terminate()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def run_in_pool(func, *args) -> asyncio.Future:
+    """Waits for a free worker, submits `func` to it and returns the call's future.
+
+    The worker counts as busy until the call finishes, even if the caller
+    stops waiting for it.
+    """
+    global _pool_slots
+    if _pool_slots is None:
+        _pool_slots = asyncio.Semaphore(EXTRACTION_WORKERS)
+    slots = _pool_slots
+    await slots.acquire()
+    try:
+        future = asyncio.get_running_loop().run_in_executor(get_process_pool(), func, *args)
+    except Exception:
+        slots.release()
+        raise
+
+    def finished(future):
+        slots.release()
+        # Mark the outcome as seen; calls abandoned after a timeout are never awaited
+        if not future.cancelled():
+            future.exception()
+
+    future.add_done_callback(finished)
+    return future
+
+
+async def call_in_pool(func, *args, timeout: Optional[float] = None):
+    """Runs `func` on a pool worker and returns its result.
+
+    `timeout` counts from when the call starts on a worker. A call still
+    running after it raises asyncio.TimeoutError and the pool is reset to
+    kill the stuck worker; other calls interrupted by that (or by a crashed
+    worker) are resubmitted once to the new pool.
+    """
+    for attempt in range(2):
+        generation = _pool_generation
+        future = await run_in_pool(func, *args)
+        try:
+            # Shielded so that timing out does not cancel the call before its worker is killed
+            return await asyncio.wait_for(asyncio.shield(future), timeout=timeout)
+        except asyncio.TimeoutError:
+            reset_process_pool()
+            raise
+        except BrokenProcessPool:
+            if generation == _pool_generation:
+                # A worker died on its own; the broken pool cannot run anything else
+                reset_process_pool()
+            if attempt:
+                raise
+
+
+def count_pdf_pages(pdf_path: str) -> int:
+    with pdfplumber.open(pdf_path) as pdf:
+        return len(pdf.pages)
+
+
+def _extract_pdf_page_range(pdf_path: str, start: int, end: int) -> List[Dict]:
+    """Extracts pages [start, end) (0-based). Runs inside a worker process."""
+    pages = []
+    with pdfplumber.open(pdf_path, pages=list(range(start + 1, end + 1))) as pdf:
+        for page in pdf.pages:
+            pages.append({"page": page.page_number, "text": page.extract_text() or ""})
+    return pages
+
+
+async def _extract_range_with_timeout(pdf_path: str, start: int, end: int, page_timeout: float) -> List[Dict]:
+    try:
+        return await call_in_pool(_extract_pdf_page_range, pdf_path, start, end, timeout=page_timeout * (end - start))
+    except Exception as e:
+        reason = "timeout" if isinstance(e, asyncio.TimeoutError) else str(e)
+        print(f"PDF extraction failed for pages {start + 1}-{end} of {pdf_path}: {reason}")
+        return [{"page": n + 1, "text": "", "error": reason} for n in range(start, end)]
+
+
+async def iter_pdf_pages(
+    pdf_path: str,
+    max_pages: Optional[int] = None,
+    page_timeout: Optional[float] = None,
+    pages_per_task: Optional[int] = None,
+    page_count: Optional[int] = None,
+) -> AsyncIterator[Dict]:
+    """Extracts PDF pages in parallel page ranges and yields each page as its range finishes.
+
+    Pages are yielded in completion order, not document order; every item
+    carries its 1-based `page` number.
+    """
+    max_pages = max_pages or PDF_MAX_PAGES
+    page_timeout = page_timeout or PDF_PAGE_TIMEOUT_SECONDS
+    pages_per_task = pages_per_task or PDF_PAGES_PER_TASK
+
+    if page_count is None:
+        page_count = await asyncio.to_thread(count_pdf_pages, pdf_path)
+    limit = min(page_count, max_pages)
+    tasks = [
+        _extract_range_with_timeout(pdf_path, start, min(start + pages_per_task, limit), page_timeout)
+        for start in range(0, limit, pages_per_task)
+    ]
+    for finished in asyncio.as_completed(tasks):
+        for page in await finished:
+            yield page
+
+
+async def extract_pdf_pages(pdf_path: str, on_page=None, **options) -> Dict:
+    """Returns {"pages": [...], "page_count": n, "truncated": bool, "failed_pages": [...]} with pages in document order.
+
+    `failed_pages` lists the numbers of pages whose extraction failed or timed out.
+    """
+    total = await asyncio.to_thread(count_pdf_pages, pdf_path)
+    pages = []
+    async for page in iter_pdf_pages(pdf_path, page_count=total, **options):
+        pages.append(page)
+        if on_page:
+            on_page(page, total)
+    pages.sort(key=lambda p: p["page"])
+    return {
+        "pages": pages,
+        "page_count": total,
+        "truncated": len(pages) < total,
+        "failed_pages": [page["page"] for page in pages if "error" in page],
+    }
+
+
+def join_pages(pages: List[Dict]) -> str:
+    return "\n".join(page["text"] for page in pages)
+
+
+def extract_docx_paragraphs(docx_path) -> List[Dict]:
+    doc = docx.Document(docx_path)
+    return [{"text": p.text, "style": p.style.name if p.style is not None else None} for p in doc.paragraphs]
+
+
+def _document_version(kind: str) -> str:
+    # The page limit changes what a PDF extraction contains, so it is part of the version
+    return f"v{EXTRACTOR_VERSION}-p{PDF_MAX_PAGES}" if kind == "pdf" else f"v{EXTRACTOR_VERSION}"
+
+
+def _ocr_version(settings) -> str:
+    return f"v{EXTRACTOR_VERSION}-" + "-".join(str(value) for value in settings)
+
+
+async def extract_document(doc_path: str, sha256: Optional[str] = None, artifacts=None, on_page=None) -> Dict:
+    """Extracts a PDF or DOCX, reusing a stored text artifact for the same content when available.
+
+    Returns {"kind", "text", "pages", "paragraphs", "page_count", "truncated",
+    "sha256", "cached"}; `pages` is set for PDFs and `paragraphs` ({"text", "style"})
+    for DOCX files.
+    """
+    kind = doc_path.split('.')[-1].lower()
+    if artifacts is not None and not sha256:
+        sha256 = await asyncio.to_thread(hash_file, doc_path)
+    if artifacts is not None:
+        artifact = await asyncio.to_thread(artifacts.load, sha256, kind, _document_version(kind))
+        if artifact is not None:
+            return {**artifact, "sha256": sha256, "cached": True}
+
+    artifact = {"kind": kind, "text": "", "pages": [], "paragraphs": [], "page_count": 0, "truncated": False, "failed_pages": []}
+    if kind == "pdf":
+        extracted = await extract_pdf_pages(doc_path, on_page=on_page)
+        artifact.update(extracted, text=join_pages(extracted["pages"]))
+    elif kind == "docx":
+        paragraphs = await asyncio.to_thread(extract_docx_paragraphs, doc_path)
+        artifact.update(paragraphs=paragraphs, text="\n".join(p["text"] for p in paragraphs))
+
+    # Pages that failed or timed out are retried on the next run instead of being persisted
+    if artifacts is not None and kind in ("pdf", "docx") and not artifact["failed_pages"]:
+        await asyncio.to_thread(artifacts.save, sha256, kind, _document_version(kind), artifact)
+    return {**artifact, "sha256": sha256, "cached": False}
+
+
+def hash_file(path: str, chunk_size: int = 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def preprocess_image(image, max_dimension=OCR_MAX_DIMENSION, grayscale=OCR_GRAYSCALE, threshold=OCR_BINARIZE_THRESHOLD):
+    """Downscales and optionally grayscales/binarizes an image to speed up Tesseract."""
+    if max_dimension and max(image.size) > max_dimension:
+        image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+    if grayscale or threshold:
+        image = image.convert("L")
+    if threshold:
+        image = image.point(lambda px: 255 if px > threshold else 0, mode="1")
+    return image
+
+
+class OCRError(Exception):
+    pass
+
+
+def extract_text_from_image(image_path, max_dimension=OCR_MAX_DIMENSION, grayscale=OCR_GRAYSCALE, threshold=OCR_BINARIZE_THRESHOLD):
+    try:
+        with Image.open(image_path) as image:
+            # Let JPEG decode at reduced size directly when we are going to downscale anyway
+            if max_dimension:
+                image.draft("RGB", (max_dimension, max_dimension))
+            image = preprocess_image(image, max_dimension, grayscale, threshold)
+            return pytesseract.image_to_string(image)
+    except Exception as e:
+        # Re-raised as a plain exception: some (e.g. pytesseract's) cannot be
+        # unpickled in the parent, which breaks the whole process pool
+        raise OCRError(f"{type(e).__name__}: {e}") from None
+
+
+def ocr_cache_info() -> Dict:
+    return {"size": len(_ocr_cache), "max_size": _ocr_cache.maxsize, **ocr_cache_stats}
+
+
+async def extract_screenshot_texts(image_paths: List[str], hashes: Optional[List[str]] = None, artifacts=None) -> List[str]:
+    """OCRs screenshots in parallel on the process pool, reusing cached text for identical images.
+
+    `hashes` are the images' SHA-256 digests when already known (e.g. computed
+    during upload); otherwise the files are hashed here. With an `artifacts`
+    store, OCR text also persists across restarts. A screenshot that cannot
+    be read gets UNREADABLE_SCREENSHOT instead of failing the whole call.
+    """
+    settings = (OCR_MAX_DIMENSION, OCR_GRAYSCALE, OCR_BINARIZE_THRESHOLD)
+    if not hashes:
+        hashes = await asyncio.gather(*(asyncio.to_thread(hash_file, path) for path in image_paths))
+
+    texts: Dict[int, str] = {}
+    pending = {}
+    for index, (path, digest) in enumerate(zip(image_paths, hashes)):
+        cached = _ocr_cache.get((digest, settings))
+        if cached is not None:
+            ocr_cache_stats["hits"] += 1
+            texts[index] = cached
+            continue
+        if digest in pending:
+            # Same image uploaded twice in one request: OCR it once
+            pending[digest][1].append(index)
+            continue
+        artifact = None
+        if artifacts is not None:
+            artifact = await asyncio.to_thread(artifacts.load, digest, "ocr", _ocr_version(settings))
+        if artifact is not None:
+            ocr_cache_stats["hits"] += 1
+            _ocr_cache[(digest, settings)] = artifact["text"]
+            texts[index] = artifact["text"]
+        else:
+            ocr_cache_stats["misses"] += 1
+            future = asyncio.ensure_future(call_in_pool(extract_text_from_image, path, *settings))
+            pending[digest] = (future, [index])
+
+    for digest, (future, indexes) in pending.items():
+        try:
+            text = await future
+        except (OCRError, BrokenProcessPool) as e:
+            # Not cached, so the image is retried next time (e.g. once Tesseract is installed)
+            print(f"OCR failed for {image_paths[indexes[0]]}: {e}")
+            text = UNREADABLE_SCREENSHOT
+        else:
+            _ocr_cache[(digest, settings)] = text
+            if artifacts is not None:
+                await asyncio.to_thread(artifacts.save, digest, "ocr", _ocr_version(settings), {"text": text})
+        for index in indexes:
+            texts[index] = text
+    return [texts[index] for index in range(len(image_paths))]
@@ -0,0 +1,92 @@
+import json
+import os
+import re
+from typing import Dict, List
+
+from chunking import estimate_tokens
+from repetition import format_position, preview
+
+# "paragraph" checks paragraphs in batches and returns corrections as diffs;
+# "document" asks the model to rewrite the whole text as before
+GRAMMAR_MODE = os.getenv("GRAMMAR_MODE", "paragraph").lower()
+GRAMMAR_MODES = ("paragraph", "document")
+# Paragraphs per prompt are packed up to this many estimated tokens
+GRAMMAR_BATCH_TOKENS = int(os.getenv("GRAMMAR_BATCH_TOKENS", "1500"))
+
+_LETTER = re.compile(r"[A-Za-z]")
+
+
+def needs_check(text: str) -> bool:
+    # Page numbers, figures and separators have nothing to correct
+    return bool(_LETTER.search(text))
+
+
+def batch_paragraphs(paragraphs: List[Dict], token_budget: int = GRAMMAR_BATCH_TOKENS) -> List[List[Dict]]:
+    batches, current, current_tokens = [], [], 0
+    for paragraph in paragraphs:
+        tokens = estimate_tokens(paragraph["text"])
+        if current and current_tokens + tokens > token_budget:
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(paragraph)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def format_batch(paragraphs: List[Dict]) -> str:
+    """Numbers a batch's paragraphs from 1, independent of their position in the document."""
+    return "\n\n".join(f"[{number}] {paragraph['text']}" for number, paragraph in enumerate(paragraphs, start=1))
+
+
+def parse_corrections(text: str, paragraphs: List[Dict]) -> List[List[Dict]]:
+    """Returns each batch paragraph's corrections ({"original", "correction", "reason"}).
+
+    Corrections whose original span does not occur verbatim in the paragraph
+    are dropped, so the diffs always point at real text. Raises ValueError
+    when the response is not the expected JSON.
+    """
+    cleaned = text.strip()
+    if cleaned.startswith("```"):
+        cleaned = cleaned.strip("`")
+        cleaned = cleaned[cleaned.find("{"):] if "{" in cleaned else cleaned
+    data = json.loads(cleaned)
+    items = data.get("corrections") if isinstance(data, dict) else data
+    if not isinstance(items, list):
+        raise ValueError("response has no corrections list")
+
+    corrections = [[] for _ in paragraphs]
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        number, original, correction = item.get("paragraph"), item.get("original"), item.get("correction")
+        if not isinstance(number, int) or not 1 <= number <= len(paragraphs):
+            continue
+        if not isinstance(original, str) or not isinstance(correction, str) or not original or original == correction:
+            continue
+        if original not in paragraphs[number - 1]["text"]:
+            continue
+        corrections[number - 1].append({
+            "original": original,
+            "correction": correction,
+            "reason": item.get("reason") if isinstance(item.get("reason"), str) else "",
+        })
+    return corrections
+
+
+def format_corrections(corrections: List[Dict], checked: int) -> str:
+    """Renders the diffs as the report's Markdown-style list, grouped by paragraph."""
+    if not corrections:
+        return f"No grammar, spelling or punctuation errors were found in {checked} paragraph(s)."
+    paragraphs = {}
+    for correction in corrections:
+        paragraphs.setdefault(correction["paragraph"], []).append(correction)
+    lines = [f"Found {len(corrections)} correction(s) in {len(paragraphs)} of {checked} paragraph(s)."]
+    for number, items in paragraphs.items():
+        lines.append("")
+        lines.append(f"### {format_position(items[0])}")
+        for item in items:
+            reason = f" ({item['reason']})" if item["reason"] else ""
+            lines.append(f"- \"{preview(item['original'])}\" -> \"{preview(item['correction'])}\"{reason}")
+    return "\n".join(lines)
@@ -0,0 +1,311 @@
+import asyncio
+import json
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+# Older entries beyond this are dropped from a user's history
+HISTORY_MAX_ENTRIES = int(os.getenv("HISTORY_MAX_ENTRIES", "200"))
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "20"))
+# Pending history updates are written at most this long after they are made...
+HISTORY_FLUSH_INTERVAL_SECONDS = float(os.getenv("HISTORY_FLUSH_INTERVAL_SECONDS", "1.0"))
+# ...or as soon as this many updates are waiting
+HISTORY_FLUSH_MAX_PENDING = int(os.getenv("HISTORY_FLUSH_MAX_PENDING", "100"))
+SUMMARY_PREVIEW_CHARS = 200
+
+LISTING_FIELDS = ("id", "original_filename", "timestamp", "file_type", "analysis_mode")
+
+
+def empty_stats() -> Dict:
+    return {'documents_analyzed': 0, 'reports_generated': 0, 'last_analysis': None}
+
+
+def make_listing(entry: Dict) -> Dict:
+    """The summary-only view of a history entry used in listings."""
+    listing = {field: entry.get(field) for field in LISTING_FIELDS}
+    listing['summary'] = (entry.get('summary') or "")[:SUMMARY_PREVIEW_CHARS]
+    listing['has_errors'] = bool(entry.get('errors'))
+    return listing
+
+
+def _write_json(path: str, data):
+    with open(path + ".tmp", "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def _read_json(path: str, default):
+    if not os.path.exists(path):
+        return default
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+class HistoryStore:
+    """Analysis history sharded into one directory per user.
+
+    `<root>/<user_id>/stats.json` holds the counters, `index.json` the
+    newest-first summary listings, and `entries/<report_id>.json` each full
+    entry, so requests only touch the files of the user making them and
+    details are a single file read. The legacy `user_data.json` is imported
+    once on first start.
+
+    Updates are applied to an in-memory copy of the user's shard and written
+    by a single writer task (see `start`), which coalesces everything pending
+    for a user into one atomic write per file. Reads see pending updates
+    immediately. Without a running writer every update is written through.
+    """
+
+    def __init__(self, root_dir: str, legacy_json_path: Optional[str] = None, max_entries: int = HISTORY_MAX_ENTRIES):
+        self.root_dir = root_dir
+        self.max_entries = max_entries
+        # user_id -> {"stats", "index", "entries": {report_id: entry, or None once deleted}}
+        self._pending: Dict[str, Dict] = {}
+        # Shards currently being written by the writer; still visible to reads
+        self._flushing: Dict[str, Dict] = {}
+        self._pending_ops = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._writer: Optional[asyncio.Task] = None
+        self._stopping = False
+        self.write_stats = {
+            "batches": 0,
+            "updates": 0,
+            "users_written": 0,
+            "files_written": 0,
+            "failed_batches": 0,
+            "last_batch_updates": 0,
+            "last_batch_seconds": 0.0,
+            "max_batch_updates": 0,
+        }
+        os.makedirs(root_dir, exist_ok=True)
+        if legacy_json_path:
+            self._migrate_legacy_json(legacy_json_path)
+
+    def _user_dir(self, user_id: str) -> str:
+        return os.path.join(self.root_dir, user_id)
+
+    def _stats_path(self, user_id: str) -> str:
+        return os.path.join(self._user_dir(user_id), "stats.json")
+
+    def _index_path(self, user_id: str) -> str:
+        return os.path.join(self._user_dir(user_id), "index.json")
+
+    def _entry_path(self, user_id: str, report_id: str) -> str:
+        return os.path.join(self._user_dir(user_id), "entries", f"{report_id}.json")
+
+    def _migrate_legacy_json(self, legacy_json_path: str):
+        marker = os.path.join(self.root_dir, ".migrated")
+        if os.path.exists(marker) or not os.path.exists(legacy_json_path):
+            return
+        with open(legacy_json_path, "r") as f:
+            user_data = json.load(f)
+        for user_id, data in user_data.items():
+            stats = {key: data.get(key, default) for key, default in empty_stats().items()}
+            history = data.get('analysis_history', [])[:self.max_entries]
+            self._write_shard(user_id, {
+                "stats": stats,
+                "index": [make_listing(entry) for entry in history],
+                "entries": {entry['id']: entry for entry in history},
+            })
+        open(marker, "w").close()
+        print(f"Migrated analysis history for {len(user_data)} user(s) from {legacy_json_path}")
+
+    # Reads: pending updates first, then a batch being written, then disk
+
+    def _cached_shard(self, user_id: str) -> Optional[Dict]:
+        return self._pending.get(user_id) or self._flushing.get(user_id)
+
+    def get_stats(self, user_id: str) -> Dict:
+        shard = self._cached_shard(user_id)
+        if shard is not None:
+            return dict(shard["stats"])
+        return _read_json(self._stats_path(user_id), empty_stats())
+
+    def _index(self, user_id: str) -> List[Dict]:
+        shard = self._cached_shard(user_id)
+        if shard is not None:
+            return shard["index"]
+        return _read_json(self._index_path(user_id), [])
+
+    def list(self, user_id: str, cursor: Optional[str] = None, limit: int = HISTORY_PAGE_SIZE) -> Tuple[List[Dict], Optional[str]]:
+        """Returns one page of listings, newest first, and the cursor for the next page (None at the end).
+
+        The cursor is the ID of the last entry on the previous page.
+        """
+        index = self._index(user_id)
+        start = 0
+        if cursor:
+            positions = [i for i, listing in enumerate(index) if listing['id'] == cursor]
+            if not positions:
+                raise KeyError(cursor)
+            start = positions[0] + 1
+        page = index[start:start + limit]
+        next_cursor = page[-1]['id'] if page and start + limit < len(index) else None
+        return page, next_cursor
+
+    def get(self, user_id: str, report_id: str) -> Optional[Dict]:
+        # Report IDs are "<user_id>_<hex>"; anything with path separators cannot be one
+        if os.path.basename(report_id) != report_id:
+            return None
+        for shards in (self._pending, self._flushing):
+            entries = shards.get(user_id, {}).get("entries", {})
+            if report_id in entries:
+                return entries[report_id]
+        return _read_json(self._entry_path(user_id, report_id), None)
+
+    # Updates
+
+    def _shard_for_update(self, user_id: str) -> Dict:
+        shard = self._pending.get(user_id)
+        if shard is None:
+            base = self._flushing.get(user_id)
+            if base is not None:
+                stats, index = dict(base["stats"]), list(base["index"])
+            else:
+                stats = _read_json(self._stats_path(user_id), empty_stats())
+                index = _read_json(self._index_path(user_id), [])
+            shard = {"stats": stats, "index": index, "entries": {}}
+            self._pending[user_id] = shard
+        return shard
+
+    def _updated(self):
+        self._pending_ops += 1
+        if self._writer is None:
+            self.flush()
+        elif self._pending_ops >= HISTORY_FLUSH_MAX_PENDING:
+            self._wakeup.set()
+
+    def init_user(self, user_id: str):
+        self._shard_for_update(user_id)
+        self._updated()
+
+    def add(self, user_id: str, entry: Dict):
+        shard = self._shard_for_update(user_id)
+        shard["entries"][entry['id']] = entry
+        shard["index"].insert(0, make_listing(entry))
+        for dropped in shard["index"][self.max_entries:]:
+            shard["entries"][dropped['id']] = None
+        del shard["index"][self.max_entries:]
+
+        stats = shard["stats"]
+        stats['documents_analyzed'] += 1
+        stats['reports_generated'] += 1
+        stats['last_analysis'] = entry['timestamp']
+        self._updated()
+
+    def delete(self, user_id: str, report_id: str) -> bool:
+        if self.get(user_id, report_id) is None:
+            return False
+        shard = self._shard_for_update(user_id)
+        shard["index"] = [listing for listing in shard["index"] if listing['id'] != report_id]
+        shard["entries"][report_id] = None
+        self._updated()
+        return True
+
+    # Writing
+
+    def _write_shard(self, user_id: str, shard: Dict) -> int:
+        """Writes one user's shard: entries first, so the index never lists a missing entry."""
+        os.makedirs(os.path.join(self._user_dir(user_id), "entries"), exist_ok=True)
+        files = 0
+        for report_id, entry in shard["entries"].items():
+            path = self._entry_path(user_id, report_id)
+            if entry is not None:
+                _write_json(path, entry)
+                files += 1
+            elif os.path.exists(path):
+                os.remove(path)
+                files += 1
+        _write_json(self._index_path(user_id), shard["index"])
+        _write_json(self._stats_path(user_id), shard["stats"])
+        return files + 2
+
+    def _take_batch(self) -> Tuple[Dict[str, Dict], int]:
+        batch, updates = self._pending, self._pending_ops
+        self._pending, self._pending_ops = {}, 0
+        self._flushing = batch
+        return batch, updates
+
+    def _write_batch(self, batch: Dict[str, Dict]) -> int:
+        return sum(self._write_shard(user_id, shard) for user_id, shard in batch.items())
+
+    def _finish_batch(self, batch: Dict[str, Dict], updates: int, files: int, started: float):
+        self._flushing = {}
+        stats = self.write_stats
+        stats["batches"] += 1
+        stats["updates"] += updates
+        stats["users_written"] += len(batch)
+        stats["files_written"] += files
+        stats["last_batch_updates"] = updates
+        stats["last_batch_seconds"] = round(time.monotonic() - started, 6)
+        stats["max_batch_updates"] = max(stats["max_batch_updates"], updates)
+
+    def _requeue_batch(self, batch: Dict[str, Dict], updates: int):
+        # Newer pending updates already carry the latest stats/index; only entry writes need merging
+        self._flushing = {}
+        for user_id, shard in batch.items():
+            pending = self._pending.get(user_id)
+            if pending is None:
+                self._pending[user_id] = shard
+            else:
+                pending["entries"] = {**shard["entries"], **pending["entries"]}
+        self._pending_ops += updates
+        self.write_stats["failed_batches"] += 1
+
+    def flush(self):
+        """Writes all pending updates synchronously."""
+        if not self._pending:
+            return
+        started = time.monotonic()
+        batch, updates = self._take_batch()
+        try:
+            files = self._write_batch(batch)
+        except Exception:
+            self._requeue_batch(batch, updates)
+            raise
+        self._finish_batch(batch, updates, files, started)
+
+    async def _flush_async(self):
+        if not self._pending:
+            return
+        started = time.monotonic()
+        batch, updates = self._take_batch()
+        try:
+            files = await asyncio.to_thread(self._write_batch, batch)
+        except Exception as e:
+            print(f"Failed to write analysis history ({updates} update(s)), will retry: {e}")
+            self._requeue_batch(batch, updates)
+            return
+        self._finish_batch(batch, updates, files, started)
+
+    async def _run_writer(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=HISTORY_FLUSH_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self._flush_async()
+
+    async def start(self):
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._writer = asyncio.create_task(self._run_writer())
+
+    async def stop(self):
+        """Stops the writer and writes everything still pending before returning."""
+        if self._writer is not None:
+            # Let an in-progress batch finish rather than cancelling it halfway through its files
+            self._stopping = True
+            self._wakeup.set()
+            await self._writer
+            self._writer = None
+        self.flush()
+
+    def writer_stats(self) -> Dict:
+        return {
+            **self.write_stats,
+            "pending_updates": self._pending_ops,
+            "pending_users": len(self._pending),
+            "flush_interval_seconds": HISTORY_FLUSH_INTERVAL_SECONDS,
+        }
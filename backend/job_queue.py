@@ -0,0 +1,195 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+# Repeated updates within one stage (e.g. "12/500 pages") are written at most this often;
+# a stage's first and final states are always written
+PROGRESS_WRITE_INTERVAL_SECONDS = float(os.getenv("JOB_PROGRESS_WRITE_INTERVAL_SECONDS", "0.5"))
+FINAL_STAGE_STATES = ("done", "cached", "deferred", "failed")
+
+
+class JobQueue:
+    """Persistent job queue processed by a bounded pool of asyncio workers.
+
+    Jobs are stored in SQLite so that queued work survives a restart. Jobs that
+    were running when the process stopped are put back in the queue on startup.
+    The handler receives the job record and a `progress(stage, state)` callback
+    and returns a JSON-serializable result.
+
+    Listeners can `subscribe` to a job's live events: every progress update,
+    anything the handler `publish`es, and a final "done" or "failed" event.
+    Events are not persisted; a listener only sees those published after it
+    subscribed.
+    """
+
+    def __init__(self, db_path: str, handler: Callable[[Dict, Callable], Awaitable[Dict]], workers: int = 2):
+        self.db_path = db_path
+        self.handler = handler
+        self.worker_count = workers
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self._lock = threading.Lock()
+        self._subscribers: Dict[str, List[asyncio.Queue]] = {}
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                status TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                progress TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                created_at TEXT NOT NULL,
+                updated_at TEXT NOT NULL
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, created_at)")
+        columns = [row["name"] for row in self._conn.execute("PRAGMA table_info(jobs)")]
+        if "batch_id" not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN batch_id TEXT")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_batch ON jobs(batch_id)")
+        self._conn.commit()
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        with self._lock:
+            # Anything left running by a previous process is retried from scratch
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, progress = '{}', updated_at = ? WHERE status = ?",
+                (JOB_QUEUED, datetime.now().isoformat(), JOB_RUNNING),
+            )
+            self._conn.commit()
+            pending = self._conn.execute(
+                "SELECT id FROM jobs WHERE status = ? ORDER BY created_at", (JOB_QUEUED,)
+            ).fetchall()
+        for row in pending:
+            self._queue.put_nowait(row["id"])
+        if pending:
+            print(f"Resuming {len(pending)} queued analysis job(s)")
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.worker_count)]
+
+    async def stop(self):
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def enqueue(self, user_id: str, payload: Dict, batch_id: Optional[str] = None) -> str:
+        job_id = uuid.uuid4().hex
+        now = datetime.now().isoformat()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (id, user_id, status, payload, progress, created_at, updated_at, batch_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, user_id, JOB_QUEUED, json.dumps(payload), "{}", now, now, batch_id),
+            )
+            self._conn.commit()
+        self._queue.put_nowait(job_id)
+        return job_id
+
+    def _decode(self, row) -> Dict:
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"])
+        job["progress"] = json.loads(job["progress"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._decode(row) if row is not None else None
+
+    def list_batch(self, batch_id: str) -> List[Dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM jobs WHERE batch_id = ? ORDER BY created_at, rowid", (batch_id,)
+            ).fetchall()
+        return [self._decode(row) for row in rows]
+
+    def subscribe(self, job_id: str) -> asyncio.Queue:
+        """Returns a queue receiving (event, data) tuples for the job until it finishes."""
+        queue = asyncio.Queue()
+        self._subscribers.setdefault(job_id, []).append(queue)
+        return queue
+
+    def unsubscribe(self, job_id: str, queue: asyncio.Queue):
+        queues = self._subscribers.get(job_id, [])
+        if queue in queues:
+            queues.remove(queue)
+        if not queues:
+            self._subscribers.pop(job_id, None)
+
+    def publish(self, job_id: str, event: str, data: Dict):
+        for queue in self._subscribers.get(job_id, ()):
+            queue.put_nowait((event, data))
+
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    def count_by_status(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) AS count FROM jobs GROUP BY status").fetchall()
+        return {row["status"]: row["count"] for row in rows}
+
+    def _update(self, job_id: str, **fields):
+        fields["updated_at"] = datetime.now().isoformat()
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock:
+            self._conn.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+            self._conn.commit()
+
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await self._run(job_id)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job_id: str):
+        job = self.get(job_id)
+        if job is None or job["status"] != JOB_QUEUED:
+            return
+        progress = {}
+        last_write = 0.0
+
+        def report_progress(stage: str, state: str):
+            nonlocal last_write
+            now = time.monotonic()
+            repeated = stage in progress and state not in FINAL_STAGE_STATES
+            progress[stage] = state
+            # Listeners get every update; the stored copy only needs to stay roughly current
+            if not repeated or now - last_write >= PROGRESS_WRITE_INTERVAL_SECONDS:
+                self._update(job_id, progress=json.dumps(progress))
+                last_write = now
+            self.publish(job_id, "progress", {"stage": stage, "state": state})
+
+        self._update(job_id, status=JOB_RUNNING)
+        try:
+            result = await self.handler(job, report_progress)
+            self._update(job_id, status=JOB_DONE, result=json.dumps(result))
+            self.publish(job_id, JOB_DONE, result)
+        except asyncio.CancelledError:
+            # Shutting down: leave the job as running so it is retried on restart
+            raise
+        except Exception as e:
+            print(f"Job {job_id} failed: {e}")
+            traceback.print_exc()
+            detail = getattr(e, "detail", None) or str(e)
+            self._update(job_id, status=JOB_FAILED, error=detail)
+            self.publish(job_id, JOB_FAILED, {"error": detail})
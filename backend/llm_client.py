@@ -0,0 +1,303 @@
+import asyncio
+import json
+import random
+import time
+from dataclasses import asdict, dataclass
+from typing import Callable, Dict, Optional, Tuple
+
+import httpx
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+DEFAULT_BASE_URLS = {
+    "gemini": "https://generativelanguage.googleapis.com/v1beta",
+    "openai": "https://api.together.xyz/v1",
+}
+
+
+@dataclass
+class LLMResult:
+    text: str = ""
+    error: Optional[str] = None
+    status_code: Optional[int] = None
+    attempts: int = 0
+    latency: float = 0.0
+    input_tokens: Optional[int] = None
+    output_tokens: Optional[int] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def to_dict(self) -> Dict:
+        return asdict(self)
+
+
+class LLMError(Exception):
+    """Raised by callers that want to abort a multi-call operation on the first failed result."""
+
+    def __init__(self, result: LLMResult):
+        super().__init__(result.error)
+        self.result = result
+
+
+class TokenBucket:
+    """Token-bucket rate limiter shared by all requests made through one client."""
+
+    def __init__(self, rate_per_second: float, capacity: float):
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class LLMClient:
+    """Async LLM provider client with pooled keep-alive connections.
+
+    Supports the Gemini REST API ("gemini") and OpenAI-compatible chat
+    completion endpoints ("openai"). Every request passes a concurrency bound
+    and, when `requests_per_minute` is set, a global token-bucket rate limit
+    that allows bursts of `rate_limit_burst` requests (by default a full
+    minute's quota, like providers' per-minute windows). 429/5xx responses,
+    timeouts and transport errors are retried with exponential backoff and
+    full jitter.
+    Failures are returned as an `LLMResult` with `error` set, never raised.
+    `on_result`, if given, is called with every finished call's result.
+    """
+
+    def __init__(
+        self,
+        provider: str,
+        api_key: Optional[str],
+        model: str,
+        base_url: Optional[str] = None,
+        timeout: float = 120.0,
+        max_retries: int = 4,
+        backoff_base: float = 1.0,
+        backoff_max: float = 30.0,
+        requests_per_minute: Optional[float] = None,
+        rate_limit_burst: Optional[float] = None,
+        max_concurrency: int = 8,
+        max_connections: int = 20,
+        on_result: Optional[Callable[[LLMResult], None]] = None,
+    ):
+        if provider not in DEFAULT_BASE_URLS:
+            raise ValueError(f"Unsupported LLM provider: {provider}")
+        self.provider = provider
+        self.api_key = api_key
+        self.model = model
+        self.base_url = (base_url or DEFAULT_BASE_URLS[provider]).rstrip("/")
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.on_result = on_result
+        self._rate_limiter = None
+        if requests_per_minute:
+            self._rate_limiter = TokenBucket(requests_per_minute / 60.0, capacity=max(1.0, rate_limit_burst or requests_per_minute))
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._client = httpx.AsyncClient(
+            timeout=httpx.Timeout(timeout),
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+
+    @property
+    def configured(self) -> bool:
+        return bool(self.api_key) and self.api_key != "your_gemini_api_key_here"
+
+    async def aclose(self):
+        await self._client.aclose()
+
+    def _build_request(self, prompt: str, system_prompt: Optional[str], json_mode: bool) -> Tuple[str, Dict, Dict]:
+        if self.provider == "gemini":
+            url = f"{self.base_url}/models/{self.model}:generateContent"
+            headers = {"x-goog-api-key": self.api_key}
+            body = {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}
+            if system_prompt:
+                body["systemInstruction"] = {"parts": [{"text": system_prompt}]}
+            if json_mode:
+                body["generationConfig"] = {"responseMimeType": "application/json"}
+            return url, headers, body
+
+        url = f"{self.base_url}/chat/completions"
+        headers = {"Authorization": f"Bearer {self.api_key}"}
+        messages = [{"role": "system", "content": system_prompt}] if system_prompt else []
+        messages.append({"role": "user", "content": prompt})
+        body = {"model": self.model, "messages": messages}
+        if json_mode:
+            body["response_format"] = {"type": "json_object"}
+        return url, headers, body
+
+    def _parse_response(self, data: Dict) -> LLMResult:
+        if self.provider == "gemini":
+            usage = data.get("usageMetadata", {})
+            candidates = data.get("candidates") or []
+            parts = candidates[0].get("content", {}).get("parts", []) if candidates else []
+            if not parts:
+                reason = data.get("promptFeedback", {}).get("blockReason") or (
+                    candidates[0].get("finishReason") if candidates else "no candidates returned"
+                )
+                return LLMResult(error=f"Empty response from model ({reason})")
+            return LLMResult(
+                text="".join(part.get("text", "") for part in parts),
+                input_tokens=usage.get("promptTokenCount"),
+                output_tokens=usage.get("candidatesTokenCount"),
+            )
+
+        usage = data.get("usage") or {}
+        choices = data.get("choices") or []
+        if not choices:
+            return LLMResult(error="Empty response from model (no choices returned)")
+        return LLMResult(
+            text=choices[0].get("message", {}).get("content") or "",
+            input_tokens=usage.get("prompt_tokens"),
+            output_tokens=usage.get("completion_tokens"),
+        )
+
+    def _build_stream_request(self, prompt: str, system_prompt: Optional[str]) -> Tuple[str, Dict, Dict]:
+        url, headers, body = self._build_request(prompt, system_prompt, json_mode=False)
+        if self.provider == "gemini":
+            return url.replace(":generateContent", ":streamGenerateContent") + "?alt=sse", headers, body
+        return url, headers, {**body, "stream": True}
+
+    def _parse_stream_event(self, data: Dict) -> Tuple[str, Dict]:
+        """Returns the text delta and token usage (if reported) of one streamed event."""
+        if self.provider == "gemini":
+            usage = data.get("usageMetadata") or {}
+            candidates = data.get("candidates") or []
+            parts = candidates[0].get("content", {}).get("parts", []) if candidates else []
+            text = "".join(part.get("text", "") for part in parts)
+            return text, {"input_tokens": usage.get("promptTokenCount"), "output_tokens": usage.get("candidatesTokenCount")}
+
+        usage = data.get("usage") or {}
+        choices = data.get("choices") or []
+        text = (choices[0].get("delta", {}).get("content") or "") if choices else ""
+        return text, {"input_tokens": usage.get("prompt_tokens"), "output_tokens": usage.get("completion_tokens")}
+
+    def _finished(self, result: LLMResult):
+        if self.on_result is not None:
+            self.on_result(result)
+
+    def _backoff_delay(self, attempt: int, retry_after: Optional[str]) -> float:
+        if retry_after:
+            try:
+                return min(self.backoff_max, float(retry_after))
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    async def generate(self, prompt: str, system_prompt: Optional[str] = None, json_mode: bool = False) -> LLMResult:
+        if not self.configured:
+            result = LLMResult(error=f"{self.provider} API key not configured.")
+            self._finished(result)
+            return result
+
+        url, headers, body = self._build_request(prompt, system_prompt, json_mode)
+        started = time.monotonic()
+        result = LLMResult()
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            if self._rate_limiter is not None:
+                await self._rate_limiter.acquire()
+            async with self._semaphore:
+                try:
+                    response = await self._client.post(url, headers=headers, json=body)
+                except (httpx.TimeoutException, httpx.TransportError) as e:
+                    result = LLMResult(error=f"{type(e).__name__}: {e}")
+                else:
+                    if response.status_code == 200:
+                        try:
+                            result = self._parse_response(response.json())
+                        except ValueError as e:
+                            result = LLMResult(error=f"Invalid response from model: {e}")
+                        result.status_code = 200
+                    else:
+                        result = LLMResult(
+                            error=f"HTTP {response.status_code}: {response.text[:500]}",
+                            status_code=response.status_code,
+                        )
+                        retry_after = response.headers.get("retry-after")
+            result.attempts = attempt + 1
+            retryable = result.status_code is None or result.status_code in RETRYABLE_STATUS_CODES
+            if result.ok or not retryable or attempt == self.max_retries:
+                break
+            await asyncio.sleep(self._backoff_delay(attempt, retry_after))
+        result.latency = time.monotonic() - started
+        self._finished(result)
+        return result
+
+    async def stream(self, prompt: str, system_prompt: Optional[str] = None, on_text: Optional[Callable[[str], None]] = None) -> LLMResult:
+        """Like `generate`, but streams the response and passes each text delta to `on_text` as it arrives.
+
+        Requests are retried like `generate` until the first text has been
+        received; a failure after that ends the stream and is returned with the
+        partial text.
+        """
+        if not self.configured:
+            result = LLMResult(error=f"{self.provider} API key not configured.")
+            self._finished(result)
+            return result
+
+        url, headers, body = self._build_stream_request(prompt, system_prompt)
+        started = time.monotonic()
+        result = LLMResult()
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            received = []
+            if self._rate_limiter is not None:
+                await self._rate_limiter.acquire()
+            async with self._semaphore:
+                try:
+                    async with self._client.stream("POST", url, headers=headers, json=body) as response:
+                        if response.status_code != 200:
+                            await response.aread()
+                            result = LLMResult(
+                                error=f"HTTP {response.status_code}: {response.text[:500]}",
+                                status_code=response.status_code,
+                            )
+                            retry_after = response.headers.get("retry-after")
+                        else:
+                            result = LLMResult(status_code=200)
+                            async for line in response.aiter_lines():
+                                if not line.startswith("data:"):
+                                    continue
+                                payload = line[len("data:"):].strip()
+                                if payload == "[DONE]":
+                                    break
+                                try:
+                                    text, usage = self._parse_stream_event(json.loads(payload))
+                                except ValueError as e:
+                                    result.error = f"Invalid response from model: {e}"
+                                    break
+                                for field, value in usage.items():
+                                    if value is not None:
+                                        setattr(result, field, value)
+                                if text:
+                                    received.append(text)
+                                    if on_text:
+                                        on_text(text)
+                            if result.ok and not received:
+                                result.error = "Empty response from model (stream ended without text)"
+                except (httpx.TimeoutException, httpx.TransportError) as e:
+                    result = LLMResult(error=f"{type(e).__name__}: {e}", status_code=result.status_code if received else None)
+            result.text = "".join(received)
+            result.attempts = attempt + 1
+            # Text already passed to on_text cannot be taken back, so only a stream that sent nothing is retried
+            retryable = not received and (result.status_code is None or result.status_code in RETRYABLE_STATUS_CODES)
+            if result.ok or not retryable or attempt == self.max_retries:
+                break
+            await asyncio.sleep(self._backoff_delay(attempt, retry_after))
+        result.latency = time.monotonic() - started
+        self._finished(result)
+        return result
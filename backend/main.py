@@ -1,30 +1,66 @@
 print("Starting backend...")
 # FastAPI backend code goes here (will provide full code in next steps)
-from fastapi import FastAPI, UploadFile, File, Form, BackgroundTasks, HTTPException, Depends, Query
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi import FastAPI, UploadFile, File, Form, BackgroundTasks, HTTPException, Depends, Query, Request
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 import os
-from typing import List, Optional, Dict
-import pdfplumber
-import docx
-from PIL import Image
-import pytesseract
+from typing import Callable, List, Optional, Dict
 from dotenv import load_dotenv
-import google.generativeai as genai
-from openai import AsyncOpenAI
 import asyncio
-from docx import Document
-from docx.shared import Pt, RGBColor
-from docx.enum.text import WD_ALIGN_PARAGRAPH
-from docx.enum.style import WD_STYLE_TYPE
 import json
+from contextvars import ContextVar
 import uuid
 from datetime import datetime
 import hashlib
-from docx2pdf import convert
+import time
 from pydantic import BaseModel, EmailStr
 import requests
+from analysis_cache import AnalysisCache, DocumentVersionStore, diff_chunks, hash_text, make_cache_key
+from job_queue import JobQueue, JOB_DONE, JOB_FAILED, JOB_QUEUED, JOB_RUNNING
+from user_store import UserStore, SessionCache, DuplicateEmailError
+from artifacts import ArtifactStore
+from extraction import (
+    extract_document,
+    IMAGE_EXTENSIONS,
+    extract_screenshot_texts,
+    ocr_cache_info,
+    EXTRACTION_WORKERS,
+    MAX_SCREENSHOTS,
+    shutdown_process_pool,
+)
+from reports import (
+    REPORT_PREBUILD_PDF,
+    REPORT_RENDER_MODE,
+    REPORT_WORKERS,
+    ReportBuilder,
+    render_docx_report,
+    render_pdf_report,
+)
+from history import HistoryStore, HISTORY_PAGE_SIZE
+from chunking import CHUNK_TOKEN_BUDGET, chunk_document, chunk_label, estimate_tokens, map_reduce
+from repetition import PARAGRAPH_MAX_WORDS, REPETITION_MODE, detect_repetition, format_clusters, split_units
+from consistency import CONSISTENCY_MODE, detect_conflicts, format_conflicts
+from grammar import GRAMMAR_BATCH_TOKENS, GRAMMAR_MODE, batch_paragraphs, format_batch, format_corrections, needs_check, parse_corrections
+from retrieval import RETRIEVAL_SECTION_TOKENS, RETRIEVAL_TOP_K, SCREENSHOT_RETRIEVAL, match_screenshots
+from llm_client import LLMClient, LLMError, LLMResult
+import metrics
+from metrics import TRACE_HEADER, llm_task, record_llm_result, timed_progress, trace_id
+from uploads import (
+    MAX_DOCUMENT_BYTES,
+    MAX_SCREENSHOT_BYTES,
+    UPLOAD_CHUNK_SIZE,
+    UPLOAD_GC_INTERVAL_SECONDS,
+    UPLOAD_TTL_SECONDS,
+    UploadManifestStore,
+    UploadSessionError,
+    UploadSessionStore,
+    UploadTooLarge,
+    safe_filename,
+    save_upload_file,
+    stored_filename,
+    upload_filename,
+)
 
 app = FastAPI()
 
@@ -35,49 +71,100 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[TRACE_HEADER],
 )
 
+@app.middleware("http")
+async def trace_and_time_requests(request: Request, call_next):
+    """Tags each request with a trace ID (echoed in the response) and records its latency by route."""
+    request_trace = request.headers.get(TRACE_HEADER) or uuid.uuid4().hex
+    trace = trace_id.set(request_trace)
+    started = time.monotonic()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+    finally:
+        route = request.scope.get("route")
+        metrics.HTTP_REQUEST_SECONDS.observe(
+            time.monotonic() - started,
+            method=request.method,
+            # The route template, not the raw path, so IDs do not create a series per request
+            route=getattr(route, "path", "unmatched"),
+            status=str(status),
+        )
+        trace_id.reset(trace)
+    response.headers[TRACE_HEADER] = request_trace
+    return response
+
 UPLOAD_DIR = "uploads"
 REPORT_DIR = "reports"
 USERS_DIR = "users"
+CACHE_DIR = "cache"
+JOBS_DIR = "jobs"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(REPORT_DIR, exist_ok=True)
 os.makedirs(USERS_DIR, exist_ok=True)
+os.makedirs(CACHE_DIR, exist_ok=True)
+os.makedirs(JOBS_DIR, exist_ok=True)
 
 load_dotenv()
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+# "gemini" (default) or "openai" for any OpenAI-compatible endpoint such as Together.ai
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "gemini")
+LLM_MODEL_NAME = os.getenv("LLM_MODEL_NAME", 'gemini-2.5-flash')
+# Streaming analyses forward the model's output token by token where a section is a single call
+LLM_STREAM_TOKENS = os.getenv("LLM_STREAM_TOKENS", "true").lower() == "true"
+
+llm_client = LLMClient(
+    provider=LLM_PROVIDER,
+    api_key=GEMINI_API_KEY if LLM_PROVIDER == "gemini" else OPENAI_API_KEY,
+    model=LLM_MODEL_NAME,
+    base_url=os.getenv("LLM_BASE_URL"),
+    timeout=float(os.getenv("LLM_TIMEOUT_SECONDS", "120")),
+    max_retries=int(os.getenv("LLM_MAX_RETRIES", "4")),
+    # Unlimited by default; set these to stay within the provider's quota
+    requests_per_minute=float(os.getenv("LLM_REQUESTS_PER_MINUTE", "0")) or None,
+    rate_limit_burst=float(os.getenv("LLM_RATE_LIMIT_BURST", "0")) or None,
+    # Bounds concurrent LLM calls across all chunks, analysis types and jobs
+    max_concurrency=int(os.getenv("LLM_CONCURRENCY", "8")),
+    max_connections=int(os.getenv("LLM_MAX_CONNECTIONS", "20")),
+    on_result=lambda result: record_llm_result(result, LLM_PROVIDER),
+)
+
+# Analysis result cache, keyed on document/screenshot content, prompts and model
+analysis_cache = AnalysisCache(
+    os.path.join(CACHE_DIR, "analysis_cache.db"),
+    ttl_seconds=int(os.getenv("ANALYSIS_CACHE_TTL_SECONDS", str(7 * 24 * 3600))),
+    max_entries=int(os.getenv("ANALYSIS_CACHE_MAX_ENTRIES", "1000")),
+    max_bytes=int(os.getenv("ANALYSIS_CACHE_MAX_BYTES", str(200 * 1024 * 1024))),
+)
 
-genai.configure(api_key=GEMINI_API_KEY)
-gemini_model = genai.GenerativeModel('gemini-2.5-flash')
-llama_client = AsyncOpenAI(
-    api_key=OPENAI_API_KEY,
-    base_url="https://api.together.xyz/v1"  # IMPORTANT: Change if not using Together.ai
+# Per-chunk map results, so a revised document only re-analyzes the chunks that changed
+chunk_cache = AnalysisCache(
+    os.path.join(CACHE_DIR, "chunk_cache.db"),
+    ttl_seconds=int(os.getenv("ANALYSIS_CACHE_TTL_SECONDS", str(7 * 24 * 3600))),
+    max_entries=int(os.getenv("CHUNK_CACHE_MAX_ENTRIES", "20000")),
+    max_bytes=int(os.getenv("CHUNK_CACHE_MAX_BYTES", str(200 * 1024 * 1024))),
 )
 
+# Extracted document/OCR text, keyed on file content hash and extractor version
+artifact_store = ArtifactStore(os.path.join(CACHE_DIR, "artifacts"))
+
 # User management
 users_file = os.path.join(USERS_DIR, "users.json")
 user_data_file = os.path.join(USERS_DIR, "user_data.json")
+user_store = UserStore(os.path.join(USERS_DIR, "users.db"), legacy_json_path=users_file)
+session_cache = SessionCache(
+    ttl_seconds=int(os.getenv("SESSION_CACHE_TTL_SECONDS", "300")),
+    max_size=int(os.getenv("SESSION_CACHE_MAX_SIZE", "10000")),
+)
+document_versions = DocumentVersionStore(os.path.join(USERS_DIR, "versions.db"))
+history_store = HistoryStore(os.path.join(USERS_DIR, "history"), legacy_json_path=user_data_file)
 
 def load_users():
-    if os.path.exists(users_file):
-        with open(users_file, 'r') as f:
-            return json.load(f)
-    return {}
-
-def save_users(users):
-    with open(users_file, 'w') as f:
-        json.dump(users, f, indent=2)
-
-def load_user_data():
-    if os.path.exists(user_data_file):
-        with open(user_data_file, 'r') as f:
-            return json.load(f)
-    return {}
-
-def save_user_data(user_data):
-    with open(user_data_file, 'w') as f:
-        json.dump(user_data, f, indent=2)
+    return user_store.all()
 
 def hash_password(password: str) -> str:
     return hashlib.sha256(password.encode()).hexdigest()
@@ -89,11 +176,12 @@ def generate_token() -> str:
     return str(uuid.uuid4())
 
 def get_user_from_token(token: str) -> Optional[Dict]:
-    users = load_users()
-    for user_id, user in users.items():
-        if user.get('token') == token:
-            return {'id': user_id, **user}
-    return None
+    user = session_cache.get(token)
+    if user is None:
+        user = user_store.get_by_token(token)
+        if user:
+            session_cache.set(token, user)
+    return user
 
 # Authentication dependency
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
@@ -105,12 +193,9 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(H
 
 @app.post("/auth/signup")
 async def signup(email: str = Form(...), password: str = Form(...), name: str = Form(...)):
-    users = load_users()
-    
     # Check if user already exists
-    for user in users.values():
-        if user['email'] == email:
-            raise HTTPException(status_code=400, detail="User already exists")
+    if user_store.get_by_email(email):
+        raise HTTPException(status_code=400, detail="User already exists")
     
     # Create new user
     user_id = str(uuid.uuid4())
@@ -124,18 +209,13 @@ async def signup(email: str = Form(...), password: str = Form(...), name: str =
         'created_at': datetime.now().isoformat()
     }
     
-    users[user_id] = new_user
-    save_users(users)
+    try:
+        user_store.create(user_id, new_user)
+    except DuplicateEmailError:
+        raise HTTPException(status_code=400, detail="User already exists")
     
     # Initialize user data
-    user_data = load_user_data()
-    user_data[user_id] = {
-        'documents_analyzed': 0,
-        'reports_generated': 0,
-        'last_analysis': None,
-        'analysis_history': []
-    }
-    save_user_data(user_data)
+    history_store.init_user(user_id)
     
     return {
         'token': token,
@@ -148,23 +228,21 @@ async def signup(email: str = Form(...), password: str = Form(...), name: str =
 
 @app.post("/auth/login")
 async def login(email: str = Form(...), password: str = Form(...)):
-    users = load_users()
-    
-    for user_id, user in users.items():
-        if user['email'] == email and verify_password(password, user['password']):
-            # Generate new token
-            token = generate_token()
-            user['token'] = token
-            save_users(users)
-            
-            return {
-                'token': token,
-                'user': {
-                    'id': user_id,
-                    'email': user['email'],
-                    'name': user['name']
-                }
+    user = user_store.get_by_email(email)
+    if user and verify_password(password, user['password']):
+        # Generate new token
+        token = generate_token()
+        user_store.update(user['id'], token=token)
+        session_cache.invalidate_user(user['id'])
+        
+        return {
+            'token': token,
+            'user': {
+                'id': user['id'],
+                'email': user['email'],
+                'name': user['name']
             }
+        }
     
     raise HTTPException(status_code=401, detail="Invalid credentials")
 
@@ -179,189 +257,370 @@ async def get_user_profile(current_user: Dict = Depends(get_current_user)):
 
 @app.get("/user/stats")
 async def get_user_stats(current_user: Dict = Depends(get_current_user)):
-    user_data = load_user_data()
-    user_stats = user_data.get(current_user['id'], {
-        'documents_analyzed': 0,
-        'reports_generated': 0,
-        'last_analysis': None,
-        'analysis_history': []
-    })
-    
-    return user_stats
+    user_stats = history_store.get_stats(current_user['id'])
+    # The first page of summary listings; older entries come from /user/history
+    history, next_cursor = history_store.list(current_user['id'])
+    return {**user_stats, 'analysis_history': history, 'history_cursor': next_cursor}
 
 @app.get("/user/history")
-async def get_user_history(current_user: Dict = Depends(get_current_user)):
-    user_data = load_user_data()
-    user_stats = user_data.get(current_user['id'], {})
-    return user_stats.get('analysis_history', [])
-
-def extract_text_from_pdf(pdf_path):
-    text = ""
-    with pdfplumber.open(pdf_path) as pdf:
-        for page in pdf.pages:
-            text += page.extract_text() or ""
-    return text
-
-def extract_text_from_docx(docx_path):
-    doc = docx.Document(docx_path)
-    return "\n".join([p.text for p in doc.paragraphs])
-
-def extract_text_from_image(image_path):
-    image = Image.open(image_path)
-    return pytesseract.image_to_string(image)
+async def get_user_history(
+    cursor: Optional[str] = None,
+    limit: int = Query(HISTORY_PAGE_SIZE, ge=1, le=100),
+    current_user: Dict = Depends(get_current_user)
+):
+    try:
+        items, next_cursor = history_store.list(current_user['id'], cursor=cursor, limit=limit)
+    except KeyError:
+        raise HTTPException(status_code=400, detail="Invalid history cursor.")
+    return {"items": items, "next_cursor": next_cursor}
 
 @app.post("/upload")
 async def upload_files(
     document: UploadFile = File(...),
     screenshots: Optional[List[UploadFile]] = File(None),
     chapter: Optional[str] = Form(None),
+    document_key: Optional[str] = Form(None),
     current_user: Dict = Depends(get_current_user)
 ):
-    # Create user-specific upload directory
-    user_upload_dir = os.path.join(UPLOAD_DIR, current_user['id'])
-    os.makedirs(user_upload_dir, exist_ok=True)
-    
-    # Save document
-    doc_path = os.path.join(user_upload_dir, document.filename)
-    with open(doc_path, "wb") as f:
-        f.write(await document.read())
-    
-    screenshot_paths = []
-    if screenshots:
-        for shot in screenshots:
-            shot_path = os.path.join(user_upload_dir, shot.filename)
-            with open(shot_path, "wb") as f:
-                f.write(await shot.read())
-            screenshot_paths.append(shot_path)
+    manifest = await save_upload(current_user['id'], document, screenshots, chapter, document_key)
+    return upload_response(manifest)
+
+DOCUMENT_EXTENSIONS = ('.pdf', '.docx')
+
+upload_manifests = UploadManifestStore(UPLOAD_DIR)
+
+async def save_upload(
+    user_id: str,
+    document: UploadFile,
+    screenshots: Optional[List[UploadFile]],
+    chapter: Optional[str],
+    document_key: Optional[str] = None,
+) -> Dict:
+    if not safe_filename(document.filename).lower().endswith(DOCUMENT_EXTENSIONS):
+        raise HTTPException(status_code=400, detail="Only .pdf and .docx documents can be analyzed.")
+    if screenshots and len(screenshots) > MAX_SCREENSHOTS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_SCREENSHOTS} screenshots can be uploaded.")
+    if any(not safe_filename(shot.filename).lower().endswith(IMAGE_EXTENSIONS) for shot in screenshots or []):
+        raise HTTPException(status_code=400, detail="Screenshots must be .png, .jpg or .jpeg images.")
+
+    # Every upload gets its own directory and manifest
+    upload_id, upload_dir = upload_manifests.new_upload(user_id)
     
-    # Return file info and analysis trigger token (placeholder)
-    return {"document": doc_path, "screenshots": screenshot_paths, "chapter": chapter, "token": "demo-token"}
+    # Stream each file to disk in chunks, hashing it on the way. Files are stored under
+    # their role and position; the client's filenames are only kept in the manifest.
+    try:
+        filename = safe_filename(document.filename)
+        doc_info = await save_upload_file(
+            document, os.path.join(upload_dir, stored_filename("document", 0, filename)), MAX_DOCUMENT_BYTES
+        )
+        doc_info['filename'] = filename
+        screenshot_infos = []
+        for index, shot in enumerate(screenshots or [], start=1):
+            filename = safe_filename(shot.filename)
+            info = await save_upload_file(
+                shot, os.path.join(upload_dir, stored_filename("screenshot", index, filename)), MAX_SCREENSHOT_BYTES
+            )
+            screenshot_infos.append({**info, 'filename': filename})
+    except UploadTooLarge as e:
+        upload_manifests.discard(user_id, upload_id)
+        raise HTTPException(status_code=413, detail=str(e))
+
+    return upload_manifests.create(user_id, upload_id, doc_info, screenshot_infos, chapter, document_key)
+
+def upload_response(manifest: Dict) -> Dict:
+    return {
+        "upload_id": manifest['id'],
+        "document": manifest['document']['path'],
+        "document_filename": upload_filename(manifest['document']),
+        "document_size": manifest['document']['size'],
+        "document_sha256": manifest['document']['sha256'],
+        "screenshots": [info['path'] for info in manifest['screenshots']],
+        "screenshot_filenames": [upload_filename(info) for info in manifest['screenshots']],
+        "screenshot_sha256": [info['sha256'] for info in manifest['screenshots']],
+        "chapter": manifest['chapter'],
+        "document_key": manifest.get('document_key'),
+        # Kept for clients that pass the upload's "token" to /analyze
+        "token": manifest['id'],
+    }
+
+async def collect_upload_garbage():
+    while True:
+        try:
+            removed = await asyncio.to_thread(upload_manifests.collect_garbage, UPLOAD_TTL_SECONDS)
+            if removed:
+                print(f"Removed {removed} orphaned upload(s)")
+        except Exception as e:
+            print(f"Upload garbage collection failed: {e}")
+        await asyncio.sleep(UPLOAD_GC_INTERVAL_SECONDS)
+
+# Resumable uploads for large documents: create a session, PUT the raw bytes
+# in pieces at increasing offsets, then complete it
+upload_sessions = UploadSessionStore(UPLOAD_DIR)
+
+def get_upload_session(session_id: str, current_user: Dict) -> Dict:
+    session = upload_sessions.get(current_user['id'], session_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    return session
 
-def setup_document_styles(document):
-    """Sets up custom styles for the document."""
-    styles = document.styles
+@app.post("/upload/sessions")
+async def create_upload_session(
+    filename: str = Form(...),
+    total_size: int = Form(...),
+    current_user: Dict = Depends(get_current_user)
+):
+    if not safe_filename(filename).lower().endswith(DOCUMENT_EXTENSIONS):
+        raise HTTPException(status_code=400, detail="Only .pdf and .docx documents can be analyzed.")
+    try:
+        session = upload_sessions.create(current_user['id'], filename, total_size, MAX_DOCUMENT_BYTES)
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except UploadSessionError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {**session, "chunk_size": UPLOAD_CHUNK_SIZE}
+
+@app.get("/upload/sessions/{session_id}")
+async def get_upload_session_status(session_id: str, current_user: Dict = Depends(get_current_user)):
+    return get_upload_session(session_id, current_user)
+
+@app.put("/upload/sessions/{session_id}")
+async def upload_session_chunk(
+    session_id: str,
+    request: Request,
+    offset: int = Query(...),
+    current_user: Dict = Depends(get_current_user)
+):
+    session = get_upload_session(session_id, current_user)
+    try:
+        # The request body is streamed straight to disk, never buffered whole
+        return await upload_sessions.append(session, offset, request.stream())
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except UploadSessionError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@app.post("/upload/sessions/{session_id}/complete")
+async def complete_upload_session(
+    session_id: str,
+    chapter: Optional[str] = Form(None),
+    document_key: Optional[str] = Form(None),
+    current_user: Dict = Depends(get_current_user)
+):
+    session = get_upload_session(session_id, current_user)
+    user_id = current_user['id']
+    upload_id, upload_dir = upload_manifests.new_upload(user_id)
     try:
-        # Base style
-        base_style = styles['Normal']
-        font = base_style.font
-        font.name = 'Calibri'
-        font.size = Pt(11)
-
-        # Title style
-        title_style = styles.add_style('ReportTitle', WD_STYLE_TYPE.PARAGRAPH)
-        font = title_style.font
-        font.name = 'Calibri'
-        font.size = Pt(28)
-        font.bold = True
-        font.color.rgb = RGBColor(0x1F, 0x4E, 0x78)
-
-        # Heading 1 style
-        h1_style = styles.add_style('ReportHeading1', WD_STYLE_TYPE.PARAGRAPH)
-        h1_style.base_style = styles['Heading 1']
-        font = h1_style.font
-        font.name = 'Calibri'
-        font.size = Pt(16)
-        font.bold = True
-        font.color.rgb = RGBColor(0x1F, 0x4E, 0x78)
-        p_format = h1_style.paragraph_format
-        p_format.space_before = Pt(12)
-        p_format.space_after = Pt(6)
-    except Exception as e:
-        print(f"An error occurred during style setup: {e}")
+        doc_info = upload_sessions.complete(session, upload_dir)
+    except UploadSessionError as e:
+        upload_manifests.discard(user_id, upload_id)
+        raise HTTPException(status_code=409, detail=str(e))
+    manifest = upload_manifests.create(user_id, upload_id, doc_info, [], chapter, document_key)
+    return upload_response(manifest)
+
+@app.delete("/upload/sessions/{session_id}")
+async def cancel_upload_session(session_id: str, current_user: Dict = Depends(get_current_user)):
+    upload_sessions.discard(get_upload_session(session_id, current_user))
+    return {"message": "Upload session cancelled"}
 
 @app.post("/analyze")
 async def analyze(
     token: str = Form(...),
+    mode: str = Form("fanout"),
+    current_user: Dict = Depends(get_current_user)
+):
+    job_id = queue_analysis(token, mode, current_user)
+    return {
+        "message": "Analysis queued",
+        "job_id": job_id,
+        "status": "queued",
+        "status_url": f"/jobs/{job_id}",
+    }
+
+@app.post("/analyze/stream")
+async def analyze_stream(
+    token: str = Form(...),
+    mode: str = Form("fanout"),
     current_user: Dict = Depends(get_current_user)
 ):
+    """Queues an analysis and streams its progress as Server-Sent Events.
+
+    Events: "status" (the job's current status), "progress" (stage updates),
+    "token" (text as the model writes it, for sections that are a single LLM
+    call), "section" (each finished section), then "done" with the same result
+    as /jobs/{id}/result, or "failed". The report and history entry are saved
+    as for /analyze, even if the client disconnects.
+    """
+    job_id = queue_analysis(token, mode, current_user, stream=True)
+    return job_event_response(job_id)
+
+def queue_analysis(token: str, mode: str, current_user: Dict, stream: bool = False) -> str:
+    if mode not in ANALYSIS_MODES:
+        raise HTTPException(status_code=400, detail=f"Unknown analysis mode '{mode}'. Use one of: {', '.join(ANALYSIS_MODES)}.")
     user_id = current_user['id']
-    user_upload_dir = os.path.join(UPLOAD_DIR, user_id)
-    
-    # This is a simplified lookup based on the most recent files.
-    # A more robust system would use a database to track file uploads per user.
-    all_user_files = [os.path.join(user_upload_dir, f) for f in os.listdir(user_upload_dir)]
-    if not all_user_files:
-        raise HTTPException(status_code=404, detail="No documents found for this user to analyze.")
 
-    all_user_files.sort(key=os.path.getmtime, reverse=True)
-    
-    doc_path = next((f for f in all_user_files if f.lower().endswith(('.pdf', '.docx'))), None)
-    screenshot_paths = [f for f in all_user_files if f.lower().endswith(('.png', '.jpg', '.jpeg'))][:5] # Limit to 5 screenshots
+    # `token` is the upload ID returned by /upload
+    manifest = upload_manifests.get(user_id, token)
+    if not manifest:
+        raise HTTPException(status_code=404, detail="Upload not found. Upload the document again before analyzing it.")
 
-    if not doc_path:
-        raise HTTPException(status_code=404, detail="A compatible document (.pdf, .docx) for analysis not found in recent uploads.")
+    job_id = analysis_jobs.enqueue(user_id, {**analysis_payload(manifest, mode), 'stream': stream, 'trace_id': trace_id.get()})
+    # Analyzed uploads are kept; only never-analyzed ones are garbage-collected
+    upload_manifests.mark_analyzed(manifest)
+    return job_id
 
-    original_filename = os.path.basename(doc_path)
-    file_type = doc_path.split('.')[-1].lower()
-    
-    # 1. Extract text
-    doc_text = ""
-    if file_type == 'pdf':
-        doc_text = extract_text_from_pdf(doc_path)
-    elif file_type == 'docx':
-        doc_text = extract_text_from_docx(doc_path)
-
-    screenshot_texts = [extract_text_from_image(p) for p in screenshot_paths]
-    
-    # 2. Perform AI analysis concurrently
-    analysis_tasks = {
-        "summary": asyncio.to_thread(llama3_summarize, doc_text),
-        "grammar": asyncio.to_thread(llama3_grammar_correct, doc_text),
-        "suggestions": asyncio.to_thread(llama3_suggestions, doc_text),
-        "inconsistencies": asyncio.to_thread(llama3_inconsistencies, doc_text, screenshot_texts),
-        "repetition": asyncio.to_thread(llama3_check_for_repetition, doc_text),
-        "internal_inconsistencies": asyncio.to_thread(llama3_check_internal_inconsistencies, doc_text)
+def analysis_payload(manifest: Dict, mode: str) -> Dict:
+    screenshots = manifest['screenshots'][:MAX_SCREENSHOTS]
+    return {
+        'upload_id': manifest['id'],
+        'doc_path': manifest['document']['path'],
+        'doc_filename': upload_filename(manifest['document']),
+        'doc_sha256': manifest['document']['sha256'],
+        'screenshot_paths': [info['path'] for info in screenshots],
+        'screenshot_sha256': [info['sha256'] for info in screenshots],
+        'chapter': manifest['chapter'],
+        'document_key': manifest.get('document_key') or upload_filename(manifest['document']),
+        'mode': mode,
     }
+
+# Set while a streaming job runs: publishes (event, data) to the job's listeners
+analysis_events: ContextVar[Optional[Callable[[str, Dict], None]]] = ContextVar("analysis_events", default=None)
+# The section whose LLM output is streamed as "token" events; None where calls would interleave
+streaming_section: ContextVar[Optional[str]] = ContextVar("streaming_section", default=None)
+
+async def run_analysis_job(job: Dict, progress) -> Dict:
+    """Runs one queued analysis job: extraction, LLM analysis, report and history."""
+    stream = job['payload'].get('stream')
+    publish = (lambda event, data: analysis_jobs.publish(job['id'], event, data)) if stream else None
+    # Reset afterwards so the listener and trace do not leak into the worker's next job
+    events = analysis_events.set(publish)
+    trace = trace_id.set(job['payload'].get('trace_id'))
+    started = time.monotonic()
+    status = JOB_FAILED
+    try:
+        result = await analyze_document(job, timed_progress(progress))
+        status = JOB_DONE
+        return result
+    finally:
+        metrics.JOB_SECONDS.observe(time.monotonic() - started, status=status)
+        analysis_events.reset(events)
+        trace_id.reset(trace)
+
+async def analyze_document(job: Dict, progress) -> Dict:
+    user_id = job['user_id']
+    doc_path = job['payload']['doc_path']
+    screenshot_paths = job['payload']['screenshot_paths']
+    mode = job['payload'].get('mode', 'fanout')
+    if not os.path.exists(doc_path):
+        raise HTTPException(status_code=404, detail="The uploaded document is no longer available.")
+
+    original_filename = job['payload'].get('doc_filename') or os.path.basename(doc_path)
     
-    results = await asyncio.gather(*analysis_tasks.values())
+    # 1. Extract text, reusing the stored artifact when this exact file was extracted before
+    progress("extract_text", "running")
+    # PDF pages are extracted in parallel on the process pool and reported as they arrive
+    pages_done = 0
+
+    def on_page(page, total):
+        nonlocal pages_done
+        pages_done += 1
+        progress("extract_text", f"{pages_done}/{total} pages")
+
+    async with stage_limits["extract_text"]:
+        extracted = await extract_document(
+            doc_path, job['payload'].get('doc_sha256'), artifacts=artifact_store, on_page=on_page
+        )
+    failed_pages = extracted.get('failed_pages') or []
+    if failed_pages:
+        # Analyzing the rest would report on a document with pages silently missing
+        shown = ", ".join(str(n) for n in failed_pages[:10]) + (", ..." if len(failed_pages) > 10 else "")
+        raise HTTPException(
+            status_code=422,
+            detail=f"Could not extract text from {len(failed_pages)} of {extracted['page_count']} pages of {original_filename} (pages {shown}).",
+        )
+    doc_text = extracted['text']
+    doc_pages = extracted['pages']
+    if extracted['truncated']:
+        print(f"Extracted {len(doc_pages)} of {extracted['page_count']} pages from {original_filename}")
+    progress("extract_text", "cached" if extracted['cached'] else "done")
+
+    progress("ocr", "running")
+    async with stage_limits["ocr"]:
+        screenshot_texts = await extract_screenshot_texts(
+            screenshot_paths, job['payload'].get('screenshot_sha256'), artifacts=artifact_store
+        )
+    progress("ocr", "done")
+    
+    # 2. Perform AI analysis concurrently, unless this exact input was analyzed before
+    cache_key = make_cache_key(
+        doc_text, screenshot_texts, PROMPT_TEMPLATES, LLM_MODEL_NAME,
+        options={
+            "reduce_prompts": REDUCE_TEMPLATES,
+            "chunk_token_budget": CHUNK_TOKEN_BUDGET,
+            "mode": mode,
+            "combined_prompt": COMBINED_PROMPT_TEMPLATE if mode == "combined" else None,
+            "chunking": "content-defined-v1",
+            "repetition_mode": REPETITION_MODE,
+            "paragraph_max_words": PARAGRAPH_MAX_WORDS,
+            "repetition_advice_prompt": REPETITION_ADVICE_TEMPLATE if REPETITION_MODE == "hybrid" else None,
+            "consistency_mode": CONSISTENCY_MODE,
+            "consistency_review_prompt": CONSISTENCY_REVIEW_TEMPLATE if CONSISTENCY_MODE == "hybrid" else None,
+            "grammar_prompt": GRAMMAR_BATCH_TEMPLATE if GRAMMAR_MODE == "paragraph" else None,
+            "screenshot_retrieval": (SCREENSHOT_CHECK_TEMPLATE, RETRIEVAL_TOP_K, RETRIEVAL_SECTION_TOKENS) if SCREENSHOT_RETRIEVAL else None,
+        },
+    )
+    cached_results = analysis_cache.get(cache_key)
+    progress("llm_analysis", "running")
+    errors = {}
+
+    # Long documents are split into chunks and each analysis is map-reduced over them.
+    # Chunks are compared with the previous version of the same document; unchanged
+    # chunks reuse their cached per-chunk results.
+    chunks = chunk_document(doc_text, doc_pages, paragraphs=extracted['paragraphs'])
+    chunk_hashes = [hash_text(chunk['text']) for chunk in chunks]
+    document_key = job['payload'].get('document_key') or original_filename
+    previous_version = document_versions.latest(user_id, document_key)
+    incremental = diff_chunks(previous_version['chunk_hashes'] if previous_version else [], chunk_hashes)
+    chunk_stats = {"reused": 0, "analyzed": 0}
+    # Structured results some sections produce alongside their text, e.g. grammar diffs
+    details = {}
+    if cached_results:
+        print(f"Analysis cache hit for {original_filename}")
+        results = [cached_results[name] for name in ANALYSIS_SECTIONS]
+        details = cached_results.get("details", {})
+        for name, text in zip(ANALYSIS_SECTIONS, results):
+            publish_section(name, LLMResult(text=text))
+    else:
+        if len(chunks) > 1:
+            print(f"Analyzing {original_filename} in {len(chunks)} chunks")
+        if previous_version:
+            print(f"{original_filename}: {incremental['changed']} of {incremental['total']} chunks changed since version {previous_version['version']}")
+        if mode == "combined":
+            section_results = await analyze_combined(extracted, chunks, screenshot_texts, chunk_stats, details)
+            for name in COMBINED_SECTIONS:
+                publish_section(name, section_results[name])
+            llm_results = [section_results[name] for name in ANALYSIS_SECTIONS]
+        else:
+            llm_results = await asyncio.gather(*(
+                analyze_section(name, extracted, chunks, screenshot_texts, chunk_stats, details) for name in ANALYSIS_SECTIONS
+            ))
+        results = [r.text for r in llm_results]
+        errors = {name: r.error for name, r in zip(ANALYSIS_SECTIONS, llm_results) if not r.ok}
+        # Never cache failed LLM calls, so the next attempt retries them
+        if errors:
+            print(f"Analysis of {original_filename} had failed sections: {errors}")
+        else:
+            analysis_cache.set(cache_key, {**dict(zip(ANALYSIS_SECTIONS, results)), "details": details})
     summary, grammar_correction, suggestions, inconsistencies, repetition_check, internal_inconsistencies = results
+    progress("llm_analysis", "done")
 
-    # 3. Generate DOCX report in a user-specific directory
+    # 3. Generate the DOCX report in a user-specific directory, unless it is rendered on first download
+    progress("report", "running")
     user_report_dir = os.path.join(REPORT_DIR, user_id)
     os.makedirs(user_report_dir, exist_ok=True)
     
     doc_id = str(uuid.uuid4()).split('-')[0]
-    report_filename = f"report_{user_id}_{doc_id}.docx"
-    report_path = os.path.join(user_report_dir, report_filename)
-    
-    document = Document()
-    setup_document_styles(document)
-    
-    document.add_heading('AI Analysis Report', level=0).alignment = WD_ALIGN_PARAGRAPH.CENTER
-    document.add_paragraph(f"Analysis for: {original_filename}", style='Subtitle').alignment = WD_ALIGN_PARAGRAPH.CENTER
-    document.add_paragraph(f"Analyzed on: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", style='Quote').alignment = WD_ALIGN_PARAGRAPH.CENTER
-    
-    def add_section(title, content):
-        if content and content.strip():
-            document.add_heading(title, level=1)
-            lines = content.strip().split('\n')
-            for line in lines:
-                stripped = line.strip()
-                # Bullet points ("* " or "- ")
-                if stripped.startswith("* ") or stripped.startswith("- "):
-                    document.add_paragraph(stripped[2:], style='List Bullet')
-                # Numbered list (e.g., "1. ", "2. ")
-                elif len(stripped) > 2 and stripped[:2].isdigit() and stripped[2:4] == ". ":
-                    document.add_paragraph(stripped[4:], style='List Number')
-                # Markdown-style subheading (e.g., "### Heading")
-                elif stripped.startswith("### "):
-                    document.add_heading(stripped[4:], level=2)
-                # Normal paragraph
-                else:
-                    document.add_paragraph(stripped)
-
-    add_section("Summary", summary)
-    add_section("Grammar Corrections", grammar_correction)
-    add_section("Improvement Suggestions", suggestions)
-    add_section("Screenshot Inconsistencies", inconsistencies)
-    add_section("Repetitive Content Check", repetition_check)
-    add_section("Internal Inconsistencies Check", internal_inconsistencies)
-    
-    document.save(report_path)
-
-    # 4. Store analysis results in user's history
-    user_data = load_user_data()
     report_id = f"{user_id}_{doc_id}"
+    report_path = os.path.join(user_report_dir, f"report_{report_id}.docx")
     
     analysis_entry = {
         'id': report_id,
@@ -369,29 +628,233 @@ async def analyze(
         'timestamp': datetime.now().isoformat(),
         'summary': summary,
         'grammar_correction': grammar_correction,
+        'grammar_corrections': details.get('grammar_corrections'),
         'suggestions': suggestions,
         'inconsistencies': inconsistencies,
         'repetition_check': repetition_check,
         'internal_inconsistencies': internal_inconsistencies,
         'report_path': report_path,
-        'file_type': file_type,
+        'file_type': extracted['kind'],
+        'errors': errors,
+        'analysis_mode': mode,
+        'document_key': document_key,
+        'version': document_versions.record(user_id, document_key, extracted['sha256'] or '', report_id, chunk_hashes),
+        'previous_report_id': previous_version['report_id'] if previous_version else None,
+        'incremental': {**incremental, "chunk_results_reused": chunk_stats["reused"], "chunk_results_analyzed": chunk_stats["analyzed"]},
     }
-    
-    if user_id in user_data:
-        user_data[user_id]['documents_analyzed'] += 1
-        user_data[user_id]['reports_generated'] += 1
-        user_data[user_id]['last_analysis'] = datetime.now().isoformat()
-        user_data[user_id]['analysis_history'].insert(0, analysis_entry)
-        user_data[user_id]['analysis_history'] = user_data[user_id]['analysis_history'][:20]
-    
-    save_user_data(user_data)
+
+    if REPORT_RENDER_MODE == "lazy":
+        progress("report", "deferred")
+    else:
+        await report_builder.build(report_path, render_docx_report, analysis_entry)
+        progress("report", "done")
+
+    # 4. Store analysis results in user's history
+    progress("save_history", "running")
+    history_store.add(user_id, analysis_entry)
+    progress("save_history", "done")
+
+    if REPORT_PREBUILD_PDF:
+        report_builder.schedule(os.path.join(user_report_dir, f"report_{report_id}.pdf"), render_pdf_report, analysis_entry)
     
     return {
         "message": "Analysis complete",
         "report_id": report_id,
+        "cached": bool(cached_results),
         "results": analysis_entry
     }
 
+# PDF reports are rendered from the stored results on a bounded pool and kept next to the DOCX
+report_builder = ReportBuilder(REPORT_WORKERS)
+
+# Jobs run concurrently, so documents in a batch interleave their stages: while
+# one waits on the LLM, others extract or OCR. Each stage has one shared budget
+# across all jobs; LLM calls are bounded by the client's concurrency and rate limit.
+stage_limits = {
+    "extract_text": asyncio.Semaphore(int(os.getenv("EXTRACT_CONCURRENCY", str(EXTRACTION_WORKERS)))),
+    "ocr": asyncio.Semaphore(int(os.getenv("OCR_CONCURRENCY", str(EXTRACTION_WORKERS)))),
+}
+
+analysis_jobs = JobQueue(
+    os.path.join(JOBS_DIR, "jobs.db"),
+    run_analysis_job,
+    workers=int(os.getenv("ANALYSIS_WORKERS", "8")),
+)
+
+@app.on_event("startup")
+async def start_analysis_workers():
+    await history_store.start()
+    await analysis_jobs.start()
+    app.state.upload_gc_task = asyncio.create_task(collect_upload_garbage())
+
+@app.on_event("shutdown")
+async def stop_analysis_workers():
+    app.state.upload_gc_task.cancel()
+    await analysis_jobs.stop()
+    shutdown_process_pool()
+    report_builder.shutdown()
+    await llm_client.aclose()
+    # Last, so history written by jobs that finished during shutdown is on disk
+    await history_store.stop()
+
+def get_user_job(job_id: str, current_user: Dict) -> Dict:
+    job = analysis_jobs.get(job_id)
+    # Report other users' jobs as missing rather than leaking that they exist
+    if not job or job['user_id'] != current_user['id']:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.get("/jobs/{job_id}")
+async def get_job_status(job_id: str, current_user: Dict = Depends(get_current_user)):
+    job = get_user_job(job_id, current_user)
+    return {
+        "job_id": job['id'],
+        "status": job['status'],
+        "progress": job['progress'],
+        "error": job['error'],
+        "report_id": job['result']['report_id'] if job['result'] else None,
+        "trace_id": job['payload'].get('trace_id'),
+        "created_at": job['created_at'],
+        "updated_at": job['updated_at'],
+    }
+
+@app.get("/jobs/{job_id}/result")
+async def get_job_result(job_id: str, current_user: Dict = Depends(get_current_user)):
+    job = get_user_job(job_id, current_user)
+    if job['status'] != JOB_DONE:
+        raise HTTPException(status_code=409, detail=f"Job is {job['status']}, no result available yet.")
+    return job['result']
+
+@app.get("/jobs/{job_id}/events")
+async def get_job_events(job_id: str, current_user: Dict = Depends(get_current_user)):
+    """Streams a job's remaining events as Server-Sent Events, e.g. to reconnect to /analyze/stream."""
+    get_user_job(job_id, current_user)
+    return job_event_response(job_id)
+
+# Comment lines sent while waiting keep proxies from closing an idle stream
+SSE_KEEPALIVE_SECONDS = float(os.getenv("SSE_KEEPALIVE_SECONDS", "15"))
+
+def sse_message(event: str, data: Dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def job_event_response(job_id: str) -> StreamingResponse:
+    # Subscribe before checking the status, so an event published in between is not missed
+    events = analysis_jobs.subscribe(job_id)
+
+    async def stream():
+        try:
+            job = analysis_jobs.get(job_id)
+            yield sse_message("status", {
+                "job_id": job_id, "status": job['status'], "progress": job['progress'], "status_url": f"/jobs/{job_id}",
+            })
+            if job['status'] == JOB_DONE:
+                yield sse_message(JOB_DONE, job['result'])
+                return
+            if job['status'] == JOB_FAILED:
+                yield sse_message(JOB_FAILED, {"error": job['error']})
+                return
+            while True:
+                try:
+                    event, data = await asyncio.wait_for(events.get(), timeout=SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield sse_message(event, data)
+                if event in (JOB_DONE, JOB_FAILED):
+                    return
+        finally:
+            analysis_jobs.unsubscribe(job_id, events)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+BATCH_MAX_DOCUMENTS = int(os.getenv("BATCH_MAX_DOCUMENTS", "50"))
+
+@app.post("/batch")
+async def analyze_batch(
+    upload_ids: Optional[List[str]] = Form(None),
+    documents: Optional[List[UploadFile]] = File(None),
+    chapter: Optional[str] = Form(None),
+    mode: str = Form("fanout"),
+    current_user: Dict = Depends(get_current_user)
+):
+    """Queues many documents at once: existing uploads by ID (with their screenshots) and/or new documents."""
+    if mode not in ANALYSIS_MODES:
+        raise HTTPException(status_code=400, detail=f"Unknown analysis mode '{mode}'. Use one of: {', '.join(ANALYSIS_MODES)}.")
+    user_id = current_user['id']
+    # Accept repeated fields as well as a comma-separated list
+    upload_ids = [i.strip() for value in upload_ids or [] for i in value.split(',') if i.strip()]
+    documents = documents or []
+    if not upload_ids and not documents:
+        raise HTTPException(status_code=400, detail="Provide upload_ids and/or documents to analyze.")
+    if len(upload_ids) + len(documents) > BATCH_MAX_DOCUMENTS:
+        raise HTTPException(status_code=400, detail=f"A batch can contain at most {BATCH_MAX_DOCUMENTS} documents.")
+
+    # Validate everything before saving anything, so a bad file does not leave a partial batch behind
+    if any(not safe_filename(document.filename).lower().endswith(DOCUMENT_EXTENSIONS) for document in documents):
+        raise HTTPException(status_code=400, detail="Only .pdf and .docx documents can be analyzed.")
+    manifests = []
+    for upload_id in upload_ids:
+        manifest = upload_manifests.get(user_id, upload_id)
+        if not manifest:
+            raise HTTPException(status_code=404, detail=f"Upload {upload_id} not found.")
+        manifests.append(manifest)
+    for document in documents:
+        manifests.append(await save_upload(user_id, document, None, chapter))
+
+    batch_id = uuid.uuid4().hex
+    jobs = []
+    for manifest in manifests:
+        job_id = analysis_jobs.enqueue(user_id, analysis_payload(manifest, mode), batch_id=batch_id)
+        upload_manifests.mark_analyzed(manifest)
+        jobs.append({
+            "job_id": job_id,
+            "upload_id": manifest['id'],
+            "document": upload_filename(manifest['document']),
+        })
+    return {
+        "message": "Batch queued",
+        "batch_id": batch_id,
+        "jobs": jobs,
+        "status_url": f"/batch/{batch_id}",
+    }
+
+@app.get("/batch/{batch_id}")
+async def get_batch_status(batch_id: str, current_user: Dict = Depends(get_current_user)):
+    jobs = [job for job in analysis_jobs.list_batch(batch_id) if job['user_id'] == current_user['id']]
+    if not jobs:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    counts = {status: 0 for status in (JOB_QUEUED, JOB_RUNNING, JOB_DONE, JOB_FAILED)}
+    for job in jobs:
+        counts[job['status']] += 1
+    finished = counts[JOB_DONE] + counts[JOB_FAILED]
+    if finished < len(jobs):
+        status = JOB_RUNNING if counts[JOB_QUEUED] < len(jobs) else JOB_QUEUED
+    else:
+        status = JOB_DONE if not counts[JOB_FAILED] else JOB_FAILED if not counts[JOB_DONE] else "partial"
+    return {
+        "batch_id": batch_id,
+        "status": status,
+        "total": len(jobs),
+        "counts": counts,
+        "documents": [
+            {
+                "job_id": job['id'],
+                "upload_id": job['payload'].get('upload_id'),
+                "document": job['payload'].get('doc_filename') or os.path.basename(job['payload']['doc_path']),
+                "status": job['status'],
+                "progress": job['progress'],
+                "error": job['error'],
+                "report_id": job['result']['report_id'] if job['result'] else None,
+                "trace_id": job['payload'].get('trace_id'),
+            }
+            for job in jobs
+        ],
+    }
+
 @app.delete("/analysis/{report_id}")
 async def delete_analysis(report_id: str, current_user: Dict = Depends(get_current_user)):
     user_id = current_user['id']
@@ -400,32 +863,16 @@ async def delete_analysis(report_id: str, current_user: Dict = Depends(get_curre
     if not report_id.startswith(user_id):
         raise HTTPException(status_code=403, detail="Access denied: You can only delete your own analysis history.")
 
-    user_data = load_user_data()
-    user_history = user_data.get(user_id, {}).get('analysis_history', [])
-    
-    analysis_to_delete = None
-    for item in user_history:
-        if item['id'] == report_id:
-            analysis_to_delete = item
-            break
-            
-    if not analysis_to_delete:
+    if not history_store.delete(user_id, report_id):
         raise HTTPException(status_code=404, detail="Analysis not found in history.")
-        
-    # Remove from history
-    user_history.remove(analysis_to_delete)
-    user_data[user_id]['analysis_history'] = user_history
-    save_user_data(user_data)
     
     # Optionally, delete the physical report file from user's directory
     user_report_dir = os.path.join(REPORT_DIR, user_id)
     report_path_docx = os.path.join(user_report_dir, f"report_{report_id}.docx")
     report_path_pdf = os.path.join(user_report_dir, f"report_{report_id}.pdf")
     
-    if os.path.exists(report_path_docx):
-        os.remove(report_path_docx)
-    if os.path.exists(report_path_pdf):
-        os.remove(report_path_pdf)
+    report_builder.invalidate(report_path_docx)
+    report_builder.invalidate(report_path_pdf)
         
     return {"message": "Analysis deleted successfully"}
 
@@ -435,10 +882,7 @@ async def get_analysis_details(report_id: str, current_user: Dict = Depends(get_
     if not report_id.startswith(current_user['id']):
         raise HTTPException(status_code=403, detail="Access denied")
 
-    user_data = load_user_data()
-    user_history = user_data.get(current_user['id'], {}).get('analysis_history', [])
-    
-    analysis = next((item for item in user_history if item['id'] == report_id), None)
+    analysis = history_store.get(current_user['id'], report_id)
 
     if not analysis:
         raise HTTPException(status_code=404, detail="Analysis not found")
@@ -446,7 +890,7 @@ async def get_analysis_details(report_id: str, current_user: Dict = Depends(get_
     return analysis
 
 @app.get("/report/{report_id}")
-def get_report(
+async def get_report(
     report_id: str, 
     format: str = Query("docx", enum=["docx", "pdf"]),
     current_user: Dict = Depends(get_current_user)
@@ -459,73 +903,479 @@ def get_report(
     user_id = current_user['id']
     user_report_dir = os.path.join(REPORT_DIR, user_id)
     
-    report_path_docx = os.path.join(user_report_dir, f"report_{report_id}.docx")
-    
-    if not os.path.exists(report_path_docx):
-        print(f"Report not found: {report_path_docx}")
-        raise HTTPException(status_code=404, detail="Report not found")
+    format = format.lower()
+    report_path = os.path.join(user_report_dir, f"report_{report_id}.{format}")
 
-    if format.lower() == 'pdf':
-        report_path_pdf = os.path.join(user_report_dir, f"report_{report_id}.pdf")
-        
-        # Convert to PDF if it doesn't exist
-        if not os.path.exists(report_path_pdf):
-            try:
-                print(f"Converting {report_path_docx} to PDF...")
-                convert(report_path_docx, report_path_pdf)
-                print("Conversion complete.")
-            except Exception as e:
-                print(f"Error converting to PDF: {e}")
-                raise HTTPException(status_code=500, detail="Failed to convert report to PDF.")
-        
+    # Reports not rendered yet (lazy mode, or PDFs) are rendered from the stored results on first request
+    if not os.path.exists(report_path):
+        analysis = history_store.get(user_id, report_id)
+        if not analysis:
+            print(f"Report not found: {report_id}")
+            raise HTTPException(status_code=404, detail="Report not found")
+        renderer = render_pdf_report if format == 'pdf' else render_docx_report
+        try:
+            await report_builder.build(report_path, renderer, analysis)
+        except Exception as e:
+            print(f"Error rendering {format} report: {e}")
+            raise HTTPException(status_code=500, detail=f"Failed to render report as {format.upper()}.")
+
+    if format == 'pdf':
         return FileResponse(
-            report_path_pdf, 
+            report_path, 
             media_type="application/pdf", 
             filename=f"AI_Document_Analysis_{report_id}.pdf"
         )
 
     # Default to DOCX
     return FileResponse(
-        report_path_docx, 
+        report_path, 
         media_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document", 
         filename=f"AI_Document_Analysis_{report_id}.docx"
     )
 
-def llama3_generate(prompt, system_prompt=None):
-    # Use Gemini as primary LLM service
-    try:
-        if GEMINI_API_KEY and GEMINI_API_KEY != "your_gemini_api_key_here":
-            response = gemini_model.generate_content(prompt)
-            return response.text
-        else:
-            return "Error: Gemini API key not configured. Please set GEMINI_API_KEY in your environment variables."
-    except Exception as e:
-        return f"Error using Gemini: {str(e)}"
+async def llama3_generate(prompt, system_prompt=None) -> LLMResult:
+    publish, section = analysis_events.get(), streaming_section.get()
+    if publish and section and LLM_STREAM_TOKENS:
+        def on_text(text):
+            publish("token", {"section": section, "text": text})
+        return await llm_client.stream(prompt, system_prompt=system_prompt, on_text=on_text)
+    return await llm_client.generate(prompt, system_prompt=system_prompt)
+
+def publish_section(task, result: LLMResult):
+    publish = analysis_events.get()
+    if publish:
+        publish("section", {"section": task, "text": result.text, "error": result.error})
 
-def llama3_summarize(text):
-    prompt = f"Summarize the following document:\n{text}"
-    return llama3_generate(prompt)
+ANALYSIS_SECTIONS = ["summary", "grammar", "suggestions", "inconsistencies", "repetition", "internal_inconsistencies"]
 
-def llama3_grammar_correct(text):
-    prompt = f"Correct the grammar in the following text:\n{text}"
-    return llama3_generate(prompt)
+PROMPT_TEMPLATES = {
+    "summary": "Summarize the following document:\n{text}",
+    "grammar": "Correct the grammar in the following text:\n{text}",
+    "suggestions": "Suggest improvements for the following document:\n{text}",
+    "inconsistencies": "Check for inconsistencies between the following document and screenshots.\nDocument:\n{doc_text}\nScreenshots:\n{screenshots}",
+    "repetition": "Analyze the following text and identify any repetitive phrases, sentences, or ideas. List the redundant parts and suggest how they could be consolidated or rewritten for better clarity.\n\nText:\n{text}",
+    "internal_inconsistencies": "Analyze the following document for internal inconsistencies. Check for contradictory statements, conflicting data or numbers, and inconsistencies in definitions or terminology. List any inconsistencies you find.\n\nDocument:\n{text}",
+}
 
-def llama3_suggestions(text):
-    prompt = f"Suggest improvements for the following document:\n{text}"
-    return llama3_generate(prompt)
+async def llama3_summarize(text):
+    prompt = PROMPT_TEMPLATES["summary"].format(text=text)
+    return await llama3_generate(prompt)
 
-def llama3_inconsistencies(doc_text, screenshot_texts):
+async def llama3_grammar_correct(text):
+    prompt = PROMPT_TEMPLATES["grammar"].format(text=text)
+    return await llama3_generate(prompt)
+
+async def llama3_suggestions(text):
+    prompt = PROMPT_TEMPLATES["suggestions"].format(text=text)
+    return await llama3_generate(prompt)
+
+async def llama3_inconsistencies(doc_text, screenshot_texts):
     joined_screens = "\n".join(screenshot_texts)
-    prompt = f"Check for inconsistencies between the following document and screenshots.\nDocument:\n{doc_text}\nScreenshots:\n{joined_screens}"
-    return llama3_generate(prompt)
+    prompt = PROMPT_TEMPLATES["inconsistencies"].format(doc_text=doc_text, screenshots=joined_screens)
+    return await llama3_generate(prompt)
+
+async def llama3_check_for_repetition(text):
+    prompt = PROMPT_TEMPLATES["repetition"].format(text=text)
+    return await llama3_generate(prompt)
+
+async def llama3_check_internal_inconsistencies(text):
+    prompt = PROMPT_TEMPLATES["internal_inconsistencies"].format(text=text)
+    return await llama3_generate(prompt)
+
+TASK_FUNCTIONS = {
+    "summary": llama3_summarize,
+    "grammar": llama3_grammar_correct,
+    "suggestions": llama3_suggestions,
+    "inconsistencies": llama3_inconsistencies,
+    "repetition": llama3_check_for_repetition,
+    "internal_inconsistencies": llama3_check_internal_inconsistencies,
+}
+
+# Prompts that merge per-chunk results; grammar corrections are simply concatenated
+REDUCE_TEMPLATES = {
+    "summary": "The following are summaries of consecutive parts of one document. Combine them into a single coherent summary of the whole document.\n\n{partials}",
+    "suggestions": "The following are improvement suggestions for consecutive parts of one document. Merge them into one list, removing duplicates and keeping any page references.\n\n{partials}",
+    "inconsistencies": "The following are inconsistencies found between parts of one document and the same set of screenshots. Merge them into one list, removing duplicates and keeping any page references.\n\n{partials}",
+    "repetition": "The following are repetition findings for consecutive parts of one document. Merge them into one list, removing duplicates, and point out content that is repeated across parts.\n\n{partials}",
+    "internal_inconsistencies": "The following are internal inconsistencies found in consecutive parts of one document. Merge them into one list, removing duplicates, and point out statements that conflict across parts.\n\n{partials}",
+}
+
+async def llama3_reduce(task, partials):
+    prompt = REDUCE_TEMPLATES[task].format(partials="\n\n---\n\n".join(partials))
+    return await llama3_generate(prompt)
+
+async def analyze_chunked(task, chunks, screenshot_texts, chunk_stats=None) -> LLMResult:
+    """Runs one analysis type over every chunk in parallel and merges the partial results."""
+    total = len(chunks)
+    chunk_screenshots = screenshot_texts if task == "inconsistencies" else []
+    if total > 1:
+        # Partial results of several chunks would interleave; only the finished section is published
+        streaming_section.set(None)
+
+    async def map_chunk(chunk):
+        text = labeled_chunk_text(chunk, total)
+
+        async def analyze():
+            if task == "inconsistencies":
+                return checked_text(await llama3_inconsistencies(text, screenshot_texts))
+            return checked_text(await TASK_FUNCTIONS[task](text))
+
+        return await cached_chunk_result(PROMPT_TEMPLATES[task], text, chunk_screenshots, analyze, chunk_stats)
+
+    return await merge_chunk_results(task, chunks, map_chunk)
+
+def analyzed_separately(task) -> bool:
+    """Whether a section has its own analysis instead of a whole-document prompt per chunk."""
+    return (
+        (task == "grammar" and GRAMMAR_MODE == "paragraph")
+        or (task == "repetition" and REPETITION_MODE != "llm")
+        or (task == "internal_inconsistencies" and CONSISTENCY_MODE != "llm")
+        or (task == "inconsistencies" and SCREENSHOT_RETRIEVAL)
+    )
+
+async def analyze_section(task, extracted, chunks, screenshot_texts, chunk_stats=None, details=None) -> LLMResult:
+    # Runs as its own task, so the streamed section and metrics task label only apply to this section's calls
+    streaming_section.set(task)
+    llm_task.set(task)
+    result = await run_section(task, extracted, chunks, screenshot_texts, chunk_stats, details)
+    publish_section(task, result)
+    return result
+
+async def run_section(task, extracted, chunks, screenshot_texts, chunk_stats=None, details=None) -> LLMResult:
+    if task == "grammar" and GRAMMAR_MODE == "paragraph":
+        return await analyze_grammar(extracted, details)
+    if task == "repetition" and REPETITION_MODE != "llm":
+        return await analyze_repetition(extracted)
+    if task == "internal_inconsistencies" and CONSISTENCY_MODE != "llm":
+        return await analyze_internal_consistency(extracted)
+    if task == "inconsistencies" and SCREENSHOT_RETRIEVAL:
+        return await analyze_screenshot_consistency(extracted, screenshot_texts)
+    return await analyze_chunked(task, chunks, screenshot_texts, chunk_stats)
+
+GRAMMAR_BATCH_TEMPLATE = """Check the grammar, spelling and punctuation of each numbered paragraph below. Do not change wording or style that is already correct.
+Respond with a JSON object of the form {{"corrections": [{{"paragraph": <number>, "original": <the erroneous span, copied exactly from the paragraph>, "correction": <the corrected span>, "reason": <a few words>}}]}}.
+Keep each span as short as possible while still unique within its paragraph. Leave out paragraphs without errors, and respond with {{"corrections": []}} if there are none.
+
+{paragraphs}"""
+
+async def analyze_grammar(extracted, details=None) -> LLMResult:
+    """Checks grammar paragraph by paragraph and reports corrections as diffs.
+
+    Each paragraph's corrections are cached by its text, so only new or edited
+    paragraphs are sent. They are checked in batches of about
+    GRAMMAR_BATCH_TOKENS, in parallel; the model returns only the erroneous
+    spans and their corrections instead of rewriting the document.
+    """
+    paragraphs = [
+        unit for unit in split_units(extracted['text'], extracted['pages'], extracted['paragraphs'])["paragraph"]
+        if needs_check(unit["text"])
+    ]
+    found = {}
+    unchecked = {}
+    for paragraph in paragraphs:
+        if paragraph["text"] in found or paragraph["text"] in unchecked:
+            continue
+        key, cached = get_chunk_result(GRAMMAR_BATCH_TEMPLATE, paragraph["text"], [])
+        if cached is not None:
+            found[paragraph["text"]] = cached["result"]
+        else:
+            unchecked[paragraph["text"]] = {**paragraph, "cache_key": key}
+
+    async def check_batch(batch):
+        prompt = GRAMMAR_BATCH_TEMPLATE.format(paragraphs=format_batch(batch))
+        response = await llm_client.generate(prompt, json_mode=True)
+        if not response.ok:
+            return response.error
+        try:
+            corrections = parse_corrections(response.text, batch)
+        except ValueError as e:
+            return f"Invalid grammar response: {e}"
+        for paragraph, paragraph_corrections in zip(batch, corrections):
+            chunk_cache.set(paragraph["cache_key"], {"result": paragraph_corrections})
+            found[paragraph["text"]] = paragraph_corrections
+        return None
+
+    batches = batch_paragraphs(list(unchecked.values()), GRAMMAR_BATCH_TOKENS)
+    failures = [error for error in await asyncio.gather(*(check_batch(batch) for batch in batches)) if error]
 
-def llama3_check_for_repetition(text):
-    prompt = f"Analyze the following text and identify any repetitive phrases, sentences, or ideas. List the redundant parts and suggest how they could be consolidated or rewritten for better clarity.\n\nText:\n{text}"
-    return llama3_generate(prompt)
+    corrections = [
+        {"paragraph": paragraph["paragraph"], "page": paragraph["page"], **correction}
+        for paragraph in paragraphs
+        for correction in found.get(paragraph["text"], [])
+    ]
+    if details is not None:
+        details["grammar_corrections"] = corrections
+    text = format_corrections(corrections, len(paragraphs))
+    if failures:
+        # Paragraphs from failed batches are retried on the next run; the rest stay cached
+        return LLMResult(text=text, error=f"{len(failures)} of {len(batches)} grammar batch(es) failed: {failures[0]}")
+    return LLMResult(text=text)
 
-def llama3_check_internal_inconsistencies(text):
-    prompt = f"Analyze the following document for internal inconsistencies. Check for contradictory statements, conflicting data or numbers, and inconsistencies in definitions or terminology. List any inconsistencies you find.\n\nDocument:\n{text}"
-    return llama3_generate(prompt)
+REPETITION_ADVICE_TEMPLATE = "The following repeated passages were found in one document, with their positions. For each, suggest how it could be consolidated or rewritten for better clarity, or say that the repetition is intentional (for example a recurring warning or a summary) and can stay.\n\n{clusters}"
+
+async def analyze_repetition(extracted) -> LLMResult:
+    """Finds repeated sentences and paragraphs locally instead of sending the whole document to the LLM.
+
+    In "hybrid" mode the model only sees the detected passages and is asked how to
+    consolidate them; documents without repetition need no LLM call at all.
+    """
+    clusters = await asyncio.to_thread(
+        detect_repetition, extracted['text'], extracted['pages'], extracted['paragraphs']
+    )
+    listing = format_clusters(clusters)
+    if REPETITION_MODE == "local" or not clusters:
+        return LLMResult(text=listing)
+
+    # Clusters are sorted largest first, so the smallest ones are dropped if the prompt is too long
+    shown = fit_token_budget(clusters, format_clusters)
+    advice = await llama3_generate(REPETITION_ADVICE_TEMPLATE.format(clusters=format_clusters(shown)))
+    if not advice.ok:
+        # The local findings are still worth reporting without the model's advice
+        return LLMResult(text=listing, error=advice.error)
+    return LLMResult(text=f"{listing}\n\n### Consolidation advice\n{advice.text}")
+
+CONSISTENCY_REVIEW_TEMPLATE = "An automated check found the following candidate inconsistencies in one document: the same quantity with different values, a term defined in different ways, an acronym with different expansions, or a word spelled in different ways. Each is listed with the excerpts it was found in. For each one, say whether it is a real inconsistency and which version should be used, or why the difference is legitimate. Only report what the excerpts support.\n\n{conflicts}"
+
+async def analyze_internal_consistency(extracted) -> LLMResult:
+    """Indexes numbers, definitions, acronyms and spellings locally and has the LLM review only the conflicts.
+
+    In "hybrid" mode the model sees the conflicting excerpts instead of the whole
+    document, so the prompt size depends on the number of conflicts, not the
+    document length, and documents without conflicts need no LLM call.
+    """
+    conflicts = await asyncio.to_thread(
+        detect_conflicts, extracted['text'], extracted['pages'], extracted['paragraphs']
+    )
+    listing = format_conflicts(conflicts)
+    if CONSISTENCY_MODE == "local" or not conflicts:
+        return LLMResult(text=listing)
+
+    shown = fit_token_budget(conflicts, format_conflicts)
+    review = await llama3_generate(CONSISTENCY_REVIEW_TEMPLATE.format(conflicts=format_conflicts(shown)))
+    if not review.ok:
+        return LLMResult(text=listing, error=review.error)
+    return LLMResult(text=f"{listing}\n\n### Review\n{review.text}")
+
+SCREENSHOT_CHECK_TEMPLATE = "Check for inconsistencies between the following screenshot and the document sections it relates to. The sections were selected because they mention the same things as the screenshot; report only differences you can see between them, citing the section.\nDocument sections:\n{doc_text}\nScreenshot:\n{screenshot}"
+
+async def analyze_screenshot_consistency(extracted, screenshot_texts) -> LLMResult:
+    """Checks each screenshot against only its best-matching document sections.
+
+    Sections are ranked with BM25 against the screenshot's OCR text, so every
+    prompt holds one screenshot and at most RETRIEVAL_TOP_K small sections no
+    matter how long the document is or how many screenshots there are. The
+    per-screenshot checks run in parallel, bounded by the LLM client.
+    """
+    if not screenshot_texts:
+        return LLMResult(text="No screenshots were provided.")
+    if len(screenshot_texts) > 1:
+        streaming_section.set(None)
+    matches = await asyncio.to_thread(
+        match_screenshots, extracted['text'], screenshot_texts, extracted['pages'], extracted['paragraphs']
+    )
+
+    async def check(number, screenshot, sections):
+        heading = f"### Screenshot {number}"
+        if not screenshot.strip():
+            return f"{heading}\nNo text could be read from this screenshot."
+        if not sections:
+            return f"{heading}\nNo section of the document mentions anything shown in this screenshot."
+        doc_text = "\n\n".join(f"[{section['label']}]\n{section['text']}" for section in sections)
+
+        async def analyze():
+            prompt = SCREENSHOT_CHECK_TEMPLATE.format(doc_text=doc_text, screenshot=screenshot)
+            return checked_text(await llama3_generate(prompt))
+
+        result = await cached_chunk_result(SCREENSHOT_CHECK_TEMPLATE, doc_text, [screenshot], analyze)
+        return f"{heading}\n{result}"
+
+    try:
+        checks = await asyncio.gather(*(
+            check(number, screenshot, sections)
+            for number, (screenshot, sections) in enumerate(zip(screenshot_texts, matches), start=1)
+        ))
+    except LLMError as e:
+        return e.result
+    return LLMResult(text="\n\n".join(checks))
+
+def fit_token_budget(items, render):
+    """Keeps the leading items, halving them until `render(items)` fits one chunk's token budget."""
+    while len(items) > 1 and estimate_tokens(render(items)) > CHUNK_TOKEN_BUDGET:
+        items = items[:len(items) // 2]
+    return items
+
+def get_chunk_result(template, text, screenshot_texts, chunk_stats=None):
+    key = make_cache_key(text, screenshot_texts, {"chunk": template}, LLM_MODEL_NAME)
+    cached = chunk_cache.get(key)
+    if chunk_stats is not None:
+        chunk_stats["reused" if cached is not None else "analyzed"] += 1
+    return key, cached
+
+async def cached_chunk_result(template, text, screenshot_texts, analyze, chunk_stats=None):
+    """Returns the cached result of one prompt over one chunk, or runs `analyze()` and caches it."""
+    key, cached = get_chunk_result(template, text, screenshot_texts, chunk_stats)
+    if cached is not None:
+        return cached["result"]
+    # Failed calls raise LLMError here, so only successful results are cached
+    result = await analyze()
+    chunk_cache.set(key, {"result": result})
+    return result
+
+def checked_text(result: LLMResult) -> str:
+    # Abort the whole map-reduce on the first failed call
+    if not result.ok:
+        raise LLMError(result)
+    return result.text
+
+def labeled_chunk_text(chunk, total):
+    # Label chunks so partial results can cite where in the document they came from
+    return chunk['text'] if total == 1 else f"[{chunk_label(chunk, total)}]\n{chunk['text']}"
+
+async def reduce_partials(task, partials):
+    return checked_text(await llama3_reduce(task, partials))
+
+async def merge_chunk_results(task, chunks, map_chunk) -> LLMResult:
+    reduce_chunks = (lambda partials: reduce_partials(task, partials)) if task in REDUCE_TEMPLATES else None
+    try:
+        return LLMResult(text=await map_reduce(chunks, map_chunk, reduce_chunks))
+    except LLMError as e:
+        return e.result
+
+# "fanout" sends one prompt per analysis type; "combined" asks for all
+# document-only analyses in a single JSON response
+ANALYSIS_MODES = ["fanout", "combined"]
+COMBINED_FIELDS = {
+    "summary": "a summary of the document.",
+    "grammar": "the grammar corrections for the text.",
+    "suggestions": "suggested improvements for the document.",
+    "repetition": "any repetitive phrases, sentences, or ideas, listing the redundant parts and how they could be consolidated or rewritten for better clarity.",
+    "internal_inconsistencies": "any internal inconsistencies, such as contradictory statements, conflicting data or numbers, and inconsistencies in definitions or terminology.",
+}
+# Sections with their own analysis are left out of the combined prompt
+COMBINED_SECTIONS = [name for name in COMBINED_FIELDS if not analyzed_separately(name)]
+
+COMBINED_PROMPT_TEMPLATE = (
+    "Analyze the following document and respond with a single JSON object containing exactly these string fields:\n"
+    + "".join(f'"{name}": {COMBINED_FIELDS[name]}\n' for name in COMBINED_SECTIONS)
+    + "Each value must be a plain string (use Markdown-style lists inside the string if needed). Respond with the JSON object only.\n\n"
+    + "Document:\n{text}"
+)
+
+def parse_combined_response(text: str) -> Dict[str, str]:
+    """Returns the sections of a combined-mode response that are present and valid."""
+    cleaned = text.strip()
+    if cleaned.startswith("```"):
+        cleaned = cleaned.strip("`")
+        cleaned = cleaned[cleaned.find("{"):] if "{" in cleaned else cleaned
+    try:
+        data = json.loads(cleaned)
+    except ValueError:
+        return {}
+    if not isinstance(data, dict):
+        return {}
+    return {
+        name: data[name].strip()
+        for name in COMBINED_SECTIONS
+        if isinstance(data.get(name), str) and data[name].strip()
+    }
+
+async def analyze_combined(extracted, chunks, screenshot_texts, chunk_stats=None, details=None) -> Dict[str, LLMResult]:
+    """Runs the combined single-prompt analysis over every chunk.
+
+    Sections missing from or invalid in a chunk's JSON response are re-run with
+    their own per-task prompt for that chunk only. Screenshot inconsistencies
+    and sections with their own analysis run alongside it.
+    """
+    total = len(chunks)
+
+    async def analyze_chunk(chunk):
+        llm_task.set("combined")
+        text = labeled_chunk_text(chunk, total)
+        key, cached = get_chunk_result(COMBINED_PROMPT_TEMPLATE, text, [], chunk_stats)
+        if cached is not None:
+            return {name: LLMResult(text=value) for name, value in cached["result"].items()}
+        response = await llm_client.generate(COMBINED_PROMPT_TEMPLATE.format(text=text), json_mode=True)
+        parsed = parse_combined_response(response.text) if response.ok else {}
+        section_results = {name: LLMResult(text=value) for name, value in parsed.items()}
+        missing = [name for name in COMBINED_SECTIONS if name not in parsed]
+        if missing:
+            print(f"Combined analysis fell back to separate prompts for: {', '.join(missing)}")
+            fallbacks = await asyncio.gather(*(TASK_FUNCTIONS[name](text) for name in missing))
+            section_results.update(zip(missing, fallbacks))
+        # Cache the chunk only when every section succeeded
+        if all(result.ok for result in section_results.values()):
+            chunk_cache.set(key, {"result": {name: result.text for name, result in section_results.items()}})
+        return section_results
+
+    separate = [name for name in ANALYSIS_SECTIONS if name not in COMBINED_SECTIONS]
+    per_chunk, separate_results = await asyncio.gather(
+        asyncio.gather(*(analyze_chunk(chunk) for chunk in chunks)),
+        asyncio.gather(*(
+            analyze_section(name, extracted, chunks, screenshot_texts, chunk_stats, details) for name in separate
+        )),
+    )
+
+    async def merge_section(name):
+        llm_task.set(name)
+        async def map_chunk(chunk):
+            return checked_text(per_chunk[chunk['index']][name])
+        return await merge_chunk_results(name, chunks, map_chunk)
+
+    merged = await asyncio.gather(*(merge_section(name) for name in COMBINED_SECTIONS))
+    return {**dict(zip(separate, separate_results)), **dict(zip(COMBINED_SECTIONS, merged))}
+
+# Cache statistics, job counts and history writer state are read from their sources on each scrape
+CACHE_STATS = {
+    "sessions": session_cache.stats,
+    "analysis": analysis_cache.stats,
+    "chunks": chunk_cache.stats,
+    "ocr": ocr_cache_info,
+    "artifacts": artifact_store.stats,
+}
+
+def cache_counts(field):
+    return lambda: [({"cache": name}, stats()[field]) for name, stats in CACHE_STATS.items()]
+
+metrics.callback("docanalyzer_cache_hits_total", "Cache lookups that found an entry.", "counter", cache_counts("hits"))
+metrics.callback("docanalyzer_cache_misses_total", "Cache lookups that found nothing.", "counter", cache_counts("misses"))
+metrics.callback(
+    "docanalyzer_cache_entries", "Entries currently held, for caches that track it.", "gauge",
+    lambda: [
+        ({"cache": name}, stats[field])
+        for name, stats in ((name, collect()) for name, collect in CACHE_STATS.items())
+        for field in ("size", "entries") if field in stats
+    ],
+)
+metrics.callback(
+    "docanalyzer_job_queue_depth", "Analysis jobs waiting for a worker.", "gauge",
+    lambda: [({}, analysis_jobs.depth())],
+)
+metrics.callback(
+    "docanalyzer_jobs", "Analysis jobs stored, by status.", "gauge",
+    lambda: [({"status": status}, count) for status, count in analysis_jobs.count_by_status().items()],
+)
+metrics.callback(
+    "docanalyzer_history_pending_updates", "History updates waiting for the writer.", "gauge",
+    lambda: [({}, history_store.writer_stats()["pending_updates"])],
+)
+metrics.callback(
+    "docanalyzer_history_write_batches_total", "History writer batches by outcome.", "counter",
+    lambda: [
+        ({"outcome": "ok"}, history_store.writer_stats()["batches"]),
+        ({"outcome": "failed"}, history_store.writer_stats()["failed_batches"]),
+    ],
+)
+metrics.callback(
+    "docanalyzer_history_last_batch_seconds", "Duration of the history writer's last batch.", "gauge",
+    lambda: [({}, history_store.writer_stats()["last_batch_seconds"])],
+)
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus text-format metrics."""
+    if not metrics.METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    return Response(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
 
 @app.get("/test-auth")
 async def test_auth(current_user: Dict = Depends(get_current_user)):
@@ -546,13 +1396,11 @@ async def update_user_profile(
     update_data: UserUpdate,
     current_user: Dict = Depends(get_current_user)
 ):
-    users = load_users()
     user_id = current_user['id']
+    user_to_update = user_store.get_by_id(user_id)
 
-    if user_id not in users:
+    if not user_to_update:
         raise HTTPException(status_code=404, detail="User not found")
-
-    user_to_update = users[user_id]
     
     # If email or password is being changed, current password is required for verification
     if update_data.email or update_data.password:
@@ -568,9 +1416,9 @@ async def update_user_profile(
 
     # Update email if provided
     if update_data.email and update_data.email != user_to_update['email']:
-        for uid, user in users.items():
-            if user['email'] == update_data.email and uid != user_id:
-                raise HTTPException(status_code=400, detail="Email already registered by another user.")
+        existing = user_store.get_by_email(update_data.email)
+        if existing and existing['id'] != user_id:
+            raise HTTPException(status_code=400, detail="Email already registered by another user.")
         user_to_update['email'] = update_data.email
 
     # Update password if provided
@@ -579,11 +1427,20 @@ async def update_user_profile(
              raise HTTPException(status_code=400, detail="Password must be at least 4 characters long.")
         user_to_update['password'] = hash_password(update_data.password)
 
-    users[user_id] = user_to_update
-    save_users(users)
+    try:
+        user_store.update(
+            user_id,
+            name=user_to_update['name'],
+            email=user_to_update['email'],
+            password=user_to_update['password'],
+        )
+    except DuplicateEmailError:
+        raise HTTPException(status_code=400, detail="Email already registered by another user.")
+    session_cache.invalidate_user(user_id)
 
     # Return the updated user data (excluding password)
     updated_user_info = user_to_update.copy()
     del updated_user_info['password']
+    del updated_user_info['id']
     
     return {"message": "Profile updated successfully", "user": updated_user_info}
\ No newline at end of file
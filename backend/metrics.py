@@ -0,0 +1,232 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+# Requests carrying this header keep their trace ID; others get a new one. It is echoed in the response.
+TRACE_HEADER = os.getenv("TRACE_HEADER", "X-Trace-ID")
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# The current request's trace ID, and the analysis task LLM calls are attributed to
+trace_id: ContextVar[Optional[str]] = ContextVar("trace_id", default=None)
+llm_task: ContextVar[str] = ContextVar("llm_task", default="other")
+
+Samples = List[Tuple[str, Dict[str, str], float]]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    """A metric family with fixed label names; values are kept per label combination."""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> Samples:
+        with self._lock:
+            return [(self.name, dict(zip(self.labelnames, key)), value) for key, value in self._values.items()]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def samples(self) -> Samples:
+        samples = []
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                labels = dict(zip(self.labelnames, key))
+                for bound, count in zip(self.buckets, counts):
+                    samples.append((f"{self.name}_bucket", {**labels, "le": _format_value(bound)}, count))
+                samples.append((f"{self.name}_sum", labels, total))
+                samples.append((f"{self.name}_count", labels, counts[-1]))
+        return samples
+
+
+class CallbackMetric(Metric):
+    """A metric read from existing state (queue sizes, cache statistics) at scrape time."""
+
+    def __init__(self, name: str, documentation: str, kind: str, collect: Callable[[], Iterable[Tuple[Dict[str, str], float]]]):
+        super().__init__(name, documentation)
+        self.kind = kind
+        self.collect = collect
+
+    def samples(self) -> Samples:
+        try:
+            return [(self.name, labels, value) for labels, value in self.collect()]
+        except Exception as e:
+            # One broken source must not take down the whole scrape
+            print(f"Failed to collect metric {self.name}: {e}")
+            return []
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """The Prometheus text exposition format (version 0.0.4)."""
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {_escape(metric.documentation)}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name: str, documentation: str, labelnames: Iterable[str] = ()) -> Gauge:
+    return REGISTRY.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name: str, documentation: str, labelnames: Iterable[str] = (), buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+def callback(name: str, documentation: str, kind: str, collect) -> CallbackMetric:
+    return REGISTRY.register(CallbackMetric(name, documentation, kind, collect))
+
+
+# Metrics shared by the modules that record them
+
+HTTP_REQUEST_SECONDS = histogram(
+    "docanalyzer_http_request_seconds", "HTTP request latency by route.", ("method", "route", "status")
+)
+JOB_STAGE_SECONDS = histogram(
+    "docanalyzer_job_stage_seconds", "Time spent in each analysis job stage.", ("stage", "state")
+)
+JOB_SECONDS = histogram(
+    "docanalyzer_job_seconds", "Total analysis job run time by outcome.", ("status",)
+)
+LLM_REQUEST_SECONDS = histogram(
+    "docanalyzer_llm_request_seconds", "LLM call latency including retries, by analysis task.", ("task", "provider")
+)
+LLM_REQUESTS = counter(
+    "docanalyzer_llm_requests_total", "LLM calls by analysis task and outcome.", ("task", "provider", "outcome")
+)
+LLM_ERRORS = counter(
+    "docanalyzer_llm_errors_total", "Failed LLM calls by task and HTTP status (\"none\" for transport errors).", ("task", "status")
+)
+LLM_RETRIES = counter(
+    "docanalyzer_llm_retries_total", "LLM request attempts beyond the first, by task.", ("task",)
+)
+LLM_TOKENS = counter(
+    "docanalyzer_llm_tokens_total", "Tokens reported by the LLM provider, by task and direction.", ("task", "direction")
+)
+REPORT_RENDER_SECONDS = histogram(
+    "docanalyzer_report_render_seconds", "Report rendering time by format.", ("format",)
+)
+
+
+def record_llm_result(result, provider: str):
+    """Records one finished LLM call against the analysis task in `llm_task`."""
+    task = llm_task.get()
+    LLM_REQUEST_SECONDS.observe(result.latency, task=task, provider=provider)
+    LLM_REQUESTS.inc(task=task, provider=provider, outcome="ok" if result.ok else "error")
+    if not result.ok:
+        LLM_ERRORS.inc(task=task, status=str(result.status_code or "none"))
+    if result.attempts > 1:
+        LLM_RETRIES.inc(result.attempts - 1, task=task)
+    if result.input_tokens:
+        LLM_TOKENS.inc(result.input_tokens, task=task, direction="input")
+    if result.output_tokens:
+        LLM_TOKENS.inc(result.output_tokens, task=task, direction="output")
+
+
+# A stage ends when it reports one of these after "running"
+FINISHED_STAGE_STATES = ("done", "cached", "deferred", "failed")
+
+
+def timed_progress(progress: Callable[[str, str], None]) -> Callable[[str, str], None]:
+    """Wraps a job's progress callback to time each stage from "running" to its final state."""
+    started: Dict[str, float] = {}
+
+    def report(stage: str, state: str):
+        if state == "running":
+            started[stage] = time.monotonic()
+        elif state in FINISHED_STAGE_STATES and stage in started:
+            JOB_STAGE_SECONDS.observe(time.monotonic() - started.pop(stage), stage=stage, state=state)
+        progress(stage, state)
+
+    return report
@@ -0,0 +1,240 @@
+import os
+import random
+import re
+import zlib
+from collections import defaultdict
+from typing import Dict, List, Optional, Set
+
+# "llm" sends the document to the model as before; "hybrid" detects repetition
+# locally and asks the model only for consolidation advice; "local" never calls the model
+REPETITION_MODE = os.getenv("REPETITION_MODE", "hybrid").lower()
+REPETITION_MODES = ("llm", "hybrid", "local")
+
+SHINGLE_WORDS = 3
+MIN_SENTENCE_WORDS = 6
+MIN_PARAGRAPH_WORDS = 15
+NUM_PERMUTATIONS = 64
+LSH_BANDS = 16  # 16 bands of 4 rows: pairs above ~0.5 Jaccard become candidates
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv("REPETITION_SIMILARITY_THRESHOLD", "0.7"))
+MAX_CLUSTERS = int(os.getenv("REPETITION_MAX_CLUSTERS", "50"))
+PREVIEW_CHARS = 200
+# PDF text rarely has blank lines between paragraphs; longer blocks are regrouped from their lines
+PARAGRAPH_MAX_WORDS = int(os.getenv("PARAGRAPH_MAX_WORDS", "150"))
+
+_WORD = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+(?=[A-Z0-9\"'(])")
+_PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+_LINE_ENDS_SENTENCE = re.compile(r"[.!?:][\"')\]]*$")
+_LIST_ITEM = re.compile(r"^(?:[-*\u2022\u25aa\u2013]|\(?\d+[.)]|\(?[a-z][.)])\s")
+
+# Fixed seed so MinHash signatures, and therefore results, are reproducible
+_MASKS = random.Random(7).sample(range(1, 2 ** 32), NUM_PERMUTATIONS)
+
+
+def _words(text: str) -> List[str]:
+    return _WORD.findall(text.lower())
+
+
+def _shingles(words: List[str]) -> Set[int]:
+    if len(words) < SHINGLE_WORDS:
+        return {zlib.crc32(" ".join(words).encode("utf-8"))}
+    return {
+        zlib.crc32(" ".join(words[i:i + SHINGLE_WORDS]).encode("utf-8"))
+        for i in range(len(words) - SHINGLE_WORDS + 1)
+    }
+
+
+def minhash(shingles: Set[int]) -> List[int]:
+    # Each XOR mask acts as one hash permutation; map() keeps the inner loop in C
+    return [min(map(mask.__xor__, shingles)) for mask in _MASKS]
+
+
+def _group_sentences(text: str, max_words: int) -> List[str]:
+    pieces, current, words = [], [], 0
+    for sentence in _SENTENCE_END.split(text):
+        count = len(sentence.split())
+        if current and words + count > max_words:
+            pieces.append(" ".join(current))
+            current, words = [], 0
+        current.append(sentence)
+        words += count
+    if current:
+        pieces.append(" ".join(current))
+    return pieces
+
+
+def split_block(block: str, max_words: int = PARAGRAPH_MAX_WORDS) -> List[str]:
+    """Splits a block of extracted text that has no blank lines into paragraph-sized pieces.
+
+    A paragraph ends after a line that ends a sentence and is clearly shorter
+    than a full line, after a short heading-like line, or before a list item.
+    Pieces still longer than `max_words` are grouped sentence by sentence.
+    """
+    if len(block.split()) <= max_words:
+        return [block]
+    lines = [line.strip() for line in block.split("\n") if line.strip()]
+    full_width = max(len(line) for line in lines)
+    groups, current = [], []
+    for index, line in enumerate(lines):
+        current.append(line)
+        following = lines[index + 1] if index + 1 < len(lines) else ""
+        short = len(line) < 0.8 * full_width
+        ends_sentence = bool(_LINE_ENDS_SENTENCE.search(line))
+        heading = len(line) < 0.5 * full_width and not ends_sentence and following[:1].isupper()
+        if (ends_sentence and short) or heading or _LIST_ITEM.match(following):
+            groups.append(" ".join(current))
+            current = []
+    if current:
+        groups.append(" ".join(current))
+
+    pieces = []
+    for group in groups:
+        pieces.extend(_group_sentences(group, max_words) if len(group.split()) > max_words else [group])
+    return pieces
+
+
+def split_units(text: str, pages: Optional[List[Dict]] = None, paragraphs: Optional[List[Dict]] = None) -> Dict[str, List[Dict]]:
+    """Splits a document into paragraphs and sentences, each with its 1-based position.
+
+    DOCX paragraphs are used as they are; PDF and plain text are split on
+    blank lines and then regrouped from their lines (see `split_block`).
+    """
+    if paragraphs:
+        blocks = [(p["text"], None) for p in paragraphs]
+    elif pages:
+        blocks = [
+            (piece, page["page"])
+            for page in pages for block in _PARAGRAPH_BREAK.split(page["text"]) for piece in split_block(block)
+        ]
+    else:
+        blocks = [(piece, None) for block in _PARAGRAPH_BREAK.split(text) for piece in split_block(block)]
+
+    units = {"paragraph": [], "sentence": []}
+    number = 0
+    for block, page in blocks:
+        block = " ".join(block.split())
+        if not block:
+            continue
+        number += 1
+        units["paragraph"].append({"text": block, "paragraph": number, "page": page})
+        for index, sentence in enumerate(_SENTENCE_END.split(block), start=1):
+            units["sentence"].append({"text": sentence, "paragraph": number, "sentence": index, "page": page})
+    return units
+
+
+def _find_clusters(units: List[Dict], min_words: int) -> List[Dict]:
+    candidates = []
+    for unit in units:
+        words = _words(unit["text"])
+        if len(words) >= min_words:
+            candidates.append((unit, " ".join(words), _shingles(words)))
+
+    parent = list(range(len(candidates)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    similarity: Dict[int, float] = {}
+
+    def union(i, j, score):
+        # Each cluster keeps the lowest similarity among the links that formed it
+        root_i, root_j = find(i), find(j)
+        lowest = min(similarity.get(root_i, 1.0), score)
+        if root_i != root_j:
+            lowest = min(lowest, similarity.pop(root_j, 1.0))
+            parent[root_j] = root_i
+        similarity[root_i] = lowest
+
+    # Exact duplicates (after normalization) are grouped directly
+    first_seen: Dict[str, int] = {}
+    for i, (_, normalized, _) in enumerate(candidates):
+        if normalized in first_seen:
+            union(first_seen[normalized], i, 1.0)
+        else:
+            first_seen[normalized] = i
+
+    # Near duplicates: LSH over MinHash signatures, verified with the exact Jaccard similarity
+    rows = NUM_PERMUTATIONS // LSH_BANDS
+    buckets = defaultdict(list)
+    for i, (_, normalized, shingles) in enumerate(candidates):
+        if first_seen[normalized] != i:
+            continue
+        signature = minhash(shingles)
+        for band in range(LSH_BANDS):
+            buckets[(band, tuple(signature[band * rows:(band + 1) * rows]))].append(i)
+    checked = set()
+    for members in buckets.values():
+        for a in range(len(members)):
+            for b in range(a + 1, len(members)):
+                i, j = members[a], members[b]
+                if (i, j) in checked or find(i) == find(j):
+                    continue
+                checked.add((i, j))
+                shingles_i, shingles_j = candidates[i][2], candidates[j][2]
+                score = len(shingles_i & shingles_j) / len(shingles_i | shingles_j)
+                if score >= NEAR_DUPLICATE_THRESHOLD:
+                    union(i, j, score)
+
+    groups = defaultdict(list)
+    for i in range(len(candidates)):
+        groups[find(i)].append(i)
+    clusters = []
+    for root, members in groups.items():
+        if len(members) < 2:
+            continue
+        exact = len({candidates[i][1] for i in members}) == 1
+        clusters.append({
+            "kind": "exact" if exact else "near",
+            "similarity": 1.0 if exact else round(similarity.get(root, NEAR_DUPLICATE_THRESHOLD), 2),
+            "occurrences": [candidates[i][0] for i in members],
+        })
+    return clusters
+
+
+def detect_repetition(text: str, pages: Optional[List[Dict]] = None, paragraphs: Optional[List[Dict]] = None) -> List[Dict]:
+    """Finds exact and near-duplicate paragraphs and sentences.
+
+    Returns clusters {"unit", "kind", "similarity", "occurrences"}, largest
+    first. Sentence clusters that only repeat inside already-reported
+    duplicate paragraphs are left out.
+    """
+    units = split_units(text, pages, paragraphs)
+    paragraph_clusters = _find_clusters(units["paragraph"], MIN_PARAGRAPH_WORDS)
+    covered = {occ["paragraph"] for cluster in paragraph_clusters for occ in cluster["occurrences"]}
+    sentence_clusters = [
+        cluster for cluster in _find_clusters(units["sentence"], MIN_SENTENCE_WORDS)
+        if not all(occ["paragraph"] in covered for occ in cluster["occurrences"])
+    ]
+    clusters = [{"unit": "paragraph", **c} for c in paragraph_clusters] + [{"unit": "sentence", **c} for c in sentence_clusters]
+    clusters.sort(key=lambda c: (-len(c["occurrences"]) * len(c["occurrences"][0]["text"]), c["occurrences"][0]["paragraph"]))
+    return clusters[:MAX_CLUSTERS]
+
+
+def format_position(occurrence: Dict) -> str:
+    position = f"Paragraph {occurrence['paragraph']}"
+    if occurrence.get("sentence"):
+        position += f", sentence {occurrence['sentence']}"
+    if occurrence.get("page"):
+        position += f" (page {occurrence['page']})"
+    return position
+
+
+def preview(text: str) -> str:
+    return text if len(text) <= PREVIEW_CHARS else text[:PREVIEW_CHARS - 3] + "..."
+
+
+def format_clusters(clusters: List[Dict]) -> str:
+    """Renders clusters as the report's Markdown-style list."""
+    if not clusters:
+        return "No repeated sentences or paragraphs were found."
+    lines = [f"Found {len(clusters)} repeated passage(s)."]
+    for cluster in clusters:
+        detail = "exact" if cluster["kind"] == "exact" else f"near-duplicate, {cluster['similarity']:.0%} similar"
+        lines.append("")
+        lines.append(f"### Repeated {cluster['unit']} ({detail}, {len(cluster['occurrences'])} occurrences)")
+        for occurrence in cluster["occurrences"]:
+            lines.append(f"- {format_position(occurrence)}: \"{preview(occurrence['text'])}\"")
+    return "\n".join(lines)
@@ -0,0 +1,353 @@
+import asyncio
+import io
+import os
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import lru_cache
+from typing import Dict, Iterator, List, Tuple
+
+from docx import Document
+from docx.enum.style import WD_STYLE_TYPE
+from docx.enum.text import WD_ALIGN_PARAGRAPH
+from docx.shared import Pt, RGBColor
+
+from metrics import REPORT_RENDER_SECONDS
+
+REPORT_WORKERS = int(os.getenv("REPORT_WORKERS", "2"))
+# Render the PDF right after each analysis instead of on the first download
+REPORT_PREBUILD_PDF = os.getenv("REPORT_PREBUILD_PDF", "false").lower() == "true"
+# "eager" renders the DOCX with every analysis; "lazy" waits for the first GET /report/{id}
+REPORT_RENDER_MODE = os.getenv("REPORT_RENDER_MODE", "eager").lower()
+
+# (analysis entry key, report heading) in report order
+REPORT_SECTIONS = [
+    ("summary", "Summary"),
+    ("grammar_correction", "Grammar Corrections"),
+    ("suggestions", "Improvement Suggestions"),
+    ("inconsistencies", "Screenshot Inconsistencies"),
+    ("repetition_check", "Repetitive Content Check"),
+    ("internal_inconsistencies", "Internal Inconsistencies Check"),
+]
+
+
+def section_blocks(content: str) -> Iterator[Tuple[str, str]]:
+    """Classifies each line of an LLM section as ("bullet" | "number" | "subheading" | "paragraph", text)."""
+    for line in content.strip().split('\n'):
+        stripped = line.strip()
+        # Bullet points ("* " or "- ")
+        if stripped.startswith("* ") or stripped.startswith("- "):
+            yield "bullet", stripped[2:]
+        # Numbered list (e.g., "1. ", "2. ")
+        elif len(stripped) > 2 and stripped[:2].isdigit() and stripped[2:4] == ". ":
+            yield "number", stripped[4:]
+        # Markdown-style subheading (e.g., "### Heading")
+        elif stripped.startswith("### "):
+            yield "subheading", stripped[4:]
+        # Normal paragraph
+        else:
+            yield "paragraph", stripped
+
+
+def format_timestamp(timestamp: str) -> str:
+    try:
+        return datetime.fromisoformat(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+    except (TypeError, ValueError):
+        return timestamp or ""
+
+
+def setup_document_styles(document):
+    """Sets up custom styles for the document."""
+    styles = document.styles
+    try:
+        # Base style
+        base_style = styles['Normal']
+        font = base_style.font
+        font.name = 'Calibri'
+        font.size = Pt(11)
+
+        # Title style
+        title_style = styles.add_style('ReportTitle', WD_STYLE_TYPE.PARAGRAPH)
+        font = title_style.font
+        font.name = 'Calibri'
+        font.size = Pt(28)
+        font.bold = True
+        font.color.rgb = RGBColor(0x1F, 0x4E, 0x78)
+
+        # Heading 1 style
+        h1_style = styles.add_style('ReportHeading1', WD_STYLE_TYPE.PARAGRAPH)
+        h1_style.base_style = styles['Heading 1']
+        font = h1_style.font
+        font.name = 'Calibri'
+        font.size = Pt(16)
+        font.bold = True
+        font.color.rgb = RGBColor(0x1F, 0x4E, 0x78)
+        p_format = h1_style.paragraph_format
+        p_format.space_before = Pt(12)
+        p_format.space_after = Pt(6)
+    except Exception as e:
+        print(f"An error occurred during style setup: {e}")
+
+
+@lru_cache(maxsize=1)
+def docx_template() -> bytes:
+    """The styled, empty report document, built once per process."""
+    document = Document()
+    setup_document_styles(document)
+    buffer = io.BytesIO()
+    document.save(buffer)
+    return buffer.getvalue()
+
+
+def render_docx_report(analysis: Dict) -> bytes:
+    """Renders a stored analysis entry to DOCX bytes from a copy of the prebuilt template."""
+    document = Document(io.BytesIO(docx_template()))
+
+    document.add_heading('AI Analysis Report', level=0).alignment = WD_ALIGN_PARAGRAPH.CENTER
+    document.add_paragraph(f"Analysis for: {analysis.get('original_filename', '')}", style='Subtitle').alignment = WD_ALIGN_PARAGRAPH.CENTER
+    document.add_paragraph(f"Analyzed on: {format_timestamp(analysis.get('timestamp'))}", style='Quote').alignment = WD_ALIGN_PARAGRAPH.CENTER
+
+    for key, title in REPORT_SECTIONS:
+        content = analysis.get(key)
+        if not content or not content.strip():
+            continue
+        document.add_heading(title, level=1)
+        for kind, text in section_blocks(content):
+            if kind == "bullet":
+                document.add_paragraph(text, style='List Bullet')
+            elif kind == "number":
+                document.add_paragraph(text, style='List Number')
+            elif kind == "subheading":
+                document.add_heading(text, level=2)
+            else:
+                document.add_paragraph(text)
+
+    buffer = io.BytesIO()
+    document.save(buffer)
+    return buffer.getvalue()
+
+
+# Helvetica advance widths (1/1000 em) for ASCII 32-126, from the standard AFM metrics
+HELVETICA_WIDTHS = [
+    278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+    1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+    333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+    556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584,
+]
+# Helvetica-Bold is slightly wider; over-estimating only wraps a little earlier
+BOLD_WIDTH_FACTOR = 1.08
+
+PAGE_WIDTH, PAGE_HEIGHT = 595, 842  # A4 in points
+MARGIN = 56
+LINE_SPACING = 1.35
+
+# style: (font resource, size, space before, indent)
+PDF_STYLES = {
+    "title": ("F2", 22, 0, 0),
+    "subtitle": ("F1", 12, 4, 0),
+    "heading": ("F2", 15, 16, 0),
+    "subheading": ("F2", 12, 8, 0),
+    "paragraph": ("F1", 10.5, 4, 0),
+    "bullet": ("F1", 10.5, 2, 14),
+    "number": ("F1", 10.5, 2, 14),
+}
+
+
+def _text_width(text: str, size: float, bold: bool) -> float:
+    units = sum(HELVETICA_WIDTHS[ord(c) - 32] if 32 <= ord(c) <= 126 else 556 for c in text)
+    return units * size / 1000 * (BOLD_WIDTH_FACTOR if bold else 1)
+
+
+def _wrap(text: str, size: float, bold: bool, max_width: float) -> List[str]:
+    lines, current = [], ""
+    for word in text.split():
+        candidate = f"{current} {word}" if current else word
+        if _text_width(candidate, size, bold) <= max_width:
+            current = candidate
+            continue
+        if current:
+            lines.append(current)
+        # Hard-break words that are longer than a whole line (e.g. URLs)
+        while _text_width(word, size, bold) > max_width and len(word) > 1:
+            cut = len(word)
+            while cut > 1 and _text_width(word[:cut], size, bold) > max_width:
+                cut -= 1
+            lines.append(word[:cut])
+            word = word[cut:]
+        current = word
+    if current:
+        lines.append(current)
+    return lines or [""]
+
+
+def _pdf_string(text: str) -> str:
+    # Standard fonts use WinAnsiEncoding; characters outside it become "?"
+    encoded = text.encode("cp1252", errors="replace").decode("latin-1")
+    return "(" + encoded.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)") + ")"
+
+
+class _PdfPages:
+    """Lays out styled lines top to bottom, starting new pages as needed."""
+
+    def __init__(self):
+        self.pages: List[List[str]] = []
+        self.y = 0.0
+        self._new_page()
+
+    def _new_page(self):
+        self.pages.append([])
+        self.y = PAGE_HEIGHT - MARGIN
+
+    def add(self, style: str, text: str, align_center: bool = False, marker: str = ""):
+        font, size, space_before, indent = PDF_STYLES[style]
+        bold = font == "F2"
+        line_height = size * LINE_SPACING
+        if self.pages[-1]:
+            self.y -= space_before
+        x = MARGIN + indent
+        for i, line in enumerate(_wrap(text, size, bold, PAGE_WIDTH - MARGIN - x)):
+            if self.y - line_height < MARGIN:
+                self._new_page()
+            self.y -= line_height
+            line_x = x
+            if align_center:
+                line_x = (PAGE_WIDTH - _text_width(line, size, bold)) / 2
+            ops = self.pages[-1]
+            if marker and i == 0:
+                ops.append(f"BT /{font} {size} Tf {x - 11:.2f} {self.y:.2f} Td {_pdf_string(marker)} Tj ET")
+            ops.append(f"BT /{font} {size} Tf {line_x:.2f} {self.y:.2f} Td {_pdf_string(line)} Tj ET")
+
+
+def _write_pdf(pages: List[List[str]], title: str) -> bytes:
+    objects: List[bytes] = []
+
+    def add_object(body: bytes) -> int:
+        objects.append(body)
+        return len(objects)
+
+    catalog = add_object(b"")  # filled in once the page tree exists
+    page_tree = add_object(b"")
+    regular = add_object(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>")
+    bold = add_object(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold /Encoding /WinAnsiEncoding >>")
+    resources = f"<< /Font << /F1 {regular} 0 R /F2 {bold} 0 R >> >>"
+
+    page_ids = []
+    for ops in pages:
+        stream = zlib.compress("\n".join(ops).encode("latin-1"))
+        content = add_object(
+            f"<< /Length {len(stream)} /Filter /FlateDecode >>\nstream\n".encode("latin-1") + stream + b"\nendstream"
+        )
+        page_ids.append(add_object(
+            f"<< /Type /Page /Parent {page_tree} 0 R /MediaBox [0 0 {PAGE_WIDTH} {PAGE_HEIGHT}] "
+            f"/Resources {resources} /Contents {content} 0 R >>".encode("latin-1")
+        ))
+    kids = " ".join(f"{page_id} 0 R" for page_id in page_ids)
+    objects[page_tree - 1] = f"<< /Type /Pages /Kids [{kids}] /Count {len(page_ids)} >>".encode("latin-1")
+    objects[catalog - 1] = f"<< /Type /Catalog /Pages {page_tree} 0 R >>".encode("latin-1")
+    info = add_object(f"<< /Title {_pdf_string(title)} /Producer (AI Document Analyzer) >>".encode("latin-1"))
+
+    out = bytearray(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n".encode("latin-1") + body + b"\nendobj\n"
+    xref_offset = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1")
+    for offset in offsets:
+        out += f"{offset:010d} 00000 n \n".encode("latin-1")
+    out += (
+        f"trailer\n<< /Size {len(objects) + 1} /Root {catalog} 0 R /Info {info} 0 R >>\n"
+        f"startxref\n{xref_offset}\n%%EOF\n"
+    ).encode("latin-1")
+    return bytes(out)
+
+
+def render_pdf_report(analysis: Dict) -> bytes:
+    """Renders a stored analysis entry straight to PDF bytes using the built-in Helvetica fonts."""
+    layout = _PdfPages()
+    layout.add("title", "AI Analysis Report", align_center=True)
+    layout.add("subtitle", f"Analysis for: {analysis.get('original_filename', '')}", align_center=True)
+    layout.add("subtitle", f"Analyzed on: {format_timestamp(analysis.get('timestamp'))}", align_center=True)
+    for key, title in REPORT_SECTIONS:
+        content = analysis.get(key)
+        if not content or not content.strip():
+            continue
+        layout.add("heading", title)
+        number = 0
+        for kind, text in section_blocks(content):
+            number = number + 1 if kind == "number" else 0
+            if kind == "bullet":
+                layout.add("bullet", text, marker="•")
+            elif kind == "number":
+                layout.add("number", text, marker=f"{number}.")
+            else:
+                layout.add(kind, text)
+    return _write_pdf(layout.pages, f"AI Analysis Report - {analysis.get('original_filename', '')}")
+
+
+class ReportBuilder:
+    """Renders report files on a bounded thread pool, off the event loop.
+
+    Rendered files double as the cache: a report that already exists on disk is
+    returned as is. Concurrent requests for the same file share one render, and
+    `invalidate` deletes the file and discards any render still in flight.
+    """
+
+    def __init__(self, workers: int):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="report")
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._generations: Dict[str, int] = {}
+
+    def _render_to_temp(self, path: str, render_fn, args) -> str:
+        with REPORT_RENDER_SECONDS.time(format=os.path.splitext(path)[1].lstrip(".")):
+            data = render_fn(*args)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        return tmp_path
+
+    async def _render(self, path: str, render_fn, args):
+        generation = self._generations.get(path, 0)
+        loop = asyncio.get_running_loop()
+        tmp_path = await loop.run_in_executor(self._executor, self._render_to_temp, path, render_fn, args)
+        if self._generations.get(path, 0) != generation:
+            # Invalidated while rendering; the result is already stale
+            os.remove(tmp_path)
+            return
+        os.replace(tmp_path, path)
+
+    def schedule(self, path: str, render_fn, *args) -> asyncio.Future:
+        future = self._inflight.get(path)
+        if future is None:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            future = asyncio.ensure_future(self._render(path, render_fn, args))
+            self._inflight[path] = future
+            future.add_done_callback(lambda f: self._finished(path, f))
+        return future
+
+    def _finished(self, path: str, future: asyncio.Future):
+        if self._inflight.get(path) is future:
+            del self._inflight[path]
+        if not future.cancelled() and future.exception() is not None:
+            print(f"Failed to render report {path}: {future.exception()}")
+
+    async def build(self, path: str, render_fn, *args) -> str:
+        """Returns `path`, rendering it with `render_fn(*args) -> bytes` first if it does not exist."""
+        if os.path.exists(path):
+            return path
+        await asyncio.shield(self.schedule(path, render_fn, *args))
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        return path
+
+    def invalidate(self, path: str):
+        self._generations[path] = self._generations.get(path, 0) + 1
+        self._inflight.pop(path, None)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,81 @@
+import math
+import os
+import re
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from chunking import chunk_document, chunk_label
+
+# Check each screenshot only against its best-matching document sections instead of the whole document
+SCREENSHOT_RETRIEVAL = os.getenv("SCREENSHOT_RETRIEVAL", "true").lower() == "true"
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "3"))
+# Sections are small chunks, so k of them plus one screenshot stay far below the chunk budget
+RETRIEVAL_SECTION_TOKENS = int(os.getenv("RETRIEVAL_SECTION_TOKENS", "800"))
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_TERM = re.compile(r"[a-z0-9]+")
+# Words that say nothing about which section a screenshot shows
+_STOPWORDS = set("""
+a an the is are was were be been of to for at in on by with from as and or but not no it its this that
+these those you your we our they their he she his her i me my can will would should may might do does
+did has have had so if then than there here all any each which who what when where how
+""".split())
+
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in _TERM.findall(text.lower()) if len(t) > 1 and t not in _STOPWORDS]
+
+
+class BM25Index:
+    """Okapi BM25 ranking over a fixed list of texts."""
+
+    def __init__(self, texts: List[str], k1: float = BM25_K1, b: float = BM25_B):
+        self.k1 = k1
+        self.b = b
+        self.lengths = []
+        # term -> [(text index, term frequency)]
+        self.postings: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        for i, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            self.lengths.append(sum(counts.values()))
+            for term, count in counts.items():
+                self.postings[term].append((i, count))
+        self.average_length = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0.0
+
+    def _idf(self, term: str) -> float:
+        matches = len(self.postings.get(term, ()))
+        return math.log(1 + (len(self.lengths) - matches + 0.5) / (matches + 0.5))
+
+    def search(self, query: str, k: int) -> List[Tuple[int, float]]:
+        """Returns up to `k` (text index, score) pairs, best first; texts sharing no term are left out."""
+        scores: Dict[int, float] = defaultdict(float)
+        for term, query_count in Counter(tokenize(query)).items():
+            idf = self._idf(term)
+            for i, count in self.postings.get(term, ()):
+                norm = 1 - self.b + self.b * self.lengths[i] / (self.average_length or 1)
+                scores[i] += query_count * idf * count * (self.k1 + 1) / (count + self.k1 * norm)
+        return sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:k]
+
+
+def match_screenshots(
+    text: str,
+    screenshot_texts: List[str],
+    pages: Optional[List[Dict]] = None,
+    paragraphs: Optional[List[Dict]] = None,
+    top_k: Optional[int] = None,
+) -> List[List[Dict]]:
+    """Returns, for each screenshot, the document sections that best match its OCR text.
+
+    Sections are chunks of at most RETRIEVAL_SECTION_TOKENS with an added
+    "label" (a page range or opening line), returned in document order.
+    """
+    sections = chunk_document(text, pages, token_budget=RETRIEVAL_SECTION_TOKENS, paragraphs=paragraphs)
+    for section in sections:
+        section["label"] = chunk_label(section, len(sections))
+    index = BM25Index([section["text"] for section in sections])
+    matches = []
+    for screenshot in screenshot_texts:
+        hits = index.search(screenshot, top_k or RETRIEVAL_TOP_K)
+        matches.append([sections[i] for i in sorted(i for i, _ in hits)])
+    return matches
@@ -0,0 +1,298 @@
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from datetime import datetime
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+MAX_DOCUMENT_BYTES = int(os.getenv("MAX_DOCUMENT_BYTES", str(100 * 1024 * 1024)))
+MAX_SCREENSHOT_BYTES = int(os.getenv("MAX_SCREENSHOT_BYTES", str(20 * 1024 * 1024)))
+# Uploads that are never analyzed, and abandoned upload sessions, are removed after this long
+UPLOAD_TTL_SECONDS = int(os.getenv("UPLOAD_TTL_SECONDS", str(24 * 3600)))
+UPLOAD_GC_INTERVAL_SECONDS = int(os.getenv("UPLOAD_GC_INTERVAL_SECONDS", "3600"))
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class UploadSessionError(Exception):
+    pass
+
+
+def safe_filename(filename: Optional[str]) -> str:
+    # Never let a client-supplied name escape the upload directory
+    name = os.path.basename((filename or "").replace("\\", "/")).strip()
+    return name if name and name not in (".", "..") else f"upload_{uuid.uuid4().hex[:8]}"
+
+
+def stored_filename(role: str, index: int, filename: str) -> str:
+    """The on-disk name of an upload's file, e.g. "screenshot_2.png".
+
+    Files are stored by role and position so that two files with the same
+    client name cannot overwrite each other; the extension is kept because
+    extraction dispatches on it.
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    return f"{role}{extension}" if role == "document" else f"{role}_{index}{extension}"
+
+
+def upload_filename(info: Dict) -> str:
+    """The client's name for an uploaded file; older manifests stored files under that name."""
+    return info.get("filename") or os.path.basename(info["path"])
+
+
+async def _write_stream(chunks: AsyncIterator[bytes], f, digest, written: int, max_bytes: int) -> int:
+    async for chunk in chunks:
+        written += len(chunk)
+        if written > max_bytes:
+            raise UploadTooLarge(f"File exceeds the maximum size of {max_bytes} bytes.")
+        digest.update(chunk)
+        await asyncio.to_thread(f.write, chunk)
+    return written
+
+
+async def _iter_upload_file(upload) -> AsyncIterator[bytes]:
+    while True:
+        chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+async def save_upload_file(upload, dest_path: str, max_bytes: int) -> Dict:
+    """Streams an UploadFile to disk in fixed-size chunks, hashing it in the same pass.
+
+    The file is written to a temporary `.part` path and only moved into place
+    once complete; anything over `max_bytes` aborts and removes the partial file.
+    """
+    part_path = dest_path + ".part"
+    digest = hashlib.sha256()
+    try:
+        with open(part_path, "wb") as f:
+            size = await _write_stream(_iter_upload_file(upload), f, digest, 0, max_bytes)
+    except BaseException:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    os.replace(part_path, dest_path)
+    return {"path": dest_path, "size": size, "sha256": digest.hexdigest()}
+
+
+class UploadSessionStore:
+    """Resumable chunked uploads.
+
+    A session is created with the final file size, then the client PUTs the
+    body in pieces at increasing offsets. Progress is kept on disk, so an
+    interrupted upload resumes from the last received byte. The running
+    SHA-256 is kept in memory and rebuilt from the partial file if the
+    process restarted mid-upload.
+    """
+
+    def __init__(self, root_dir: str):
+        self.root_dir = root_dir
+        self._hashers: Dict = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    def _session_dir(self, user_id: str, session_id: str) -> str:
+        return os.path.join(self.root_dir, user_id, "sessions", session_id)
+
+    def _meta_path(self, user_id: str, session_id: str) -> str:
+        return os.path.join(self._session_dir(user_id, session_id), "session.json")
+
+    def _data_path(self, user_id: str, session_id: str) -> str:
+        return os.path.join(self._session_dir(user_id, session_id), "data.part")
+
+    def _save(self, session: Dict):
+        meta_path = self._meta_path(session["user_id"], session["id"])
+        with open(meta_path + ".tmp", "w") as f:
+            json.dump(session, f)
+        os.replace(meta_path + ".tmp", meta_path)
+
+    def create(self, user_id: str, filename: str, total_size: int, max_bytes: int) -> Dict:
+        if total_size <= 0:
+            raise UploadSessionError("total_size must be positive.")
+        if total_size > max_bytes:
+            raise UploadTooLarge(f"File exceeds the maximum size of {max_bytes} bytes.")
+        session_id = uuid.uuid4().hex
+        os.makedirs(self._session_dir(user_id, session_id))
+        open(self._data_path(user_id, session_id), "wb").close()
+        session = {
+            "id": session_id,
+            "user_id": user_id,
+            "filename": safe_filename(filename),
+            "total_size": total_size,
+            "received": 0,
+            "created_at": datetime.now().isoformat(),
+        }
+        self._save(session)
+        return session
+
+    def get(self, user_id: str, session_id: str) -> Optional[Dict]:
+        # Session IDs are hex UUIDs; anything else cannot be a valid session
+        if not session_id.isalnum():
+            return None
+        meta_path = self._meta_path(user_id, session_id)
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, "r") as f:
+            return json.load(f)
+
+    def _hasher(self, session: Dict):
+        hasher = self._hashers.get(session["id"])
+        if hasher is None:
+            hasher = hashlib.sha256()
+            data_path = self._data_path(session["user_id"], session["id"])
+            with open(data_path, "rb") as f:
+                remaining = session["received"]
+                while remaining > 0:
+                    chunk = f.read(min(UPLOAD_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    hasher.update(chunk)
+                    remaining -= len(chunk)
+            self._hashers[session["id"]] = hasher
+        return hasher
+
+    async def append(self, session: Dict, offset: int, chunks: AsyncIterator[bytes]) -> Dict:
+        """Appends streamed bytes at `offset`, which must equal the bytes received so far."""
+        lock = self._locks.setdefault(session["id"], asyncio.Lock())
+        async with lock:
+            session = self.get(session["user_id"], session["id"])
+            if offset != session["received"]:
+                raise UploadSessionError(f"Expected offset {session['received']}, got {offset}.")
+            data_path = self._data_path(session["user_id"], session["id"])
+            hasher = self._hasher(session)
+            with open(data_path, "r+b") as f:
+                f.seek(offset)
+                f.truncate()
+                # Hash into a copy so a rejected chunk leaves the running hash untouched
+                attempt = hasher.copy()
+                try:
+                    received = await _write_stream(chunks, f, attempt, offset, session["total_size"])
+                except BaseException:
+                    f.truncate(offset)
+                    raise
+            self._hashers[session["id"]] = attempt
+            session["received"] = received
+            self._save(session)
+            return session
+
+    def complete(self, session: Dict, dest_dir: str) -> Dict:
+        if session["received"] != session["total_size"]:
+            raise UploadSessionError(
+                f"Upload incomplete: received {session['received']} of {session['total_size']} bytes."
+            )
+        digest = self._hasher(session).hexdigest()
+        os.makedirs(dest_dir, exist_ok=True)
+        dest_path = os.path.join(dest_dir, stored_filename("document", 0, session["filename"]))
+        os.replace(self._data_path(session["user_id"], session["id"]), dest_path)
+        self.discard(session)
+        return {"path": dest_path, "filename": session["filename"], "size": session["total_size"], "sha256": digest}
+
+    def discard(self, session: Dict):
+        self._hashers.pop(session["id"], None)
+        self._locks.pop(session["id"], None)
+        shutil.rmtree(self._session_dir(session["user_id"], session["id"]), ignore_errors=True)
+
+
+class UploadManifestStore:
+    """Per-upload directories with a manifest describing their files.
+
+    Each upload lives in `<root>/<user_id>/<upload_id>/` next to a
+    `manifest.json` recording the document, screenshots, chapter, hashes
+    and sizes, so an analysis can resolve its inputs by ID without scanning.
+    """
+
+    def __init__(self, root_dir: str):
+        self.root_dir = root_dir
+
+    def _upload_dir(self, user_id: str, upload_id: str) -> str:
+        return os.path.join(self.root_dir, user_id, upload_id)
+
+    def _manifest_path(self, user_id: str, upload_id: str) -> str:
+        return os.path.join(self._upload_dir(user_id, upload_id), "manifest.json")
+
+    def new_upload(self, user_id: str) -> Tuple[str, str]:
+        upload_id = uuid.uuid4().hex
+        upload_dir = self._upload_dir(user_id, upload_id)
+        os.makedirs(upload_dir)
+        return upload_id, upload_dir
+
+    def save(self, manifest: Dict):
+        manifest_path = self._manifest_path(manifest["user_id"], manifest["id"])
+        with open(manifest_path + ".tmp", "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+    def create(
+        self,
+        user_id: str,
+        upload_id: str,
+        document: Dict,
+        screenshots: List[Dict],
+        chapter: Optional[str],
+        document_key: Optional[str] = None,
+    ) -> Dict:
+        manifest = {
+            "id": upload_id,
+            "user_id": user_id,
+            "document": document,
+            # Links revisions of the same document; defaults to its filename
+            "document_key": document_key or upload_filename(document),
+            "screenshots": screenshots,
+            "chapter": chapter,
+            "created_at": datetime.now().isoformat(),
+            "analyzed_at": None,
+        }
+        self.save(manifest)
+        return manifest
+
+    def get(self, user_id: str, upload_id: str) -> Optional[Dict]:
+        # Upload IDs are hex UUIDs; anything else cannot be a valid upload
+        if not upload_id.isalnum():
+            return None
+        manifest_path = self._manifest_path(user_id, upload_id)
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path, "r") as f:
+            return json.load(f)
+
+    def mark_analyzed(self, manifest: Dict):
+        manifest["analyzed_at"] = datetime.now().isoformat()
+        self.save(manifest)
+
+    def discard(self, user_id: str, upload_id: str):
+        shutil.rmtree(self._upload_dir(user_id, upload_id), ignore_errors=True)
+
+    def collect_garbage(self, max_age_seconds: int) -> int:
+        """Removes uploads that were never analyzed, abandoned upload sessions
+        and half-created upload directories older than `max_age_seconds`."""
+        cutoff = time.time() - max_age_seconds
+        removed = 0
+        if not os.path.isdir(self.root_dir):
+            return 0
+        for user_id in os.listdir(self.root_dir):
+            user_dir = os.path.join(self.root_dir, user_id)
+            if not os.path.isdir(user_dir):
+                continue
+            for name in os.listdir(user_dir):
+                path = os.path.join(user_dir, name)
+                if not os.path.isdir(path):
+                    continue
+                if name == "sessions":
+                    candidates = [os.path.join(path, session_id) for session_id in os.listdir(path)]
+                else:
+                    manifest = self.get(user_id, name)
+                    if manifest and manifest.get("analyzed_at"):
+                        continue
+                    candidates = [path]
+                for candidate in candidates:
+                    if os.path.getmtime(candidate) < cutoff:
+                        shutil.rmtree(candidate, ignore_errors=True)
+                        removed += 1
+        return removed
@@ -0,0 +1,185 @@
+import json
+import os
+import sqlite3
+import threading
+from typing import Dict, Optional
+
+from cachetools import TTLCache
+
+USER_FIELDS = ("email", "password", "name", "token", "created_at")
+
+
+class DuplicateEmailError(Exception):
+    pass
+
+
+class UserStore:
+    """SQLite-backed user accounts with indexed lookups by token and email.
+
+    On first use the existing `users.json` file is imported once; afterwards
+    SQLite is the source of truth and the JSON file is left untouched.
+    """
+
+    def __init__(self, db_path: str, legacy_json_path: Optional[str] = None):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._conn:
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS users (
+                    id TEXT PRIMARY KEY,
+                    email TEXT NOT NULL UNIQUE,
+                    password TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    token TEXT,
+                    created_at TEXT NOT NULL
+                )"""
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_users_token ON users(token)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS migrations (name TEXT PRIMARY KEY, applied_at TEXT NOT NULL)")
+        if legacy_json_path:
+            self._migrate_from_json(legacy_json_path)
+
+    def _migrate_from_json(self, json_path: str):
+        with self._lock:
+            done = self._conn.execute("SELECT 1 FROM migrations WHERE name = 'users_json'").fetchone()
+            if done:
+                return
+            users = {}
+            if os.path.exists(json_path):
+                with open(json_path, 'r') as f:
+                    users = json.load(f)
+            with self._conn:
+                skipped = 0
+                for user_id, user in users.items():
+                    cursor = self._conn.execute(
+                        "INSERT OR IGNORE INTO users (id, email, password, name, token, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                        (user_id, *(user.get(field) for field in USER_FIELDS)),
+                    )
+                    skipped += cursor.rowcount == 0
+                self._conn.execute(
+                    "INSERT INTO migrations (name, applied_at) VALUES ('users_json', datetime('now'))"
+                )
+            if users:
+                print(f"Migrated {len(users) - skipped} user(s) from {json_path} ({skipped} skipped as duplicates)")
+
+    def _fetch_one(self, where: str, value: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._conn.execute(f"SELECT * FROM users WHERE {where} = ?", (value,)).fetchone()
+        return dict(row) if row else None
+
+    def get_by_id(self, user_id: str) -> Optional[Dict]:
+        return self._fetch_one("id", user_id)
+
+    def get_by_token(self, token: str) -> Optional[Dict]:
+        return self._fetch_one("token", token)
+
+    def get_by_email(self, email: str) -> Optional[Dict]:
+        return self._fetch_one("email", email)
+
+    def create(self, user_id: str, user: Dict):
+        try:
+            with self._lock, self._conn:
+                self._conn.execute(
+                    "INSERT INTO users (id, email, password, name, token, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    (user_id, *(user.get(field) for field in USER_FIELDS)),
+                )
+        except sqlite3.IntegrityError as e:
+            raise DuplicateEmailError(user.get("email")) from e
+
+    def update(self, user_id: str, **fields):
+        """Updates a single user's row in one transaction."""
+        unknown = set(fields) - set(USER_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown user fields: {', '.join(sorted(unknown))}")
+        if not fields:
+            return
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        try:
+            with self._lock, self._conn:
+                self._conn.execute(f"UPDATE users SET {columns} WHERE id = ?", (*fields.values(), user_id))
+        except sqlite3.IntegrityError as e:
+            raise DuplicateEmailError(fields.get("email")) from e
+
+    def all(self) -> Dict[str, Dict]:
+        with self._lock:
+            rows = self._conn.execute("SELECT * FROM users").fetchall()
+        return {row["id"]: {field: row[field] for field in USER_FIELDS} for row in rows}
+
+
+class _TokenCache(TTLCache):
+    """Token -> user record cache that drops the user's reverse entry whenever a token is evicted or expires."""
+
+    def __init__(self, maxsize: int, ttl: int):
+        super().__init__(maxsize=maxsize, ttl=ttl)
+        self.tokens_by_user: Dict[str, str] = {}
+
+    def _forget(self, token: str, user: Dict):
+        if self.tokens_by_user.get(user["id"]) == token:
+            del self.tokens_by_user[user["id"]]
+
+    def popitem(self):
+        token, user = super().popitem()
+        self._forget(token, user)
+        return token, user
+
+    def expire(self, time=None):
+        expired = super().expire(time)
+        for token, user in expired:
+            self._forget(token, user)
+        return expired
+
+
+class SessionCache:
+    """In-memory bearer token -> user record cache with TTL expiry and a size bound.
+
+    Entries must be invalidated explicitly whenever a user's token or profile
+    changes; the TTL only bounds how long a missed invalidation can linger.
+    Both directions of the token <-> user mapping are evicted together, so a
+    cached token can always be found and invalidated by its user ID.
+    """
+
+    def __init__(self, ttl_seconds: int, max_size: int):
+        self._cache = _TokenCache(max_size, ttl_seconds)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token: str) -> Optional[Dict]:
+        with self._lock:
+            user = self._cache.get(token)
+            if user is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return dict(user)
+
+    def set(self, token: str, user: Dict):
+        with self._lock:
+            # A user has one current token; drop any other one still cached
+            previous = self._cache.tokens_by_user.get(user["id"])
+            if previous is not None and previous != token:
+                self._cache.pop(previous, None)
+            self._cache[token] = dict(user)
+            self._cache.tokens_by_user[user["id"]] = token
+
+    def invalidate_user(self, user_id: str):
+        with self._lock:
+            token = self._cache.tokens_by_user.pop(user_id, None)
+            if token is not None:
+                self._cache.pop(token, None)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._cache),
+                "max_size": self._cache.maxsize,
+                "ttl_seconds": self._cache.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
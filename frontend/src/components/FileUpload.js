@@ -89,10 +89,24 @@ const FileUpload = ({ API_URL, authToken, onAnalysisComplete }) => {
       });
       const analyzeData = await analyzeRes.json();
       
-      if (!analyzeRes.ok) throw new Error(analyzeData.error || 'Analysis failed');
+      if (!analyzeRes.ok) throw new Error(analyzeData.detail || 'Analysis failed');
+
+      // Analysis runs as a background job; poll until it finishes
+      let job = analyzeData;
+      while (job.status === 'queued' || job.status === 'running') {
+        await new Promise(resolve => setTimeout(resolve, 2000));
+        const jobRes = await fetch(`${API_URL}/jobs/${analyzeData.job_id}`, {
+          headers: {
+            'Authorization': `Bearer ${authToken}`
+          },
+        });
+        job = await jobRes.json();
+        if (!jobRes.ok) throw new Error(job.detail || 'Analysis failed');
+      }
+      if (job.status === 'failed') throw new Error(job.error || 'Analysis failed');
 
       setUploadProgress(100);
-      setNewReportId(analyzeData.report_id);
+      setNewReportId(job.report_id);
       setAnalysisComplete(true);
       
       clearInterval(progressInterval);
@@ -6,6 +6,7 @@ import { FaFilePdf, FaFileWord, FaTrash } from 'react-icons/fa';
 
 const History = () => {
   const [history, setHistory] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
   const [error, setError] = useState('');
   const { setIsLoading, setHeader, setBackgroundImage } = useContext(AppContext);
   const navigate = useNavigate();
@@ -23,7 +24,8 @@ const History = () => {
         });
         if (!response.ok) throw new Error('Failed to fetch history');
         const data = await response.json();
-        setHistory(data);
+        setHistory(data.items);
+        setNextCursor(data.next_cursor);
       } catch (err) {
         setError(err.message);
       } finally {
@@ -38,6 +40,25 @@ const History = () => {
     }
   }, [token, navigate, setIsLoading, setHeader, setBackgroundImage]);
 
+  const handleLoadMore = async () => {
+    // The cursor is the last listed entry's ID; page from the last one still shown in case it was deleted
+    const cursor = history.length > 0 ? history[history.length - 1].id : nextCursor;
+    setIsLoading(true);
+    try {
+      const response = await fetch(`http://127.0.0.1:8000/user/history?cursor=${encodeURIComponent(cursor)}`, {
+        headers: { 'Authorization': `Bearer ${token}` }
+      });
+      if (!response.ok) throw new Error('Failed to fetch history');
+      const data = await response.json();
+      setHistory(prevHistory => [...prevHistory, ...data.items]);
+      setNextCursor(data.next_cursor);
+    } catch (err) {
+      setError(err.message);
+    } finally {
+      setIsLoading(false);
+    }
+  };
+
   const handleItemClick = (reportId) => {
     navigate(`/report/${reportId}`);
   };
@@ -99,6 +120,11 @@ const History = () => {
           ))}
         </ul>
       )}
+      {nextCursor && (
+        <button className="load-more-btn" onClick={handleLoadMore}>
+          Load more
+        </button>
+      )}
     </div>
   );
 };